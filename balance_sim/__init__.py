@@ -0,0 +1,6 @@
+"""Headless Monte Carlo balance simulator for the contest pipeline."""
+
+from .engine import merge_results, simulate, simulate_parallel, summarize
+from .tables import apply_override, load_tables
+
+__all__ = ["apply_override", "load_tables", "merge_results", "simulate", "simulate_parallel", "summarize"]
@@ -0,0 +1,78 @@
+import argparse
+import itertools
+import json
+import os
+import time
+
+from .engine import POLICIES, simulate_parallel, summarize
+from .tables import GAME_DATA, apply_path, load_tables, parse_override_value
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="python -m balance_sim",
+        description="Simulate full games headlessly and report contest promotion rates.",
+    )
+    parser.add_argument("--games", type=int, default=20000, help="games per configuration")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="process pool size")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--policy", choices=POLICIES, default="greedy", help="how the simulated player picks plans")
+    parser.add_argument("--students", type=int, default=6, help="starting club size")
+    parser.add_argument("--data", default=str(GAME_DATA), help="path to gameData.js")
+    parser.add_argument(
+        "--set",
+        dest="overrides",
+        action="append",
+        default=[],
+        metavar="TABLE.ID.FIELD=V1[,V2...]",
+        help="override a table value, e.g. contests.ioaa.cutoff=78,82; several values sweep every combination",
+    )
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    return parser.parse_args()
+
+
+def sweep(overrides):
+    axes = []
+    for assignment in overrides:
+        path, _, raw = assignment.partition("=")
+        if not raw:
+            raise SystemExit(f"--set needs a value: {assignment}")
+        axes.append([(path, parse_override_value(value)) for value in raw.split(",")])
+    return itertools.product(*axes)
+
+
+def print_report(config, summary, elapsed):
+    label = ", ".join(f"{path}={value}" for path, value in config) or "baseline"
+    print(f"== {label}  ({summary['games']} games, {elapsed:.1f}s)")
+    print(f"   IOAA medal probability: {summary['ioaaMedal']:.2%}")
+    reasons = "  ".join(f"{reason} {share:.1%}" for reason, share in summary["endReasons"].items())
+    print(f"   endings: {reasons}")
+    print(f"   {'stage':<20} {'held':>7} {'advanced':>9} {'if held':>8} {'promoted':>9}")
+    for stage in summary["stages"]:
+        print(
+            f"   {stage['stage']:<20} {stage['held']:>7.1%} {stage['advanced']:>9.1%} "
+            f"{stage['advancedWhenHeld']:>8.1%} {stage['promotedPerGame']:>9.2f}"
+        )
+
+
+def main():
+    args = parse_args()
+    tables = load_tables(args.data)
+    results = []
+    for config in sweep(args.overrides):
+        configured = tables
+        for path, value in config:
+            configured = apply_path(configured, path, value)
+        started = time.perf_counter()
+        summary = summarize(simulate_parallel(configured, args.games, args.workers, args.seed, args.policy, args.students))
+        elapsed = time.perf_counter() - started
+        if args.json:
+            results.append({"overrides": dict(config), "seconds": round(elapsed, 3), **summary})
+        else:
+            print_report(config, summary, elapsed)
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
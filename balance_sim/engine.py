@@ -0,0 +1,530 @@
+"""Vectorized re-implementation of the weekly loop in ``web/gameEngine.js``.
+
+Every array carries one row per simulated game. Calendar time advances in
+lockstep for all games (each executed plan is exactly one week), so contests,
+grants and new school years happen on the same step everywhere and only the
+per-game state needs masking. AI events are not simulated.
+"""
+
+import math
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+SLOTS = 10
+MAX_ACTIVE = 10
+BAD_WEATHER = ("阴天", "大雨")
+KEPT_HONORS = ("国集", "IOAA")
+OBSERVATION_TYPES = ("观测", "实测")
+TRAIT_COUNTS = np.array([1, 2, 3])
+TRAIT_COUNT_WEIGHTS = np.array([42, 44, 14]) / 100
+END_REASONS = ("victory", "ioaaLost", "ioaaForfeit", "allQuit", "timeout")
+POLICIES = ("greedy", "random")
+
+
+def js_round(values):
+    return np.floor(np.asarray(values) + 0.5)
+
+
+class CompiledTables:
+    # The gameData.js tables flattened into NumPy arrays.
+    def __init__(self, tables):
+        self.attrs = list(tables["ATTRS"])
+        self.months = list(tables["MONTHS"])
+        self.weeks_per_month = tables["WEEKS_PER_MONTH"]
+        self.max_years = tables["MAX_YEARS"]
+
+        weather = tables["WEATHER"]
+        self.weather_names = [item["name"] for item in weather]
+        self.weather_weight = np.array([item["weight"] for item in weather], dtype=float)
+        self.weather_observe = np.array([item["observe"] for item in weather], dtype=float)
+        self.weather_stress = np.array([item["stress"] for item in weather], dtype=float)
+        self.bad_weather = np.array([name in BAD_WEATHER for name in self.weather_names])
+        self.overcast = self.weather_names.index("阴天")
+        self.rain = self.weather_names.index("大雨")
+
+        self.traits = [[(op[0], *op[1:]) for op in trait["ops"]] for trait in tables["TRAITS"]]
+
+        plans = tables["TRAINING_PLANS"]
+        self.plan_ids = [plan["id"] for plan in plans]
+        self.plan_cost = self.column(plans, "cost")
+        self.plan_stress = self.column(plans, "stress")
+        self.plan_money = self.column(plans, "money")
+        self.plan_morale = self.column(plans, "morale")
+        self.plan_equipment = self.column(plans, "equipment")
+        self.plan_recruit = self.column(plans, "recruitChance")
+        self.plan_gains = self.attr_matrix(plan.get("gains") for plan in plans)
+        self.plan_weather = np.array([bool(plan.get("weatherSensitive")) for plan in plans])
+        self.plan_observation = np.array([plan.get("type") in OBSERVATION_TYPES for plan in plans])
+        self.rest = self.plan_ids.index("rest")
+
+        events = tables["EVENTS"]
+        effects = [normalize_effects(event.get("effects")) for event in events]
+        self.event_prob = self.column(events, "probability")
+        self.event_min_stress = self.column(events, "minStress")
+        self.event_scope = np.array([event["id"] == "scope_damage" for event in events])
+        self.event_weather = np.array(
+            [
+                [name in event.get("requiresWeather", self.weather_names) for name in self.weather_names]
+                for event in events
+            ]
+        )
+        money = np.array([effect["money"] for effect in effects], dtype=float)
+        self.event_cost = np.maximum(0, -money)
+        self.event_money = np.where(self.event_cost > 0, 0, money)
+        self.event_stress = np.array([effect["stress"] for effect in effects], dtype=float)
+        self.event_morale = np.array([effect["morale"] for effect in effects], dtype=float)
+        self.event_equipment = np.array([effect["equipment"] for effect in effects], dtype=float)
+        self.event_attrs = self.attr_matrix(effect["attrs"] for effect in effects)
+
+        camp = tables["CAMP_ACTIONS"]
+        self.camp_attrs = self.attr_matrix(action["effects"].get("attrs") for action in camp)
+        self.camp_stress = np.array([action["effects"].get("stress", 0) for action in camp], dtype=float)
+        self.camp_morale = np.array([action["effects"].get("morale", 0) for action in camp], dtype=float)
+        self.camp_luck = np.array([action["effects"].get("luck", 0) for action in camp], dtype=float)
+
+        self.contests = tables["CONTESTS"]
+        honors = []
+        for contest in self.contests:
+            if contest["honor"] not in honors:
+                honors.append(contest["honor"])
+        self.honor_bits = {honor: 1 << index for index, honor in enumerate(honors)}
+        self.kept_honors = sum(self.honor_bits.get(honor, 0) for honor in KEPT_HONORS)
+        self.contest_weights = self.attr_matrix(contest["weights"] for contest in self.contests)
+
+    def column(self, rows, key):
+        return np.array([row.get(key, 0) for row in rows], dtype=float)
+
+    def attr_matrix(self, rows):
+        return np.array([[float((row or {}).get(attr, 0)) for attr in self.attrs] for row in rows])
+
+    def week_index(self, year, month_index, week):
+        return ((year - 1) * len(self.months) + month_index) * self.weeks_per_month + week
+
+    def contest_at(self, year, month_index, week):
+        for index, contest in enumerate(self.contests):
+            if contest["month"] != self.months[month_index] or contest["week"] != week:
+                continue
+            if contest.get("minYear") and year < contest["minYear"]:
+                continue
+            return index
+        return None
+
+    def next_contest(self, year, month_index, week):
+        now = self.week_index(year, month_index, week)
+        best = None
+        for contest_year in range(year, self.max_years + 1):
+            for index, contest in enumerate(self.contests):
+                if contest.get("minYear") and contest_year < contest["minYear"]:
+                    continue
+                at = self.week_index(contest_year, self.months.index(contest["month"]), contest["week"])
+                if at >= now and (best is None or at - now < best[0]):
+                    best = (at - now, index)
+        return None if best is None else best[1]
+
+
+def normalize_effects(effects):
+    # Mirrors normalizeAiEffects in gameEngine.js.
+    effects = effects or {}
+    clamp = lambda value, low, high: max(low, min(high, float(value or 0)))
+    return {
+        "attrs": {attr: clamp(value, -4, 4) for attr, value in (effects.get("attrs") or {}).items() if value},
+        "stress": clamp(effects.get("stress"), -10, 10),
+        "money": clamp(effects.get("money"), -900, 900),
+        "morale": clamp(effects.get("morale"), -10, 10),
+        "equipment": clamp(effects.get("equipment"), -12, 12),
+    }
+
+
+class Simulation:
+    def __init__(self, data, games, rng, policy="greedy", students=6):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown policy {policy}")
+        self.data = data
+        self.games = games
+        self.rng = rng
+        self.policy = policy
+        shape = (games, SLOTS)
+        attr_count = len(data.attrs)
+        self.active = np.zeros(shape, dtype=bool)
+        self.attrs = np.zeros(shape + (attr_count,))
+        self.growth = np.ones(shape + (attr_count,))
+        self.stress = np.zeros(shape)
+        self.stress_scale = np.ones(shape)
+        self.luck = np.zeros(shape)
+        self.variance = np.zeros(shape)
+        self.resilience = np.zeros(shape)
+        self.cloud = np.zeros(shape, dtype=bool)
+        self.honors = np.zeros(shape, dtype=np.int64)
+        self.money = np.full(games, 1800.0)
+        self.equipment = np.full(games, 58.0)
+        self.morale = np.full(games, 45.0)
+        self.weather = np.zeros(games, dtype=int)
+        self.over = np.zeros(games, dtype=bool)
+        self.end_reason = np.full(games, -1)
+        self.plan_available = np.zeros((games, len(data.plan_ids)), dtype=bool)
+        self.event_offer = np.full(games, -1)
+        self.year, self.month_index, self.week = 1, 0, 1
+        self.stages = {}
+
+        initial = np.zeros(shape, dtype=bool)
+        initial[:, :min(students, SLOTS)] = True
+        self.money += self.create_students(initial)
+
+    def run(self):
+        self.start_week(~self.over)
+        while not self.over.all():
+            self.play_week()
+        reasons = {name: int((self.end_reason == index).sum()) for index, name in enumerate(END_REASONS)}
+        return {"games": self.games, "endReasons": reasons, "stages": self.stages}
+
+    def create_students(self, mask):
+        # createStudent for every True slot; returns the sponsor money per game.
+        count = int(mask.sum())
+        data, rng = self.data, self.rng
+        attr_count = len(data.attrs)
+        attrs = rng.uniform(13, 28, (count, attr_count))
+        growth = rng.uniform(0.82, 1.07, (count, attr_count))
+        stress = rng.uniform(14, 30, count)
+        scale = rng.uniform(0.96, 1.18, count)
+        luck = np.zeros(count)
+        variance = np.full(count, 0.1)
+        resilience = np.zeros(count)
+        cloud = np.zeros(count, dtype=bool)
+        sponsor = np.zeros(count)
+
+        trait_count = rng.choice(TRAIT_COUNTS, size=count, p=TRAIT_COUNT_WEIGHTS)
+        ranks = rng.random((count, len(data.traits))).argsort(1).argsort(1)
+        chosen = ranks < trait_count[:, None]
+        for trait, ops in enumerate(data.traits):
+            rows = chosen[:, trait]
+            for kind, *args in ops:
+                if kind == "max_attr":
+                    column = data.attrs.index(args[0])
+                    attrs[rows, column] = np.maximum(attrs[rows, column], float(args[1]))
+                elif kind == "mul_growth":
+                    growth[rows, data.attrs.index(args[0])] *= float(args[1])
+                elif kind == "mul_all_growth":
+                    growth[rows] *= float(args[0])
+                elif kind == "mul":
+                    scale[rows] *= float(args[1])
+                elif kind in {"add", "sub"}:
+                    amount = float(args[1]) * (1 if kind == "add" else -1)
+                    {"luck": luck, "resilience": resilience, "variance": variance}[args[0]][rows] += amount
+                elif kind == "set":
+                    sponsor[rows] = float(args[1])
+                elif kind == "set_flag":
+                    cloud[rows] = args[1] == "true"
+
+        self.active[mask] = True
+        self.attrs[mask] = np.clip(attrs, 5, 99)
+        self.growth[mask] = growth
+        self.stress[mask] = stress
+        self.stress_scale[mask] = scale
+        self.luck[mask] = luck
+        self.variance[mask] = variance
+        self.resilience[mask] = resilience
+        self.cloud[mask] = cloud
+        self.honors[mask] = 0
+        per_slot = np.zeros(mask.shape)
+        per_slot[mask] = sponsor
+        return per_slot.sum(1)
+
+    def apply_stress(self, amount, targets):
+        # applyStudentStress: scaled change, then a chance to quit above 108.
+        targets = targets & self.active
+        adjusted = amount * self.stress_scale * (1 - self.resilience)
+        self.stress = np.where(targets, np.clip(self.stress + adjusted, 0, 120), self.stress)
+        chance = np.clip((self.stress - 98) / 42, 0.14, 0.76)
+        quit = targets & (self.stress > 108) & (self.rng.random(self.stress.shape) < chance)
+        self.active &= ~quit
+
+    def apply_attrs(self, gains, factor, targets):
+        targets = targets & self.active
+        amount = gains[:, None, :] if gains.ndim == 2 else gains
+        growth = np.where(amount > 0, self.growth, 1)
+        changed = np.clip(self.attrs + amount * growth * factor[:, None, None], 0, 100)
+        self.attrs = np.where(targets[..., None], changed, self.attrs)
+
+    def play_week(self):
+        data = self.data
+        live = ~self.over
+        choice = self.choose_options(live)
+        plan_count = len(data.plan_ids)
+        planned = live & (choice < plan_count)
+        event_rows = live & (choice >= plan_count)
+        self.execute_plans(planned, np.minimum(choice, plan_count - 1))
+        self.execute_events(event_rows, np.maximum(choice - plan_count, 0))
+
+        contest = data.contest_at(self.year, self.month_index, self.week)
+        if contest is not None:
+            self.run_contest(contest, live)
+        self.advance_time()
+        self.check_game_end(live & ~self.over)
+        self.start_week(~self.over)
+
+    def execute_plans(self, rows, plan):
+        data = self.data
+        weather = self.weather
+        self.money -= np.where(rows, data.plan_cost[plan], 0)
+
+        factor = np.ones(self.games)
+        sensitive = data.plan_weather[plan]
+        factor *= np.where(sensitive, data.weather_observe[weather], 1)
+        cloud_bonus = sensitive & (self.cloud & self.active).any(1) & data.bad_weather[weather]
+        factor *= np.where(cloud_bonus, 1.18, 1)
+        factor *= np.where((self.equipment < 35) & data.plan_observation[plan], 0.85, 1)
+        factor *= np.where(self.morale > 70, 1.08, 1)
+        factor *= np.where(self.morale < 35, 0.9, 1)
+        self.apply_attrs(data.plan_gains[plan], factor, rows[:, None])
+
+        self.money += np.where(rows, js_round(data.plan_money[plan]), 0)
+        self.equipment = np.where(rows, np.clip(self.equipment + data.plan_equipment[plan], 0, 100), self.equipment)
+        self.morale = np.where(rows, np.clip(self.morale + data.plan_morale[plan], 0, 100), self.morale)
+        stress = data.plan_stress[plan]
+        self.apply_stress(stress[:, None], (rows & (stress != 0))[:, None])
+
+        active_count = self.active.sum(1)
+        recruit = rows & (data.plan_recruit[plan] > 0) & (active_count < MAX_ACTIVE)
+        chance = np.clip(
+            data.plan_recruit[plan] + np.maximum(0, 6 - active_count) * 0.08 + np.maximum(0, self.morale - 55) / 220,
+            0,
+            0.9,
+        )
+        joined = recruit & (self.rng.random(self.games) < chance)
+        if joined.any():
+            slot = np.zeros(self.active.shape, dtype=bool)
+            slot[np.flatnonzero(joined), (~self.active[joined]).argmax(1)] = True
+            self.money += self.create_students(slot)
+            self.stress = np.where(slot, np.maximum(4, self.stress - 6), self.stress)
+
+        self.morale = np.where(rows, np.clip(self.morale + np.where(stress < 0, 1.5, -0.5), 0, 100), self.morale)
+
+    def execute_events(self, rows, event):
+        if not rows.any():
+            return
+        data = self.data
+        self.money -= np.where(rows, data.event_cost[event], 0)
+        self.money += np.where(rows, js_round(data.event_money[event]), 0)
+        self.equipment = np.where(rows, np.clip(self.equipment + data.event_equipment[event], 0, 100), self.equipment)
+        self.morale = np.where(rows, np.clip(self.morale + data.event_morale[event], 0, 100), self.morale)
+        self.apply_attrs(data.event_attrs[event], np.ones(self.games), rows[:, None])
+        stress = data.event_stress[event]
+        self.apply_stress(stress[:, None], (rows & (stress != 0))[:, None])
+
+    def choose_options(self, live):
+        # Columns are the training plans followed by this week's normal event.
+        data = self.data
+        plan_count = len(data.plan_ids)
+        event = np.maximum(self.event_offer, 0)
+        cost = np.concatenate([np.broadcast_to(data.plan_cost, (self.games, plan_count)), data.event_cost[event][:, None]], 1)
+        allowed = np.concatenate([self.plan_available, (self.event_offer >= 0)[:, None]], 1)
+        allowed &= cost <= self.money[:, None]
+        allowed[:, data.rest] = True
+
+        if self.policy == "random":
+            value = self.rng.random(allowed.shape)
+        else:
+            value = self.option_values(event, cost)
+            value += self.rng.random(allowed.shape) * 0.01
+        value = np.where(allowed, value, -np.inf)
+        return np.where(live, value.argmax(1), data.rest)
+
+    def option_values(self, event, cost):
+        # A deliberately simple "reasonable player": train what the next
+        # contest weighs, buy stress relief as the team gets tired, and keep
+        # some money in reserve.
+        data = self.data
+        upcoming = data.next_contest(self.year, self.month_index, self.week)
+        weights = data.contest_weights[upcoming] if upcoming is not None else np.full(len(data.attrs), 0.25)
+        active = self.active
+        count = np.maximum(active.sum(1), 1)
+        avg_stress = np.where(active, self.stress, 0).sum(1) / count
+        stress_price = 0.05 + np.clip((avg_stress - 50) / 30, 0, 2)
+        broke = self.money < 600
+
+        gains = np.concatenate([np.broadcast_to(data.plan_gains, (self.games,) + data.plan_gains.shape), data.event_attrs[event][:, None]], 1)
+        stress = np.concatenate([np.broadcast_to(data.plan_stress, (self.games, len(data.plan_ids))), data.event_stress[event][:, None]], 1)
+        money = np.concatenate([np.broadcast_to(data.plan_money, (self.games, len(data.plan_ids))), data.event_money[event][:, None]], 1)
+        morale = np.concatenate([np.broadcast_to(data.plan_morale, (self.games, len(data.plan_ids))), data.event_morale[event][:, None]], 1)
+        equipment = np.concatenate([np.broadcast_to(data.plan_equipment, (self.games, len(data.plan_ids))), data.event_equipment[event][:, None]], 1)
+        recruit = np.concatenate([np.broadcast_to(data.plan_recruit, (self.games, len(data.plan_ids))), np.zeros((self.games, 1))], 1)
+        sensitive = np.concatenate([np.broadcast_to(data.plan_weather, (self.games, len(data.plan_ids))), np.zeros((self.games, 1), dtype=bool)], 1)
+
+        factor = np.where(sensitive, data.weather_observe[self.weather][:, None], 1)
+        value = (gains * weights).sum(-1) * 4 * factor
+        value -= stress * stress_price[:, None]
+        value += morale * 0.15 + equipment * 0.08
+        value += money / 400 * np.where(broke, 3, 1)[:, None]
+        value -= cost / 400 * np.where(broke, 3, 1)[:, None]
+        value += recruit * np.where(count < 4, 6, 0)[:, None]
+        return value
+
+    def run_contest(self, index, live):
+        data = self.data
+        contest = data.contests[index]
+        key = f"Y{self.year} {contest['name']}"
+        stage = self.stages.setdefault(key, {"order": data.week_index(self.year, self.month_index, self.week), "held": 0, "advanced": 0, "promoted": 0})
+
+        eligible = self.active & live[:, None]
+        if contest.get("requires"):
+            eligible &= (self.honors & data.honor_bits[contest["requires"]]) != 0
+        held = eligible.any(1)
+        if contest.get("final"):
+            forfeit = live & ~held
+            self.finish(forfeit, "ioaaForfeit")
+        if not held.any():
+            return
+
+        if contest.get("camp"):
+            factor = 1.12 if contest["id"] == "national_final" else 1
+            order = self.rng.random((self.games, len(data.camp_stress))).argsort(1)
+            for step in range(2):
+                action = order[:, step]
+                targets = eligible & held[:, None]
+                self.morale = np.where(held, np.clip(self.morale + data.camp_morale[action] * factor, 0, 100), self.morale)
+                self.apply_attrs(data.camp_attrs[action], np.full(self.games, factor), targets)
+                stress = data.camp_stress[action] * factor
+                self.apply_stress(stress[:, None], targets & (stress != 0)[:, None])
+                self.luck = np.where(targets, self.luck + (data.camp_luck[action] * factor)[:, None], self.luck)
+
+        weights = np.broadcast_to(data.contest_weights[index], (self.games, len(data.attrs))).copy()
+        bad = data.bad_weather[self.weather]
+        observe, practice = data.attrs.index("observe"), data.attrs.index("practice")
+        weights[bad, observe] *= 0.72
+        weights[bad, practice] *= 1.08
+
+        base = (self.attrs * weights[:, None, :]).sum(-1)
+        stress_penalty = np.maximum(0, self.stress - 55) * 0.24
+        equipment_bonus = ((self.equipment - 55) * 0.04)[:, None]
+        morale_bonus = ((self.morale - 50) * 0.05)[:, None]
+        variance = (self.rng.random(self.stress.shape) * 2 - 1) * self.variance + self.luck
+        score = np.clip((base - stress_penalty + equipment_bonus + morale_bonus) * (1 + variance), 0, 100)
+
+        rank = np.where(eligible, -score, np.inf).argsort(1, kind="stable").argsort(1)
+        entrants = eligible.sum(1)
+        if contest.get("quota"):
+            quota = np.full(self.games, contest["quota"])
+        else:
+            quota = np.maximum(1, np.ceil(entrants * contest["quotaRatio"]))
+        passed = eligible & (rank < quota[:, None]) & (score >= contest["cutoff"])
+        self.apply_stress(contest["stress"] + np.where(passed, 2, 6), eligible)
+        self.honors |= np.where(passed, data.honor_bits[contest["honor"]], 0)
+
+        promoted = passed.sum(1)
+        stage["held"] += int(held.sum())
+        stage["advanced"] += int((promoted > 0).sum())
+        stage["promoted"] += int(promoted.sum())
+        if contest.get("final"):
+            self.finish(held & (promoted > 0), "victory")
+            self.finish(held & (promoted == 0), "ioaaLost")
+
+    def finish(self, rows, reason):
+        rows = rows & ~self.over
+        self.over |= rows
+        self.end_reason[rows] = END_REASONS.index(reason)
+
+    def advance_time(self):
+        self.week += 1
+        if self.week > self.data.weeks_per_month:
+            self.week = 1
+            self.month_index += 1
+            if self.month_index >= len(self.data.months):
+                self.month_index = 0
+                self.year += 1
+                self.honors &= self.data.kept_honors
+
+    def check_game_end(self, rows):
+        self.finish(rows & ~self.active.any(1), "allQuit")
+        if self.year > self.data.max_years:
+            self.finish(rows, "timeout")
+
+    def start_week(self, rows):
+        data, rng = self.data, self.rng
+        if self.year > data.max_years:
+            return
+        cultists = (self.cloud & self.active).sum(1)
+        weights = np.broadcast_to(data.weather_weight, (self.games, len(data.weather_weight))).copy()
+        weights[:, data.overcast] += cultists * 9
+        weights[:, data.rain] += cultists * 2
+        cumulative = weights.cumsum(1)
+        cursor = rng.random(self.games) * cumulative[:, -1]
+        self.weather = np.where(rows, (cumulative >= cursor[:, None]).argmax(1), self.weather)
+
+        offered = np.where(self.equipment > 75, 6, 5)
+        ranks = rng.random(self.plan_available.shape).argsort(1).argsort(1)
+        self.plan_available = ranks < offered[:, None]
+        self.plan_available[:, data.rest] = True
+
+        count = self.active.sum(1)
+        avg_stress = np.where(self.active, self.stress, 0).sum(1) / np.maximum(count, 1)
+        protection = np.where(data.event_scope, np.clip(self.equipment / 180, 0, 0.42)[:, None], 0)
+        fires = rng.random((self.games, len(data.event_prob))) < data.event_prob * 1.8 - protection
+        fires &= data.event_weather[:, self.weather].T
+        fires &= (data.event_min_stress == 0) | (avg_stress[:, None] >= data.event_min_stress)
+        self.event_offer = np.where(fires.any(1), fires.argmax(1), -1)
+
+        if self.week == 1:
+            self.money += np.where(rows, 280 + js_round(self.morale * 1.15), 0)
+        self.apply_stress(data.weather_stress[self.weather][:, None], rows[:, None])
+        self.finish(rows & ~self.active.any(1), "allQuit")
+
+
+def simulate(tables, games, seed=None, policy="greedy", students=6):
+    data = CompiledTables(tables)
+    return Simulation(data, games, np.random.default_rng(seed), policy, students).run()
+
+
+def simulate_parallel(tables, games, workers=None, seed=None, policy="greedy", students=6, chunk=2000):
+    chunks = [chunk] * (games // chunk) + ([games % chunk] if games % chunk else [])
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    if workers == 1 or len(chunks) == 1:
+        results = [simulate(tables, size, child, policy, students) for size, child in zip(chunks, seeds)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(
+                executor.map(
+                    simulate,
+                    [tables] * len(chunks),
+                    chunks,
+                    seeds,
+                    [policy] * len(chunks),
+                    [students] * len(chunks),
+                )
+            )
+    return merge_results(results)
+
+
+def merge_results(results):
+    merged = {"games": 0, "endReasons": dict.fromkeys(END_REASONS, 0), "stages": {}}
+    for result in results:
+        merged["games"] += result["games"]
+        for reason, count in result["endReasons"].items():
+            merged["endReasons"][reason] += count
+        for key, stage in result["stages"].items():
+            target = merged["stages"].setdefault(key, dict.fromkeys(stage, 0))
+            for field, value in stage.items():
+                target[field] = value if field == "order" else target[field] + value
+    return merged
+
+
+def summarize(result):
+    games = max(result["games"], 1)
+    stages = []
+    for key, stage in sorted(result["stages"].items(), key=lambda item: item[1]["order"]):
+        stages.append(
+            {
+                "stage": key,
+                "held": stage["held"] / games,
+                "advanced": stage["advanced"] / games,
+                "advancedWhenHeld": stage["advanced"] / stage["held"] if stage["held"] else math.nan,
+                "promotedPerGame": stage["promoted"] / games,
+            }
+        )
+    return {
+        "games": result["games"],
+        "ioaaMedal": result["endReasons"]["victory"] / games,
+        "endReasons": {reason: count / games for reason, count in result["endReasons"].items()},
+        "stages": stages,
+    }
@@ -0,0 +1,225 @@
+"""Loads the balance tables straight from ``web/gameData.js``.
+
+The data file is a plain ES module of object literals, so a small literal
+parser is enough; trait ``apply`` bodies are compiled into a list of simple
+operations instead of being evaluated.
+"""
+
+import copy
+import re
+from pathlib import Path
+
+
+GAME_DATA = Path(__file__).resolve().parent.parent / "web" / "gameData.js"
+TABLE_NAMES = (
+    "ATTRS",
+    "MONTHS",
+    "WEEKS_PER_MONTH",
+    "MAX_YEARS",
+    "WEATHER",
+    "TRAITS",
+    "TRAINING_PLANS",
+    "EVENTS",
+    "CONTESTS",
+    "CAMP_ACTIONS",
+)
+# Keys used by ``--set table.id.field=value`` overrides.
+OVERRIDE_TABLES = {
+    "weather": ("WEATHER", "name"),
+    "traits": ("TRAITS", "id"),
+    "plans": ("TRAINING_PLANS", "id"),
+    "events": ("EVENTS", "id"),
+    "contests": ("CONTESTS", "id"),
+    "camp": ("CAMP_ACTIONS", "id"),
+}
+
+TRAIT_STATEMENTS = (
+    (re.compile(r"^student\.attrs\.(\w+) = Math\.max\(student\.attrs\.\1, (-?[\d.]+)\)$"), "max_attr"),
+    (re.compile(r"^student\.growth\.(\w+) \*= (-?[\d.]+)$"), "mul_growth"),
+    (re.compile(r"^for \(const attr of ATTRS\) student\.growth\[attr\] \*= (-?[\d.]+)$"), "mul_all_growth"),
+    (re.compile(r"^student\.(stressScale) \*= (-?[\d.]+)$"), "mul"),
+    (re.compile(r"^student\.(luck|resilience|variance) \+= (-?[\d.]+)$"), "add"),
+    (re.compile(r"^student\.(luck|resilience|variance) -= (-?[\d.]+)$"), "sub"),
+    (re.compile(r"^student\.(sponsor) = (-?[\d.]+)$"), "set"),
+    (re.compile(r"^student\.(cloudAffinity) = (true|false)$"), "set_flag"),
+)
+
+
+class LiteralParser:
+    # Recursive-descent reader for the subset of JavaScript used in gameData.js.
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+
+    def skip(self):
+        while self.pos < len(self.text):
+            if self.text[self.pos].isspace():
+                self.pos += 1
+            elif self.text.startswith("//", self.pos):
+                end = self.text.find("\n", self.pos)
+                self.pos = len(self.text) if end < 0 else end
+            elif self.text.startswith("/*", self.pos):
+                self.pos = self.text.index("*/", self.pos) + 2
+            else:
+                return
+
+    def peek(self):
+        self.skip()
+        return self.text[self.pos] if self.pos < len(self.text) else ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"gameData.js: expected {char!r} at offset {self.pos}")
+        self.pos += 1
+
+    def value(self):
+        char = self.peek()
+        if char == "{":
+            return self.object()
+        if char == "[":
+            return self.array()
+        if char in "\"'":
+            return self.string()
+        match = re.compile(r"-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?").match(self.text, self.pos)
+        if match:
+            self.pos = match.end()
+            number = match.group()
+            return float(number) if any(c in number for c in ".eE") else int(number)
+        name = self.identifier()
+        constants = {"true": True, "false": False, "null": None}
+        if name not in constants:
+            raise ValueError(f"gameData.js: unsupported expression {name!r} at offset {self.pos}")
+        return constants[name]
+
+    def identifier(self):
+        self.skip()
+        match = re.compile(r"[A-Za-z_$][\w$]*").match(self.text, self.pos)
+        if not match:
+            raise ValueError(f"gameData.js: expected identifier at offset {self.pos}")
+        self.pos = match.end()
+        return match.group()
+
+    def string(self):
+        quote = self.text[self.pos]
+        self.pos += 1
+        chars = []
+        while self.text[self.pos] != quote:
+            if self.text[self.pos] == "\\":
+                self.pos += 1
+                chars.append({"n": "\n", "t": "\t"}.get(self.text[self.pos], self.text[self.pos]))
+            else:
+                chars.append(self.text[self.pos])
+            self.pos += 1
+        self.pos += 1
+        return "".join(chars)
+
+    def array(self):
+        self.expect("[")
+        items = []
+        while self.peek() != "]":
+            items.append(self.value())
+            if self.peek() == ",":
+                self.pos += 1
+        self.pos += 1
+        return items
+
+    def object(self):
+        self.expect("{")
+        result = {}
+        while self.peek() != "}":
+            key = self.string() if self.peek() in "\"'" else self.identifier()
+            if self.peek() == "(":
+                result[key] = self.method_body()
+            else:
+                self.expect(":")
+                result[key] = self.value()
+            if self.peek() == ",":
+                self.pos += 1
+        self.pos += 1
+        return result
+
+    def method_body(self):
+        self.pos = self.text.index(")", self.pos) + 1
+        self.expect("{")
+        start = self.pos
+        depth = 1
+        while depth:
+            char = self.text[self.pos]
+            if char in "\"'`":
+                self.pos = self.text.index(char, self.pos + 1)
+            elif char == "{":
+                depth += 1
+            elif char == "}":
+                depth -= 1
+            self.pos += 1
+        return self.text[start:self.pos - 1]
+
+
+def load_tables(path=GAME_DATA):
+    source = Path(path).read_text(encoding="utf-8")
+    tables = {}
+    for name in TABLE_NAMES:
+        match = re.search(rf"^const {name} = ", source, re.MULTILINE)
+        if not match:
+            raise ValueError(f"gameData.js: missing table {name}")
+        parser = LiteralParser(source)
+        parser.pos = match.end()
+        tables[name] = parser.value()
+    for trait in tables["TRAITS"]:
+        trait["ops"] = compile_trait(trait)
+    return tables
+
+
+def compile_trait(trait):
+    ops = []
+    for statement in trait.get("apply", "").split(";"):
+        statement = " ".join(statement.split())
+        if not statement:
+            continue
+        for pattern, kind in TRAIT_STATEMENTS:
+            match = pattern.match(statement)
+            if match:
+                ops.append((kind, *match.groups()))
+                break
+        else:
+            raise ValueError(f"gameData.js: trait {trait.get('id')} has an unsupported statement: {statement}")
+    return ops
+
+
+def apply_override(tables, assignment):
+    path, _, raw = assignment.partition("=")
+    if not raw:
+        raise ValueError(f"override must look like table.id.field=value: {assignment}")
+    return apply_path(tables, path, parse_override_value(raw))
+
+
+def apply_path(tables, path, value):
+    parts = path.split(".")
+    if len(parts) < 3 or parts[0] not in OVERRIDE_TABLES:
+        raise ValueError(f"unknown override target {path}; use one of {', '.join(OVERRIDE_TABLES)}")
+    table_name, key = OVERRIDE_TABLES[parts[0]]
+    tables = copy.deepcopy(tables)
+    rows = [row for row in tables[table_name] if str(row.get(key)) == parts[1]]
+    if not rows:
+        raise ValueError(f"{table_name} has no row with {key}={parts[1]}")
+    target = rows[0]
+    for part in parts[2:-1]:
+        target = target.setdefault(part, {})
+    target[parts[-1]] = value
+    if table_name == "TRAITS":
+        rows[0]["ops"] = compile_trait(rows[0])
+    return tables
+
+
+def parse_override_value(raw):
+    raw = raw.strip()
+    if raw in {"true", "false"}:
+        return raw == "true"
+    try:
+        return int(raw)
+    except ValueError:
+        pass
+    try:
+        return float(raw)
+    except ValueError:
+        return raw
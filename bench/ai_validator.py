@@ -0,0 +1,352 @@
+"""Parity check and benchmark for the schema-driven AI reply validator.
+
+Feeds hand-written and randomly mutated model replies to both the schema-driven
+``ReactionValidator`` in ``main.py`` and the hand-rolled normalizers it
+replaced, checks the repaired replies agree, and compares their speed::
+
+    python bench/ai_validator.py --fuzz 5000
+
+Cases that hit one of the deliberate behaviour changes (non-finite numbers,
+``lines`` that is not a list, non-string or falsy entries inside ``lines``)
+are counted separately instead of compared. Unknown keys inside ``effects``
+are dropped by the new validator, so they are stripped from the legacy
+output before comparing.
+"""
+
+import argparse
+import copy
+import json
+import math
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402
+
+
+REPLY = {
+    "lines": ["这周的训练计划像星图一样漂亮，也一样看不懂。", "经费在燃烧，比流星雨还壮观。"],
+    "event": {
+        "kind": "optional",
+        "title": "天文馆夜场",
+        "text": "天文馆开放夜场，可以带队去蹭讲解。",
+        "target": "",
+        "effects": {"attrs": {"theory": 0, "observe": 1, "practice": 0, "culture": 1.5}, "stress": 2, "money": -180, "morale": 3, "equipment": 0},
+    },
+}
+EFFECT_KEYS = ("attrs", "stress", "money", "morale", "equipment")
+ATTR_KEYS = ("theory", "observe", "practice", "culture")
+
+CASES = {
+    "valid": REPLY,
+    "null event": {"lines": ["今天的星空很安静。"], "event": None},
+    "missing event": {"lines": ["今天的星空很安静。"]},
+    "empty lines": {"lines": [], "event": None},
+    "guidance only": {"lines": ["建议你下一步多做观测。", "你需要调整计划。"], "event": None},
+    "long line": {"lines": ["星" * 90], "event": None},
+    "three lines": {"lines": ["一", "二", "三"], "event": None},
+    "string numbers": {
+        "lines": ["经费又少了。"],
+        "event": {"kind": "passive", "title": "设备故障", "text": "主镜的调焦座坏了。", "target": None,
+                  "effects": {"attrs": {"theory": "1", "observe": "-2", "practice": "", "culture": None}, "stress": "3", "money": "x", "morale": 0, "equipment": "-1"}},
+    },
+    "uppercase kind": {
+        "lines": ["机会来了。"],
+        "event": {"kind": "OPTIONAL", "title": "借镜", "text": "兄弟学校愿意借一台赤道仪。", "target": "林",
+                  "effects": {"attrs": {"theory": 0, "observe": 2, "practice": 0, "culture": 0}, "stress": 1, "money": -50, "morale": 0, "equipment": 1}},
+    },
+    "type alias": {
+        "lines": ["又下雨了。"],
+        "event": {"type": "passive", "title": "连阴雨", "text": "连续三天阴雨，观测全部取消。", "effects": {"stress": 2}},
+    },
+    "passive flag": {
+        "lines": ["又下雨了。"],
+        "event": {"kind": "weird", "passive": True, "title": "阴天", "text": "整晚云层覆盖。", "effects": {}},
+    },
+    "passive wording": {
+        "lines": ["倒霉。"],
+        "event": {"kind": "optional", "title": "镜片损坏", "text": "学生不小心摔坏了目镜。", "target": "",
+                  "effects": {"attrs": {"theory": 0, "observe": 0, "practice": 0, "culture": 0}, "stress": 0, "money": 0, "morale": 0, "equipment": 0}},
+    },
+    "no benefit optional": {
+        "lines": ["花钱了。"],
+        "event": {"kind": "optional", "title": "买资料", "text": "购买一套竞赛讲义。", "target": "",
+                  "effects": {"attrs": {"theory": 0, "observe": 0, "practice": 0, "culture": 0}, "stress": 0, "money": -200, "morale": 0, "equipment": 0}},
+    },
+    "extra keys": {
+        "lines": ["好耶。"], "mood": "happy",
+        "event": {"kind": "optional", "title": "讲座", "text": "天文台研究员来校讲座。", "target": "", "note": "x",
+                  "effects": {"attrs": {"theory": 1, "observe": 0, "practice": 0, "culture": 0, "luck": 3}, "stress": 0, "money": 0, "morale": 1, "equipment": 0}},
+    },
+    "empty text": {"lines": ["嗯。"], "event": {"kind": "passive", "title": "空", "text": "   ", "effects": {}}},
+    "event not dict": {"lines": ["嗯。"], "event": "下雨了"},
+    "effects not dict": {"lines": ["嗯。"], "event": {"kind": "passive", "title": "停电", "text": "活动室停电一晚。", "effects": [1, 2]}},
+}
+
+
+def legacy_normalize_ai_reaction(data):
+    # The hand-rolled normalizers the schema-driven validator replaced.
+    lines = data.get("lines") or []
+    lines = [legacy_clean_ai_line(line) for line in lines]
+    lines = [line for line in lines if line]
+    if not lines:
+        lines = ["AI 把吐槽写成教案了，已被当场塞回粉笔盒。"]
+    event = legacy_normalize_ai_event(data.get("event"))
+    return {"lines": lines[:2] or ["AI 没有给出有效反应。"], "event": event}
+
+
+def legacy_clean_ai_line(line):
+    text = str(line).strip()
+    if not text:
+        return ""
+    if any(token in text for token in main.GUIDANCE_TOKENS):
+        return ""
+    return text[:60]
+
+
+def legacy_normalize_ai_event(event):
+    if not isinstance(event, dict):
+        return None
+    title = str(event.get("title") or "突发事件").strip()[:18]
+    text = str(event.get("text") or "").strip()[:90]
+    if not text:
+        return None
+    kind = str(event.get("kind") or event.get("type") or "").strip().lower()
+    if kind not in {"passive", "optional"}:
+        kind = "passive" if event.get("passive") is True else "optional"
+    target = event.get("target")
+    target = str(target).strip()[:16] if target else None
+    effects = event.get("effects") if isinstance(event.get("effects"), dict) else {}
+    if kind == "optional" and legacy_looks_like_passive_event(title, text):
+        kind = "passive"
+    effects = legacy_repair_event_effects(kind, effects)
+    return {
+        "kind": kind,
+        "target": target,
+        "title": title or "突发事件",
+        "text": text,
+        "effects": effects,
+    }
+
+
+def legacy_looks_like_passive_event(title, text):
+    combined = f"{title}{text}"
+    return any(word in combined for word in main.PASSIVE_EVENT_WORDS)
+
+
+def legacy_repair_event_effects(kind, effects):
+    fixed = dict(effects) if isinstance(effects, dict) else {}
+    attrs = fixed.get("attrs") if isinstance(fixed.get("attrs"), dict) else {}
+    fixed["attrs"] = {
+        "theory": main.safe_number(attrs.get("theory")),
+        "observe": main.safe_number(attrs.get("observe")),
+        "practice": main.safe_number(attrs.get("practice")),
+        "culture": main.safe_number(attrs.get("culture")),
+    }
+    fixed["stress"] = main.safe_number(fixed.get("stress"))
+    fixed["money"] = main.safe_number(fixed.get("money"))
+    fixed["morale"] = main.safe_number(fixed.get("morale"))
+    fixed["equipment"] = main.safe_number(fixed.get("equipment"))
+
+    if kind == "optional" and not legacy_has_effect_benefit(fixed):
+        fixed["attrs"]["culture"] = max(fixed["attrs"]["culture"], 1)
+        fixed["stress"] = max(fixed["stress"], 1)
+    if kind == "passive":
+        if not legacy_has_effect_benefit(fixed):
+            fixed["attrs"]["culture"] = max(fixed["attrs"]["culture"], 1)
+        if not legacy_has_effect_penalty(fixed):
+            fixed["stress"] = max(fixed["stress"], 1)
+    return fixed
+
+
+def legacy_has_effect_benefit(effects):
+    attrs = effects.get("attrs") if isinstance(effects, dict) and isinstance(effects.get("attrs"), dict) else {}
+    return (
+        sum(max(0, main.safe_number(value)) for value in attrs.values()) > 0
+        or main.safe_number(effects.get("money")) > 0
+        or main.safe_number(effects.get("morale")) > 0
+        or main.safe_number(effects.get("equipment")) > 0
+        or main.safe_number(effects.get("stress")) < 0
+    )
+
+
+def legacy_has_effect_penalty(effects):
+    attrs = effects.get("attrs") if isinstance(effects, dict) and isinstance(effects.get("attrs"), dict) else {}
+    return (
+        sum(min(0, main.safe_number(value)) for value in attrs.values()) < 0
+        or main.safe_number(effects.get("money")) < 0
+        or main.safe_number(effects.get("morale")) < 0
+        or main.safe_number(effects.get("equipment")) < 0
+        or main.safe_number(effects.get("stress")) > 0
+    )
+
+
+def legacy_comparable(result):
+    event = result.get("event")
+    if event:
+        event["effects"] = {key: event["effects"][key] for key in EFFECT_KEYS}
+    return result
+
+
+def intentional_difference(data):
+    lines = data.get("lines")
+    if lines and not isinstance(lines, list):
+        return "lines not a list"
+    if isinstance(lines, list) and any(not isinstance(line, (str, int, float)) or not line for line in lines):
+        return "non-string line"
+    if any(isinstance(value, float) and not math.isfinite(value) for value in walk_numbers(data.get("event"))):
+        return "non-finite number"
+    if any(isinstance(value, str) and not math.isfinite(main.safe_number(value) if value.strip() else 0) for value in walk_numbers(data.get("event"))):
+        return "non-finite number"
+    return None
+
+
+def walk_numbers(event):
+    effects = event.get("effects") if isinstance(event, dict) else None
+    if not isinstance(effects, dict):
+        return []
+    values = [effects.get(key) for key in EFFECT_KEYS[1:]]
+    attrs = effects.get("attrs")
+    if isinstance(attrs, dict):
+        values.extend(attrs.values())
+    return values
+
+
+def mutate(rng):
+    data = copy.deepcopy(REPLY)
+    event = data["event"]
+    effects = event["effects"]
+    for _ in range(rng.randint(1, 4)):
+        choice = rng.randrange(16)
+        if choice == 0:
+            data.pop(rng.choice(["lines", "event"]), None)
+        elif choice == 1 and isinstance(event, dict):
+            event.pop(rng.choice(["kind", "title", "text", "target", "effects"]), None)
+        elif choice == 2:
+            key = rng.choice(EFFECT_KEYS[1:])
+            effects[key] = rng.choice([str(effects.get(key, 0)), "", None, " 3 ", "abc", True, -rng.randint(1, 300)])
+        elif choice == 3 and isinstance(effects.get("attrs"), dict):
+            key = rng.choice(ATTR_KEYS)
+            effects["attrs"][key] = rng.choice(["2", -1, 0, None, "x", 1.25, "inf", float("nan")])
+        elif choice == 4 and isinstance(event, dict):
+            event["kind"] = rng.choice(["PASSIVE", " Optional ", "weird", "", None, 3])
+        elif choice == 5 and isinstance(event, dict):
+            event["type"] = rng.choice(["passive", "optional", "Passive"])
+            event.pop("kind", None) if rng.random() < 0.7 else None
+        elif choice == 6 and isinstance(event, dict):
+            event["text"] = rng.choice(["学生不小心摔坏了目镜。", "资料被雨淋湿了。", "  ", "望远镜" * 40])
+        elif choice == 7 and isinstance(data.get("lines"), list):
+            data["lines"].append(rng.choice(["建议多观测。", "你需要休息。", "夜" * 80, "  ", "普通的一句话。"]))
+        elif choice == 8 and isinstance(data.get("lines"), list):
+            data["lines"].insert(0, rng.choice([None, 0, {"a": 1}, ["x"], 12, 3.5]))
+        elif choice == 9:
+            data["lines"] = rng.choice(["单独一句话", [], None, {"a": "b"}])
+        elif choice == 10 and isinstance(event, dict):
+            event["title"] = rng.choice(["", None, "一" * 30, 42, " 标题 "])
+        elif choice == 11 and isinstance(event, dict):
+            event["target"] = rng.choice(["", None, "林", "名字特别特别特别特别特别特别长的同学", 7, "  "])
+        elif choice == 12 and isinstance(event, dict):
+            event["extra"] = 1
+            effects[rng.choice(["luck", "fame"])] = 2
+        elif choice == 13:
+            data["event"] = rng.choice([None, "text", 5, []])
+            event = data["event"]
+        elif choice == 14 and isinstance(event, dict):
+            event["effects"] = rng.choice([{}, [], None, {"attrs": [1]}, {"stress": 0}])
+            effects = event["effects"] if isinstance(event["effects"], dict) else {}
+        elif choice == 15 and isinstance(event, dict):
+            event["passive"] = rng.choice([True, False, "true"])
+    return data
+
+
+def compare(data):
+    # Returns None on agreement, the skip reason for intentional changes, or
+    # a diff description.
+    reason = intentional_difference(data)
+    expected = legacy_comparable(legacy_normalize_ai_reaction(copy.deepcopy(data)))
+    actual = main.normalize_ai_reaction(copy.deepcopy(data))
+    if expected == actual:
+        return None
+    if reason:
+        return reason
+    return f"legacy {json.dumps(expected, ensure_ascii=False)}\n  schema {json.dumps(actual, ensure_ascii=False)}"
+
+
+def run_cases():
+    failures = 0
+    for name, data in CASES.items():
+        outcome = compare(data)
+        if outcome and "\n" in outcome:
+            print(f"MISMATCH {name}: {outcome}")
+            failures += 1
+    print(f"cases: {len(CASES)} checked, {failures} mismatches")
+    return failures
+
+
+def run_fuzz(count, seed):
+    rng = random.Random(seed)
+    failures = 0
+    skipped = {}
+    for _ in range(count):
+        data = mutate(rng)
+        try:
+            outcome = compare(data)
+        except Exception as exc:  # the validator must never raise
+            print(f"RAISED {type(exc).__name__}: {exc!r} on {json.dumps(data, ensure_ascii=False)[:160]}")
+            failures += 1
+            continue
+        if outcome is None:
+            continue
+        if "\n" in outcome:
+            print(f"MISMATCH on {json.dumps(data, ensure_ascii=False, default=str)[:200]}\n  {outcome}")
+            failures += 1
+        else:
+            skipped[outcome] = skipped.get(outcome, 0) + 1
+    notes = ", ".join(f"{reason} {total}" for reason, total in sorted(skipped.items())) or "none"
+    print(f"fuzz: {count} cases, {failures} mismatches, intentional differences: {notes}")
+    return failures
+
+
+def time_round(normalize, corpus, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for data in corpus:
+            normalize(data)
+    return (time.perf_counter() - started) / (rounds * len(corpus))
+
+
+def run_timing(replies, seed):
+    # Rounds alternate between the two implementations and the best round of
+    # each is kept, which keeps a noisy machine from favouring either side.
+    rng = random.Random(seed)
+    mutated = list(CASES.values()) + [mutate(rng) for _ in range(200)]
+    corpora = {
+        "valid reply": [REPLY],
+        "mutated replies": [data for data in mutated if not intentional_difference(data)],
+    }
+    for label, corpus in corpora.items():
+        rounds = max(1, replies // len(corpus))
+        legacy = schema = float("inf")
+        for _ in range(7):
+            legacy = min(legacy, time_round(legacy_normalize_ai_reaction, corpus, rounds))
+            schema = min(schema, time_round(main.REACTION_VALIDATOR.validate, corpus, rounds))
+        print(f"timing {label}: legacy {legacy * 1e6:.1f} us, schema {schema * 1e6:.1f} us ({legacy / schema:.2f}x)")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--fuzz", type=int, default=3000, help="number of random mutations")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--replies", type=int, default=5000, help="replies normalized per timing round")
+    args = parser.parse_args()
+    failures = run_cases()
+    failures += run_fuzz(args.fuzz, args.seed)
+    run_timing(args.replies, args.seed)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,174 @@
+"""Fuzz and benchmark corpus for ``decode_json_object``.
+
+Runs the bounded scanner in ``main.py`` against a set of pathological model
+outputs and random mutations of valid replies, checks it never raises, finds
+the reply whenever it is intact in the text, and compares its speed with the
+previous retry-from-every-brace implementation::
+
+    python bench/json_extract.py --fuzz 3000
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402
+
+
+REPLY = {
+    "lines": ["这周的训练计划像星图一样漂亮，也一样看不懂。", "经费在燃烧，比流星雨还壮观。"],
+    "event": {
+        "kind": "optional",
+        "title": "天文馆夜场",
+        "text": "天文馆开放夜场，可以带队去蹭讲解 {不是 JSON}。",
+        "target": "",
+        "effects": {"attrs": {"theory": 0, "observe": 1, "practice": 0, "culture": 1.5}, "stress": 2, "money": -180, "morale": 3, "equipment": 0},
+    },
+}
+REPLY_TEXT = json.dumps(REPLY, ensure_ascii=False)
+PROSE = "好的，我来分析一下当前局势，注意 “引号” 和 {花括号} 以及 \"转义\"。"
+
+
+def legacy_decode_json_object(raw):
+    # The implementation the scanner replaced, kept here for comparison.
+    decoder = json.JSONDecoder()
+    for candidate in [raw, main.strip_code_fence(raw)]:
+        candidate = candidate.strip()
+        if not candidate:
+            continue
+        try:
+            data = json.loads(candidate)
+            if isinstance(data, dict):
+                return data
+        except json.JSONDecodeError:
+            pass
+    start = raw.find("{")
+    while start >= 0:
+        try:
+            data, _ = decoder.raw_decode(raw[start:])
+            if isinstance(data, dict):
+                return data
+        except json.JSONDecodeError:
+            pass
+        start = raw.find("{", start + 1)
+    return None
+
+
+def pathological_corpus():
+    # (name, text, whether the full reply is intact in the text)
+    return [
+        ("plain", REPLY_TEXT, True),
+        ("fenced", f"```json\n{REPLY_TEXT}\n```", True),
+        ("prose-around", f"{PROSE}\n{REPLY_TEXT}\n以上。", True),
+        ("decoy-first", f'示例：{{"a": 1}}。真正结果：{REPLY_TEXT}', True),
+        ("stray-open-brace", f"先写一个 {{ 然后忘了关。{REPLY_TEXT}", True),
+        ("stray-quote", f'他说"你好 {REPLY_TEXT}', True),
+        ("many-open-braces", "{" * 20000 + REPLY_TEXT, True),
+        ("many-braces-no-json", "{ " * 30000, False),
+        ("truncated-long", REPLY_TEXT[:-3] + "，" * 20000, False),
+        ("truncated-repeated", (REPLY_TEXT[:-5] + "\n") * 200, False),
+        ("deep-nesting", '{"a":' * 3000 + "1" + "}" * 3000, False),
+        ("huge-string", '{"lines": ["' + "很长的吐槽" * 8000 + '"], "event": null}', True),
+        ("prose-then-reply-x50", (PROSE * 50) + REPLY_TEXT, True),
+        ("escaped-braces-in-string", json.dumps({"lines": ["\\{ \\} \" {{ }}"], "event": None}, ensure_ascii=False), True),
+        ("two-replies", REPLY_TEXT + "\n" + REPLY_TEXT, True),
+        ("empty", "", False),
+        ("html", "<!doctype html><html><body>{ error }</body></html>", False),
+    ]
+
+
+REPLY_LAYOUTS = [
+    REPLY_TEXT,
+    json.dumps(REPLY, ensure_ascii=False, separators=(",", ":")),
+    json.dumps(REPLY, ensure_ascii=False, indent=2),
+    json.dumps(REPLY, indent=1),
+]
+
+
+def mutate(rng):
+    reply = rng.choice(REPLY_LAYOUTS)
+    text = reply
+    intact = True
+    for _ in range(rng.randint(1, 4)):
+        choice = rng.random()
+        if choice < 0.25:
+            text = rng.choice([PROSE, "{", "}", '"', "```json\n", "\\", " { ", "】"]) * rng.randint(1, 50) + text
+        elif choice < 0.45:
+            text = text + rng.choice([PROSE, "}", "{", '"', "\n```", "]"]) * rng.randint(1, 50)
+        elif choice < 0.65:
+            position = rng.randrange(len(text))
+            text = text[:position] + rng.choice(["{", "}", '"', "\\", ",", ":"]) + text[position:]
+            intact = False
+        elif choice < 0.85:
+            text = text[: rng.randrange(1, len(text))] if len(text) > 1 else text
+            intact = False
+        else:
+            text = rng.choice(["```json\n", "结果：", "\n\n"]) + text
+    return text, intact and reply in text
+
+
+def timed(function, text, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = function(text)
+    return result, (time.perf_counter() - started) / repeat
+
+
+def run_corpus(repeat, legacy_limit):
+    print(f"{'case':<26} {'chars':>7} {'scanner ms':>11} {'legacy ms':>10}  result")
+    failures = 0
+    for name, text, intact in pathological_corpus():
+        result, seconds = timed(main.decode_json_object, text, repeat)
+        legacy = "-"
+        if len(text) <= legacy_limit:
+            try:
+                _, legacy_seconds = timed(legacy_decode_json_object, text, 1)
+                legacy = f"{legacy_seconds * 1000:.2f}"
+            except RecursionError:
+                legacy = "raised"
+        found = isinstance(result, dict) and "lines" in result
+        ok = found or not intact
+        failures += not ok
+        print(f"{name:<26} {len(text):>7} {seconds * 1000:>11.3f} {legacy:>10}  {'found' if found else 'none'}{'' if ok else '  MISSED'}")
+    return failures
+
+
+def run_fuzz(count, seed):
+    rng = random.Random(seed)
+    failures = 0
+    slowest = 0.0
+    for _ in range(count):
+        text, intact = mutate(rng)
+        try:
+            result, seconds = timed(main.decode_json_object, text, 1)
+        except Exception as exc:  # the extractor must never raise
+            print(f"RAISED {type(exc).__name__}: {exc!r} on {text[:80]!r}")
+            failures += 1
+            continue
+        slowest = max(slowest, seconds)
+        if intact and not (isinstance(result, dict) and result.get("lines") == REPLY["lines"]):
+            print(f"MISSED intact reply in {text[:120]!r}")
+            failures += 1
+    print(f"fuzz: {count} cases, {failures} failures, slowest {slowest * 1000:.2f} ms")
+    return failures
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--fuzz", type=int, default=2000, help="number of random mutations")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--repeat", type=int, default=20, help="timing repetitions per corpus case")
+    parser.add_argument("--legacy-limit", type=int, default=70000, help="skip the legacy decoder above this many chars")
+    args = parser.parse_args()
+    failures = run_corpus(args.repeat, args.legacy_limit)
+    failures += run_fuzz(args.fuzz, args.seed)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main_cli()
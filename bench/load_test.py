@@ -0,0 +1,371 @@
+"""End-to-end load generator for the Astro Chaos server.
+
+Drives ``/api/react``, ``/api/models`` and the static files at a fixed
+concurrency, then reports throughput and p50/p95/p99 latency per endpoint.
+With ``--spawn`` it starts the mock gateway and ``main.py`` itself::
+
+    python bench/load_test.py --spawn --duration 20 --concurrency 16 --save bench/baseline.json
+    python bench/load_test.py --spawn --server-args "--engine asyncio" --compare bench/baseline.json
+"""
+
+import argparse
+import http.client
+import itertools
+import json
+import math
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlsplit
+
+
+ROOT = Path(__file__).resolve().parent.parent
+STATIC_PATHS = ["/", "/app.js", "/gameEngine.js", "/gameData.js", "/styles.css"]
+DEFAULT_MIX = "react=6,models=1,static=3"
+REGRESSION_TOLERANCE = 0.15
+# Latency changes smaller than this are scheduler noise, not regressions.
+REGRESSION_FLOOR_MS = 2.0
+
+
+def sample_state(index, unique):
+    # Shaped like serializeForAi() output; ``unique`` varies it per request so
+    # the server's reaction cache cannot answer.
+    week = index if unique else 0
+    students = [
+        {
+            "name": name,
+            "stress": 30 + (week + offset * 7) % 50,
+            "honors": ["市队"] if offset % 2 else [],
+            "traits": traits,
+            "attrs": {"理论": 40 + offset, "观测": 35 + offset, "实测": 38, "常识": 42},
+        }
+        for offset, (name, traits) in enumerate(
+            [
+                ("张子涵", ["理论奇才"]),
+                ("王思源", ["欧皇", "玻璃心"]),
+                ("李嘉琪", ["数据大师"]),
+                ("赵浩然", ["阴天教徒"]),
+                ("陈语晨", ["科普达人", "嗜睡体质"]),
+                ("杨雨泽", ["散光"]),
+            ]
+        )
+    ]
+    return {
+        "date": f"第 1 年 {8 + week % 5} 月 第 {1 + week % 4} 周",
+        "money": 1800 + week * 13,
+        "equipment": 58,
+        "morale": 45 + week % 20,
+        "weather": "晴朗",
+        "nextContest": "市级预赛（7 周后）",
+        "activeCount": 6,
+        "quitCount": 0,
+        "avgStress": 38,
+        "avgAttrs": {"理论": 42, "观测": 37, "实测": 38, "常识": 42},
+        "recentLogs": ["活动: 模拟笔试：理论 +4.6 / 常识 +1.6，压力 +8。", "天气: 第 1 年 8 月 第 2 周，天气 晴朗。"],
+        "students": students,
+    }
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+        self.statuses = {}
+        self.bytes = 0
+
+    def record(self, kind, seconds, status, size, ok):
+        with self._lock:
+            self.samples.setdefault(kind, []).append(seconds)
+            bucket = self.statuses.setdefault(kind, {})
+            bucket[str(status)] = bucket.get(str(status), 0) + 1
+            if not ok:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+            self.bytes += size
+
+
+class LoadClient:
+    # One persistent connection per worker thread, reopened after errors or
+    # when the server closes it.
+    def __init__(self, target, args, counter):
+        parts = urlsplit(target)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.args = args
+        self.counter = counter
+        self.connection = None
+
+    def request(self, method, path, body=None, headers=None):
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.args.timeout)
+            try:
+                self.connection.request(method, path, body=body, headers=headers or {})
+                response = self.connection.getresponse()
+                data = response.read()
+                if response.will_close:
+                    self.close()
+                return response.status, data
+            except (ConnectionError, http.client.RemoteDisconnected, http.client.CannotSendRequest):
+                self.close()
+                if attempt:
+                    raise
+        raise RuntimeError("unreachable")
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def react(self):
+        index = next(self.counter)
+        payload = {
+            "trigger": "玩家刚执行了“模拟笔试”，游戏已经进入新一周。",
+            "state": sample_state(index, random.random() >= self.args.cache_ratio),
+            "config": self.args.config,
+        }
+        return self.post("/api/react", payload)
+
+    def models(self):
+        return self.post("/api/models", {"config": self.args.config})
+
+    def static(self):
+        status, data = self.request("GET", random.choice(STATIC_PATHS), headers={"Accept-Encoding": "gzip"})
+        return status, len(data), status == 200
+
+    def post(self, path, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        status, data = self.request("POST", path, body, {"Content-Type": "application/json"})
+        ok = status == 200
+        if ok:
+            try:
+                ok = "error" not in json.loads(data)
+            except ValueError:
+                ok = False
+        return status, len(data), ok
+
+
+def run_load(args):
+    mix = parse_mix(args.mix)
+    kinds = [kind for kind, weight in mix for _ in range(weight)]
+    recorder = Recorder()
+    counter = itertools.count()
+    deadline = time.monotonic() + args.duration
+    issued = itertools.count()
+
+    def worker():
+        client = LoadClient(args.target, args, counter)
+        while time.monotonic() < deadline:
+            if args.requests and next(issued) >= args.requests:
+                break
+            kind = random.choice(kinds)
+            started = time.perf_counter()
+            try:
+                status, size, ok = getattr(client, kind)()
+            except (OSError, http.client.HTTPException):
+                status, size, ok = "connection-error", 0, False
+                client.close()
+            recorder.record(kind, time.perf_counter() - started, status, size, ok)
+        client.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(recorder, time.perf_counter() - started, args)
+
+
+def parse_mix(spec):
+    mix = []
+    for item in spec.split(","):
+        kind, _, weight = item.partition("=")
+        if kind not in {"react", "models", "static"}:
+            raise SystemExit(f"unknown request kind in --mix: {kind}")
+        mix.append((kind, int(weight or 1)))
+    return mix
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def latency_summary(values, elapsed):
+    values = sorted(values)
+    millis = lambda value: None if value is None else round(value * 1000, 2)
+    return {
+        "requests": len(values),
+        "throughput": round(len(values) / elapsed, 2) if elapsed else 0,
+        "p50Ms": millis(percentile(values, 0.50)),
+        "p95Ms": millis(percentile(values, 0.95)),
+        "p99Ms": millis(percentile(values, 0.99)),
+        "maxMs": millis(values[-1] if values else None),
+    }
+
+
+def summarize(recorder, elapsed, args):
+    endpoints = {}
+    for kind, values in sorted(recorder.samples.items()):
+        endpoints[kind] = {
+            **latency_summary(values, elapsed),
+            "errors": recorder.errors.get(kind, 0),
+            "status": recorder.statuses.get(kind, {}),
+        }
+    everything = [value for values in recorder.samples.values() for value in values]
+    return {
+        "createdAt": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": {
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "mix": args.mix,
+            "cacheRatio": args.cache_ratio,
+            "serverArgs": args.server_args,
+            "gatewayArgs": args.gateway_args,
+        },
+        "elapsedSeconds": round(elapsed, 3),
+        "bytesReceived": recorder.bytes,
+        "overall": {**latency_summary(everything, elapsed), "errors": sum(recorder.errors.values())},
+        "endpoints": endpoints,
+    }
+
+
+def compare(baseline, report, tolerance):
+    regressions = []
+    for kind, current in [("overall", report["overall"]), *report["endpoints"].items()]:
+        previous = baseline["overall"] if kind == "overall" else baseline.get("endpoints", {}).get(kind)
+        if not previous:
+            continue
+        for field in ("p50Ms", "p95Ms", "p99Ms"):
+            before, after = previous.get(field), current.get(field)
+            if before and after and after > before * (1 + tolerance) and after - before > REGRESSION_FLOOR_MS:
+                regressions.append(f"{kind} {field}: {before} -> {after} ms")
+        before, after = previous.get("throughput"), current.get("throughput")
+        if before and after is not None and after < before * (1 - tolerance):
+            regressions.append(f"{kind} throughput: {before} -> {after} req/s")
+    return regressions
+
+
+def print_report(report):
+    print(f"{'endpoint':<10} {'reqs':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for kind, stats in [*report["endpoints"].items(), ("overall", report["overall"])]:
+        print(
+            f"{kind:<10} {stats['requests']:>7} {stats['throughput']:>8} {fmt(stats['p50Ms']):>9} "
+            f"{fmt(stats['p95Ms']):>9} {fmt(stats['p99Ms']):>9} {stats['errors']:>7}"
+        )
+
+
+def fmt(value):
+    return "-" if value is None else f"{value:.1f}"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"{process.args[1]} exited with code {process.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise SystemExit(f"port {port} did not open within {timeout}s")
+
+
+def spawn(args):
+    gateway_port, server_port = free_port(), free_port()
+    quiet = {"stdout": subprocess.DEVNULL, "stderr": subprocess.DEVNULL}
+    gateway = subprocess.Popen(
+        [sys.executable, str(ROOT / "bench" / "mock_gateway.py"), "--port", str(gateway_port), *shlex.split(args.gateway_args)],
+        **quiet,
+    )
+    # A spawned server starts with a cold format-capability cache and leaves
+    # the developer's cache file alone.
+    server = subprocess.Popen(
+        [sys.executable, str(ROOT / "main.py"), "--port", str(server_port), *shlex.split(args.server_args)],
+        cwd=ROOT,
+        env={**os.environ, "ASTRO_CHAOS_CAPABILITY_FILE": ""},
+        **quiet,
+    )
+    processes = [gateway, server]
+    try:
+        wait_for_port(gateway_port, gateway)
+        wait_for_port(server_port, server)
+    except BaseException:
+        stop(processes)
+        raise
+    args.target = f"http://127.0.0.1:{server_port}"
+    args.config["baseUrl"] = f"http://127.0.0.1:{gateway_port}/v1"
+    return processes
+
+
+def stop(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the Astro Chaos server against a (mock) upstream.")
+    parser.add_argument("--target", default="http://127.0.0.1:8765", help="Astro Chaos server to drive")
+    parser.add_argument("--gateway", default="http://127.0.0.1:9100/v1", help="upstream base URL put in the request config")
+    parser.add_argument("--spawn", action="store_true", help="start the mock gateway and main.py on free ports")
+    parser.add_argument("--server-args", default="", help="extra main.py arguments when spawning")
+    parser.add_argument("--gateway-args", default="", help="extra mock_gateway.py arguments when spawning")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=15, help="seconds to run")
+    parser.add_argument("--requests", type=int, default=0, help="stop after this many requests (0 = duration only)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weighted request kinds, e.g. react=6,models=1,static=3")
+    parser.add_argument("--cache-ratio", type=float, default=0.0, help="share of /api/react requests that repeat a cached state")
+    parser.add_argument("--wire-api", choices=("responses", "chat"), default="responses")
+    parser.add_argument("--model", default="mock-mini")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--save", help="write the report as a JSON baseline")
+    parser.add_argument("--compare", help="compare against a saved baseline and exit 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE, help="allowed relative slowdown")
+    args = parser.parse_args(argv)
+    args.config = {"token": "mock-token", "baseUrl": args.gateway, "model": args.model, "wireApi": args.wire_api}
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    processes = spawn(args) if args.spawn else []
+    try:
+        report = run_load(args)
+    finally:
+        stop(processes)
+    print_report(report)
+    if args.save:
+        Path(args.save).write_text(json.dumps(report, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+        print(f"Saved baseline to {args.save}")
+    if args.compare:
+        regressions = compare(json.loads(Path(args.compare).read_text(encoding="utf-8")), report, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions beyond tolerance.")
+
+
+if __name__ == "__main__":
+    main()
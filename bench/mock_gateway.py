@@ -0,0 +1,326 @@
+"""Stand-in OpenAI-compatible API for measuring the proxy without a real key.
+
+Serves ``/v1/responses``, ``/v1/chat/completions`` (both with optional SSE
+streaming) and ``/v1/models``. Latency, error and 429 injection, structured
+output rejection and malformed/fenced replies are all configurable::
+
+    python bench/mock_gateway.py --port 9100 --latency lognormal:350,0.4 \\
+        --rate-limit 0.02 --reject json_schema --fenced 0.1
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+CANNED_LINES = [
+    "这周的训练计划写得像星图，看着很美，其实谁也没看懂。",
+    "社员的压力条比赤经坐标涨得还快。",
+    "望远镜表示它也需要一个整周休整。",
+    "经费在燃烧，比流星雨还壮观。",
+    "理论分涨了一点，但常识依旧停留在“月亮会发光”。",
+]
+CANNED_EVENTS = [
+    {
+        "kind": "optional",
+        "title": "天文馆夜场",
+        "text": "天文馆开放夜场，可以带队去蹭讲解。",
+        "target": "",
+        "effects": {"money": -180, "stress": 2, "morale": 3, "equipment": 0, "attrs": {"culture": 1.5}},
+    },
+    {
+        "kind": "passive",
+        "title": "赤道仪故障",
+        "text": "赤道仪又坏了，大家一边修一边学会了极轴校准。",
+        "target": "",
+        "effects": {"money": 0, "stress": 3, "morale": 0, "equipment": -4, "attrs": {"practice": 1}},
+    },
+]
+
+
+class LatencyModel:
+    # fixed:MS | uniform:LOW,HIGH | lognormal:MEDIAN,SIGMA | exp:MEAN
+    def __init__(self, spec, rng):
+        kind, _, args = spec.partition(":")
+        self.kind = kind
+        self.args = [float(value) for value in args.split(",") if value] if args else [0.0]
+        self.rng = rng
+        if kind not in {"fixed", "uniform", "lognormal", "exp"}:
+            raise ValueError(f"unknown latency distribution {spec}")
+
+    def sample(self):
+        if self.kind == "fixed":
+            millis = self.args[0]
+        elif self.kind == "uniform":
+            millis = self.rng.uniform(self.args[0], self.args[1])
+        elif self.kind == "lognormal":
+            median, sigma = self.args[0], self.args[1] if len(self.args) > 1 else 0.5
+            millis = median * self.rng.lognormvariate(0, sigma)
+        else:
+            millis = self.rng.expovariate(1 / self.args[0]) if self.args[0] else 0
+        return max(0.0, millis) / 1000
+
+
+class GatewayState:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.latency = LatencyModel(args.latency, self.rng)
+        self.rejected_formats = set(args.reject)
+        self._lock = threading.Lock()
+        self.counters = {"requests": 0, "streams": 0, "status": {}, "outputs": {}, "peakInflight": 0}
+        self.inflight = 0
+
+    def enter(self):
+        with self._lock:
+            limit = self.args.concurrency_limit
+            if limit and self.inflight >= limit:
+                return False
+            self.inflight += 1
+            self.counters["peakInflight"] = max(self.counters["peakInflight"], self.inflight)
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.inflight -= 1
+
+    def chance(self, probability):
+        with self._lock:
+            return self.rng.random() < probability
+
+    def pick(self, items):
+        with self._lock:
+            return self.rng.choice(items)
+
+    def count(self, group, key):
+        with self._lock:
+            bucket = self.counters[group]
+            bucket[str(key)] = bucket.get(str(key), 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps(self.counters))
+
+
+class MockGatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "AstroChaosMock/1.0"
+    disable_nagle_algorithm = True
+    state = None
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if path == "/_stats":
+            return self._write_json(HTTPStatus.OK, self.state.snapshot())
+        if path.endswith("/models"):
+            time.sleep(self.state.latency.sample() / 4)
+            models = [{"id": model, "object": "model", "owned_by": "mock"} for model in self.state.args.models]
+            return self._write_json(HTTPStatus.OK, {"object": "list", "data": models})
+        self._write_json(HTTPStatus.NOT_FOUND, {"error": {"message": "Unknown endpoint"}})
+
+    def do_POST(self):
+        path = self.path.split("?", 1)[0].rstrip("/")
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return self._write_json(HTTPStatus.BAD_REQUEST, {"error": {"message": "invalid JSON body"}})
+        with self.state._lock:
+            self.state.counters["requests"] += 1
+
+        if path.endswith("/responses"):
+            wire_api = "responses"
+        elif path.endswith("/chat/completions"):
+            wire_api = "chat"
+        else:
+            return self._write_json(HTTPStatus.NOT_FOUND, {"error": {"message": "Unknown endpoint"}})
+
+        args = self.state.args
+        if not self.state.enter():
+            return self._write_json(
+                HTTPStatus.TOO_MANY_REQUESTS,
+                {"error": {"message": "Too many concurrent requests", "type": "rate_limit_error"}},
+                {"Retry-After": str(args.retry_after)},
+            )
+        try:
+            self._respond(path, payload, wire_api)
+        finally:
+            self.state.leave()
+
+    def _respond(self, path, payload, wire_api):
+        time.sleep(self.state.latency.sample())
+        args = self.state.args
+        if self.state.chance(args.rate_limit):
+            return self._write_json(
+                HTTPStatus.TOO_MANY_REQUESTS,
+                {"error": {"message": "Rate limit reached for requests", "type": "rate_limit_error"}},
+                {"Retry-After": str(args.retry_after)},
+            )
+        if self.state.chance(args.error_rate):
+            return self._write_json(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": {"message": "The server had an error"}})
+
+        response_format = requested_format(payload, wire_api)
+        if response_format in self.state.rejected_formats:
+            field = "text.format" if wire_api == "responses" else "response_format"
+            return self._write_json(
+                HTTPStatus.BAD_REQUEST,
+                {"error": {"message": f"Unsupported parameter: {field} type '{response_format}' is not supported with this model."}},
+            )
+
+        text = self.reaction_text(payload, wire_api)
+        usage = mock_usage(payload, text)
+        if payload.get("stream"):
+            with self.state._lock:
+                self.state.counters["streams"] += 1
+            return self._write_stream(text, wire_api, usage)
+        if wire_api == "responses":
+            body = {
+                "id": "resp_mock",
+                "object": "response",
+                "output": [{"type": "message", "role": "assistant", "content": [{"type": "output_text", "text": text}]}],
+                "usage": usage,
+            }
+        else:
+            body = {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": {
+                    "prompt_tokens": usage["input_tokens"],
+                    "completion_tokens": usage["output_tokens"],
+                    "prompt_tokens_details": {"cached_tokens": usage["input_tokens_details"]["cached_tokens"]},
+                },
+            }
+        self._write_json(HTTPStatus.OK, body)
+
+    def reaction_text(self, payload, wire_api):
+        messages = payload.get("input") if wire_api == "responses" else payload.get("messages")
+        try:
+            prompt = json.loads((messages or [{}])[-1].get("content") or "{}")
+        except (AttributeError, ValueError):
+            prompt = {}
+        if isinstance(prompt, dict) and isinstance(prompt.get("triggers"), list):
+            reply = {"reactions": [self.reaction() for _ in prompt["triggers"]]}
+        else:
+            reply = self.reaction()
+        text = json.dumps(reply, ensure_ascii=False)
+
+        args = self.state.args
+        if self.state.chance(args.malformed):
+            self.state.count("outputs", "malformed")
+            return text[: max(1, len(text) * 2 // 3)]
+        if self.state.chance(args.fenced):
+            self.state.count("outputs", "fenced")
+            return f"好的，以下是结果：\n```json\n{text}\n```"
+        self.state.count("outputs", "json")
+        return text
+
+    def reaction(self):
+        lines = [self.state.pick(CANNED_LINES) for _ in range(2)]
+        event = self.state.pick(CANNED_EVENTS) if self.state.chance(self.state.args.event_rate) else None
+        return {"lines": lines, "event": event}
+
+    def _write_stream(self, text, wire_api, usage):
+        self.send_response(HTTPStatus.OK)
+        self.state.count("status", HTTPStatus.OK.value)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        size = max(1, self.state.args.chunk_chars)
+        for start in range(0, len(text), size):
+            delta = text[start:start + size]
+            if wire_api == "responses":
+                chunk = {"type": "response.output_text.delta", "delta": delta}
+            else:
+                chunk = {"choices": [{"index": 0, "delta": {"content": delta}}]}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(self.state.args.chunk_ms / 1000)
+        if wire_api == "responses":
+            final = {"type": "response.completed", "response": {"usage": usage}}
+        else:
+            final = {"choices": [], "usage": {"prompt_tokens": usage["input_tokens"], "completion_tokens": usage["output_tokens"]}}
+        self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def _write_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.state.count("status", status.value)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.state.args.verbose:
+            super().log_message(format, *args)
+
+
+def requested_format(payload, wire_api):
+    if wire_api == "responses":
+        return ((payload.get("text") or {}).get("format") or {}).get("type") or "plain"
+    return (payload.get("response_format") or {}).get("type") or "plain"
+
+
+def mock_usage(payload, text):
+    prompt_chars = len(json.dumps(payload.get("input") or payload.get("messages") or [], ensure_ascii=False))
+    input_tokens = prompt_chars // 2
+    return {
+        "input_tokens": input_tokens,
+        "output_tokens": len(text) // 2,
+        "input_tokens_details": {"cached_tokens": input_tokens // 2},
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible gateway for Astro Chaos benchmarks.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", default="lognormal:300,0.35", help="fixed:MS | uniform:LOW,HIGH | lognormal:MEDIAN,SIGMA | exp:MEAN")
+    parser.add_argument("--chunk-ms", type=float, default=15, help="delay between streamed chunks")
+    parser.add_argument("--chunk-chars", type=int, default=12, help="characters per streamed chunk")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of a 500 response")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="probability of a 429 response")
+    parser.add_argument("--retry-after", type=float, default=1, help="Retry-After seconds sent with 429")
+    parser.add_argument("--concurrency-limit", type=int, default=0, help="answer 429 while this many requests are in flight")
+    parser.add_argument(
+        "--reject",
+        action="append",
+        default=[],
+        choices=["json_schema", "json_object"],
+        help="reject this structured-output format with a 400 (repeatable)",
+    )
+    parser.add_argument("--malformed", type=float, default=0.0, help="probability of truncated JSON output")
+    parser.add_argument("--fenced", type=float, default=0.0, help="probability of prose plus a ```json fence")
+    parser.add_argument("--event-rate", type=float, default=0.35, help="probability that a reaction carries an event")
+    parser.add_argument("--models", type=lambda value: value.split(","), default=["mock-mini", "mock-large"])
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    MockGatewayHandler.state = GatewayState(args)
+    server = ThreadingHTTPServer((args.host, args.port), MockGatewayHandler)
+    server.daemon_threads = True
+    print(f"Mock gateway: http://{args.host}:{server.server_port}/v1", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopped.")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
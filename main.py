@@ -1,22 +1,167 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import asyncio
+import contextvars
+import copy
+import gzip
+import hashlib
+import heapq
+import http.client
+import io
 import json
+import math
+import mimetypes
 import os
+import random
+import re
+import select
+import signal
+import socket
+import ssl
+import struct
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from email.utils import formatdate, parsedate_to_datetime
 from http import HTTPStatus
 from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 from urllib.error import HTTPError, URLError
-from urllib.request import Request, urlopen
+from urllib.parse import parse_qs, unquote, urlsplit
+from urllib.request import Request, getproxies, proxy_bypass, urlopen
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
+
+PROCESS_STARTED = time.monotonic()
 ROOT = Path(__file__).resolve().parent
 WEB_ROOT = ROOT / "web"
 DEFAULT_BASE_URL = os.environ.get("ASTRO_CHAOS_OPENAI_BASE_URL", "")
 DEFAULT_MODEL = os.environ.get("ASTRO_CHAOS_OPENAI_MODEL", "gpt-5.4")
 DEFAULT_WIRE_API = os.environ.get("ASTRO_CHAOS_OPENAI_WIRE_API", "responses")
+UPSTREAM_TIMEOUT = 45
+STALE_CONNECTION_ERRORS = (http.client.BadStatusLine, ConnectionResetError, ConnectionAbortedError, BrokenPipeError)
+POOL_MAX_IDLE = int(os.environ.get("ASTRO_CHAOS_POOL_MAX_IDLE", "8"))
+POOL_IDLE_SECONDS = float(os.environ.get("ASTRO_CHAOS_POOL_IDLE_SECONDS", "30"))
+CAPABILITY_FILE = os.environ.get("ASTRO_CHAOS_CAPABILITY_FILE", str(ROOT / ".astro_chaos_capabilities.json"))
+CAPABILITY_TTL_SECONDS = float(os.environ.get("ASTRO_CHAOS_CAPABILITY_TTL", "86400"))
+CAPABILITY_REPROBE_SECONDS = float(os.environ.get("ASTRO_CHAOS_CAPABILITY_REPROBE", "1800"))
+RESPONSE_FORMAT_VARIANTS = ("json_schema", "json_object", "plain")
+EXTRA_PROVIDERS = os.environ.get("ASTRO_CHAOS_PROVIDERS", "")
+HEDGE_PERCENTILE = float(os.environ.get("ASTRO_CHAOS_HEDGE_PERCENTILE", "90"))
+HEDGE_INITIAL_DELAY = float(os.environ.get("ASTRO_CHAOS_HEDGE_DELAY_MS", "3000")) / 1000
+HEDGE_MIN_DELAY = 0.2
+HEDGE_WORKERS = 32
+PROVIDER_EWMA_ALPHA = 0.2
+PROVIDER_LATENCY_WINDOW = 64
+PROVIDER_MIN_SAMPLES = 5
+PROVIDER_UNHEALTHY_ERROR_RATE = 0.5
+PROVIDER_COOLDOWN_SECONDS = 30
+PROVIDER_LIMIT = 64
+UPSTREAM_RPS = float(os.environ.get("ASTRO_CHAOS_UPSTREAM_RPS", "0"))
+UPSTREAM_BURST = float(os.environ.get("ASTRO_CHAOS_UPSTREAM_BURST", "4"))
+UPSTREAM_CONCURRENCY = int(os.environ.get("ASTRO_CHAOS_UPSTREAM_CONCURRENCY", "8"))
+UPSTREAM_MAX_CONCURRENCY = int(os.environ.get("ASTRO_CHAOS_UPSTREAM_MAX_CONCURRENCY", "32"))
+UPSTREAM_QUEUE_LIMIT = int(os.environ.get("ASTRO_CHAOS_UPSTREAM_QUEUE", "64"))
+UPSTREAM_QUEUE_TIMEOUT = float(os.environ.get("ASTRO_CHAOS_UPSTREAM_QUEUE_TIMEOUT", "20"))
+UPSTREAM_RETRIES = int(os.environ.get("ASTRO_CHAOS_UPSTREAM_RETRIES", "2"))
+UPSTREAM_BACKOFF_BASE = 0.5
+UPSTREAM_BACKOFF_CAP = 8
+UPSTREAM_RETRY_AFTER_MAX = 60
+UPSTREAM_RETRY_STATUSES = {429, 500, 502, 503, 504}
+AIMD_DECREASE = 0.7
+STREAM_LINES_KEY = re.compile(r'"lines"\s*:\s*\[')
+STREAM_EVENT_KEY = re.compile(r'"event"\s*:\s*')
+STREAM_LIST_GAP = re.compile(r"[\s,]*")
+JSON_SCAN_MAX_CHARS = int(os.environ.get("ASTRO_CHAOS_JSON_SCAN_MAX_CHARS", "65536"))
+JSON_SCAN_WORK_FACTOR = 4
+JSON_STRUCTURE = re.compile(r'[{}"]')
+JSON_STRING_END = re.compile(r'["\\]')
+JSON_OBJECT_START = re.compile(r'\{\s*["}]')
+JSON_DECODE_ERRORS = (ValueError, RecursionError)
+SSE_DONE = object()
+MODELS_CACHE_TTL = float(os.environ.get("ASTRO_CHAOS_MODELS_TTL", "300"))
+MODELS_CACHE_STALE_SECONDS = float(os.environ.get("ASTRO_CHAOS_MODELS_STALE", "3600"))
+REACTION_CACHE_BYTES = int(os.environ.get("ASTRO_CHAOS_REACTION_CACHE_BYTES", str(2 * 1024 * 1024)))
+REACTION_CACHE_TTL = float(os.environ.get("ASTRO_CHAOS_REACTION_CACHE_TTL", "900"))
+REACTION_QUANTUM = int(os.environ.get("ASTRO_CHAOS_REACTION_QUANTUM", "5"))
+# Headcounts in serializeForAi; one student quitting changes the situation.
+REACTION_EXACT_FIELDS = frozenset({"activeCount", "quitCount"})
+PREFETCH_WORKERS = int(os.environ.get("ASTRO_CHAOS_PREFETCH_WORKERS", "4"))
+PREFETCH_PER_SESSION = int(os.environ.get("ASTRO_CHAOS_PREFETCH_PER_SESSION", "2"))
+PREFETCH_TTL = float(os.environ.get("ASTRO_CHAOS_PREFETCH_TTL", "180"))
+JOB_WORKERS = int(os.environ.get("ASTRO_CHAOS_JOB_WORKERS", "8"))
+JOB_QUEUE_LIMIT = int(os.environ.get("ASTRO_CHAOS_JOB_QUEUE", "64"))
+JOB_DEADLINE = float(os.environ.get("ASTRO_CHAOS_JOB_DEADLINE", "30"))
+JOB_RESULT_TTL = 120
+JOB_POLL_SECONDS = 20
+JOB_POLL_MAX = 30
+JOB_PATH = "/api/react/jobs"
+JOB_FINAL_STATES = {"done", "failed", "cancelled", "superseded", "expired"}
+LATENCY_BUDGET_MS = float(os.environ.get("ASTRO_CHAOS_LATENCY_BUDGET_MS", "0"))
+BUDGET_WORKERS = 16
+CORPUS_SEED_FILE = ROOT / "reaction_corpus.json"
+CORPUS_FILE = os.environ.get("ASTRO_CHAOS_CORPUS_FILE", str(ROOT / ".astro_chaos_corpus.jsonl"))
+CORPUS_SIZE = int(os.environ.get("ASTRO_CHAOS_CORPUS_SIZE", "2000"))
+CORPUS_PER_KEY = 6
+CORPUS_MEMO_LIMIT = 4096
+CORPUS_FEATURES = ("phase", "contest", "contestSoon", "weather", "money", "stress", "quits", "honor")
+CORPUS_ORDINAL_FEATURES = {"money", "stress", "quits", "honor"}
+CORPUS_WEIGHTS = {"phase": 8, "contest": 3, "contestSoon": 2, "weather": 1, "money": 2, "stress": 2, "quits": 2, "honor": 1.5}
+CORPUS_HONORS = ("市队", "省队", "国初", "国集", "IOAA")
+NOVELTY_THRESHOLD = float(os.environ.get("ASTRO_CHAOS_NOVELTY_THRESHOLD", "0.5"))
+NOVELTY_EVENTS = 64
+NOVELTY_HINTS = 6
+NOVELTY_BANDS = 16
+NOVELTY_ROWS = 2
+NOVELTY_HASH = struct.Struct(f"<{NOVELTY_BANDS * NOVELTY_ROWS}I")
+NOVELTY_MEMO_LIMIT = 1024
+UPSTREAM_TAPE_FILE = "upstream.jsonl"
+WORKER_BACKLOG = 128
+WORKER_DRAIN_SECONDS = float(os.environ.get("ASTRO_CHAOS_WORKER_DRAIN", "20"))
+WORKER_RESTART_BACKOFF = 1.0
+CONTEST_WEEKS = re.compile(r"(\d+) 周后")
+ASYNC_MAX_CONCURRENCY = int(os.environ.get("ASTRO_CHAOS_ASYNC_MAX_CONCURRENCY", "64"))
+ASYNC_PER_CLIENT = int(os.environ.get("ASTRO_CHAOS_ASYNC_PER_CLIENT", "8"))
+MAX_REQUEST_BODY = 4 * 1024 * 1024
+STATIC_MAX_AGE = int(os.environ.get("ASTRO_CHAOS_STATIC_MAX_AGE", "0"))
+SESSION_LIMIT = int(os.environ.get("ASTRO_CHAOS_SESSION_LIMIT", "500"))
+SESSION_DIR = os.environ.get("ASTRO_CHAOS_SESSION_DIR", "")
+SESSION_LOG_MAX_BYTES = 8 * 1024 * 1024
+STATE_TOKEN_BUDGET = int(os.environ.get("ASTRO_CHAOS_STATE_TOKEN_BUDGET", "1500"))
+SLOW_REQUEST_MS = float(os.environ.get("ASTRO_CHAOS_SLOW_REQUEST_MS", "0"))
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# --warmup-probe: the smallest structured-output call that still shows which
+# response format the gateway accepts. 16 is the lowest output limit some
+# Responses gateways allow.
+WARMUP_PROBE_TOKENS = 16
+WARMUP_PROBE_MESSAGES = [{"role": "user", "content": 'Reply with {"ok":true}.'}]
+WARMUP_PROBE_SCHEMA = {
+    "type": "object",
+    "additionalProperties": False,
+    "required": ["ok"],
+    "properties": {"ok": {"type": "boolean"}},
+}
+FIRST_REACTION_ENDPOINTS = {"/api/react", "/api/react/stream", "/api/react/batch"}
+METRIC_ENDPOINTS = {"/api/react", "/api/react/stream", "/api/react/batch", "/api/react/prefetch", "/api/react/jobs", "/api/models"}
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
 GUIDANCE_TOKENS = ("建议", "应该", "可以考虑", "下一步", "你可以", "你需要")
+AI_LINE_MAX_CHARS = 60
+AI_LINE_FALLBACK = "AI 把吐槽写成教案了，已被当场塞回粉笔盒。"
+AI_EVENT_DEFAULT_TITLE = "突发事件"
+AI_EVENT_KINDS = ("passive", "optional")
+AI_FIELD_LIMITS = {"event.title": 18, "event.text": 90, "event.target": 16}
 PASSIVE_EVENT_WORDS = ("坏", "损坏", "故障", "断电", "丢失", "生病", "受伤", "争执", "事故", "翻出", "捡到")
+GUIDANCE_PATTERN = re.compile("|".join(map(re.escape, GUIDANCE_TOKENS)))
+PASSIVE_EVENT_PATTERN = re.compile("|".join(map(re.escape, PASSIVE_EVENT_WORDS)))
 AI_TASK_PROMPT = (
     "你为网页游戏《天文闹赛》生成简短锐评和偶发事件。只返回一个 JSON 对象，"
     "第一字符必须是 {，最后字符必须是 }，不要 Markdown，不要代码块，不要解释。"
@@ -86,20 +231,120 @@ AI_RESPONSE_SCHEMA = {
     },
     "required": ["lines", "event"],
 }
+AI_BATCH_RESPONSE_SCHEMA = {
+    "type": "object",
+    "additionalProperties": False,
+    "properties": {"reactions": {"type": "array", "items": AI_RESPONSE_SCHEMA}},
+    "required": ["reactions"],
+}
+RESPONSE_SHAPE_KEYS = frozenset(AI_RESPONSE_SCHEMA["required"]) | frozenset(AI_BATCH_RESPONSE_SCHEMA["required"])
+AI_SCHEMA_EXAMPLE = {
+    "lines": ["锐评", "吐槽"],
+    "event": {
+        "kind": "passive 或 optional",
+        "target": "学生姓名或 null",
+        "title": "不超过 10 个汉字",
+        "text": "不超过 45 个汉字",
+        "effects": {
+            "attrs": {"theory": 0, "observe": 0, "practice": 0, "culture": 0},
+            "stress": 0,
+            "money": 0,
+            "morale": 0,
+            "equipment": 0,
+        },
+    },
+}
+# Everything that does not depend on the game lives in one byte-stable system
+# message so upstream prompt-prefix caching can reuse it across requests.
+AI_SYSTEM_PROMPT = "\n".join(
+    [
+        "你写简洁、有现场感、俏皮恶搞的中文游戏锐评；不写建议、攻略或行动指导。允许生成克制的天文社事件。必须只输出合法 JSON 对象，不能输出 Markdown 或自然语言前后缀。",
+        AI_TASK_PROMPT,
+        "用户消息是 JSON：trigger 为触发原因，mode 为 AI 模式，game_state 为当前局势（omittedStudents 表示为节省篇幅省略的在社学生人数）。",
+        "若有 seen_events，它列出本局已经出现过的事件标题，不要再生成相同或相似的事件。",
+        f"输出格式：{json.dumps(AI_SCHEMA_EXAMPLE, ensure_ascii=False)}",
+    ]
+)
+AI_BATCH_PROMPT = (
+    "本次用户消息给出的是 triggers 数组而不是单个 trigger，它们按时间顺序发生在同一局势下。"
+    "返回 {\"reactions\": [...]}，reactions 与 triggers 一一对应、顺序相同，每一项都是上面格式的对象；"
+    "event 最多只在其中一项里出现，其余为 null。"
+)
+MAX_BATCH_TRIGGERS = 6
 
 
 class AstroChaosHandler(SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out as separate writes; with Nagle on, keep-alive
+    # clients wait out a delayed ACK (~40 ms) before the body arrives.
+    disable_nagle_algorithm = True
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, directory=str(WEB_ROOT), **kwargs)
 
     def do_GET(self):
+        if self.path == "/api/stats":
+            self._write_json(collect_server_stats())
+            return
+        job = parse_job_target(self.path)
+        if job is not None:
+            body = REACTION_JOBS.poll(*job)
+            self._write_json(body or job_missing_body(), status=HTTPStatus.OK if body else HTTPStatus.NOT_FOUND)
+            return
+        if urlsplit(self.path).path == "/api/metrics":
+            body, content_type = metrics_response(self.path, self.headers.get("Accept"))
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path == "/":
+            self.path = "/index.html"
+        if not self._write_static_asset():
+            return super().do_GET()
+
+    def do_HEAD(self):
         if self.path == "/":
             self.path = "/index.html"
-        return super().do_GET()
+        if not self._write_static_asset(head=True):
+            return super().do_HEAD()
+
+    def _write_static_asset(self, head=False):
+        response = static_asset_response(self.path, self.headers)
+        if response is None:
+            return False
+        status, headers, body = response
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if body and not head:
+            self.wfile.write(body)
+        return True
+
+    def do_DELETE(self):
+        job = parse_job_target(self.path)
+        body = REACTION_JOBS.cancel(job[0]) if job is not None else None
+        self._write_json(body or job_missing_body(), status=HTTPStatus.OK if body else HTTPStatus.NOT_FOUND)
 
     def do_POST(self):
+        trace = METRICS.begin(self.path, int(self.headers.get("Content-Length") or 0))
+        try:
+            self._handle_post()
+        finally:
+            METRICS.finish(*trace)
+
+    def _handle_post(self):
+        if self.path == "/api/react/stream":
+            self._stream_reaction()
+            return
+
         handlers = {
             "/api/react": build_ai_reaction,
+            "/api/react/batch": build_ai_reaction_batch,
+            "/api/react/prefetch": prefetch_ai_reactions,
+            "/api/react/jobs": REACTION_JOBS.submit,
             "/api/models": fetch_models,
         }
         handler = handlers.get(self.path)
@@ -108,16 +353,64 @@ class AstroChaosHandler(SimpleHTTPRequestHandler):
             return
 
         try:
-            payload = self._read_json()
+            with METRICS.stage("read_json"):
+                payload = self._read_json()
+            if self.path in SESSION_STATE_ENDPOINTS:
+                with METRICS.stage("session"):
+                    payload = resolve_session_state(payload)
             result = handler(payload)
+        except StaleSessionError as exc:
+            self._write_json({"error": str(exc), "resync": True}, status=HTTPStatus.CONFLICT)
+            return
         except RuntimeError as exc:
-            self._write_json({"error": str(exc)}, status=HTTPStatus.SERVICE_UNAVAILABLE)
+            self._write_json(api_error_body(exc), status=api_error_status(exc))
+            return
+        except Exception as exc:
+            self._write_json({"error": f"请求处理失败: {exc}"}, status=HTTPStatus.BAD_REQUEST)
+            return
+
+        with METRICS.stage("write"):
+            self._write_json(result, status=HTTPStatus.ACCEPTED if self.path == JOB_PATH else HTTPStatus.OK)
+
+    def _stream_reaction(self):
+        try:
+            with METRICS.stage("read_json"):
+                payload = self._read_json()
+            with METRICS.stage("session"):
+                payload = resolve_session_state(payload)
+        except StaleSessionError as exc:
+            self._write_json({"error": str(exc), "resync": True}, status=HTTPStatus.CONFLICT)
             return
         except Exception as exc:
             self._write_json({"error": f"请求处理失败: {exc}"}, status=HTTPStatus.BAD_REQUEST)
             return
+        self._write_event_stream(stream_ai_reaction(payload))
+
+    def _write_event_stream(self, events):
+        self.close_connection = True
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.send_header("X-Accel-Buffering", "no")
+        self.end_headers()
+        try:
+            for name, data in events:
+                self._write_sse(name, data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except RuntimeError as exc:
+            self._write_sse("error", api_error_body(exc))
+        except Exception as exc:
+            self._write_sse("error", {"error": f"请求处理失败: {exc}"})
+        finally:
+            events.close()
 
-        self._write_json(result)
+    def _write_sse(self, name, data):
+        chunk = format_sse(name, data)
+        METRICS.note_response(HTTPStatus.OK, len(chunk))
+        self.wfile.write(chunk)
+        self.wfile.flush()
 
     def _read_json(self):
         length = int(self.headers.get("Content-Length", "0"))
@@ -128,6 +421,7 @@ class AstroChaosHandler(SimpleHTTPRequestHandler):
 
     def _write_json(self, payload, status=HTTPStatus.OK):
         data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        METRICS.note_response(status, len(data))
         self.send_response(status)
         self.send_header("Content-Type", "application/json; charset=utf-8")
         self.send_header("Content-Length", str(len(data)))
@@ -138,346 +432,3611 @@ class AstroChaosHandler(SimpleHTTPRequestHandler):
         print(f"[server] {self.address_string()} - {format % args}")
 
 
-def build_ai_reaction(payload):
-    config = payload.get("config") or {}
-    api_key = config.get("token") or os.environ.get("OPENAI_API_KEY")
-    base_url = normalize_base_url(config.get("baseUrl") or os.environ.get("OPENAI_BASE_URL") or DEFAULT_BASE_URL)
-    model = config.get("model") or DEFAULT_MODEL
-    mode = config.get("mode") or "events"
-    wire_api = config.get("wireApi") or DEFAULT_WIRE_API
-    if not api_key:
-        raise RuntimeError("请在网页设置里填写 API Token。")
+class StaticAssetCache:
+    # Files under web/ held in memory with precomputed gzip/brotli variants and
+    # strong per-variant ETags, so static requests never touch the disk.
+    def __init__(self, root):
+        self.root = Path(root)
+        self._assets = None
+        self._lock = threading.Lock()
+        # Counters have their own lock so requests never wait behind a reload.
+        self._counter_lock = threading.Lock()
+        self._counters = {"hits": 0, "notModified": 0, "reloads": 0}
 
-    state = payload.get("state", {})
-    trigger = payload.get("trigger", "玩家推进了一周。")
-    prompt = {
-        "trigger": trigger,
-        "game_state": state,
-        "mode": mode,
-        "task": AI_TASK_PROMPT,
-        "schema": {
-            "lines": ["锐评", "吐槽"],
-            "event": {
-                "kind": "passive 或 optional",
-                "target": "学生姓名或 null",
-                "title": "不超过 10 个汉字",
-                "text": "不超过 45 个汉字",
-                "effects": {
-                    "attrs": {"theory": 0, "observe": 0, "practice": 0, "culture": 0},
-                    "stress": 0,
-                    "money": 0,
-                    "morale": 0,
-                    "equipment": 0,
-                },
-            },
-        },
-    }
+    def get(self, path):
+        if self._assets is None:
+            self.load()
+        asset = self._assets.get(path)
+        if asset is not None:
+            self._count("hits")
+        return asset
 
-    if not base_url:
-        base_url = "https://api.openai.com/v1"
-    messages = [
-        {
-            "role": "system",
-            "content": "你写简洁、有现场感、俏皮恶搞的中文游戏锐评；不写建议、攻略或行动指导。允许生成克制的天文社事件。必须只输出合法 JSON 对象，不能输出 Markdown 或自然语言前后缀。",
-        },
-        {"role": "user", "content": json.dumps(prompt, ensure_ascii=False)},
-    ]
+    def load(self):
+        with self._lock:
+            previous = self._assets or {}
+            assets = {}
+            for file_path in sorted(self.root.rglob("*")):
+                if not file_path.is_file():
+                    continue
+                url_path = "/" + file_path.relative_to(self.root).as_posix()
+                mtime = file_path.stat().st_mtime
+                cached = previous.get(url_path)
+                if cached is not None and cached["mtime"] == mtime:
+                    assets[url_path] = cached
+                else:
+                    assets[url_path] = build_static_asset(file_path, mtime)
+            changed = assets.keys() != previous.keys() or any(assets[key] is not previous.get(key) for key in assets)
+            self._assets = assets
+            if changed and previous:
+                self._count("reloads")
+        return changed
 
-    if wire_api == "responses":
-        data = post_with_fallbacks(
-            f"{base_url}/responses",
-            api_key,
-            [
-                {
-                    "model": model,
-                    "input": messages,
-                    "max_output_tokens": 520,
-                    "text": {
-                        "format": {
-                            "type": "json_schema",
-                            "name": "astro_chaos_reaction",
-                            "schema": AI_RESPONSE_SCHEMA,
-                            "strict": True,
-                        },
-                    },
-                },
-                {
-                    "model": model,
-                    "input": messages,
-                    "max_output_tokens": 520,
-                    "text": {"format": {"type": "json_object"}},
-                },
-                {"model": model, "input": messages, "max_output_tokens": 520},
-            ],
+    def watch(self, interval=1.0):
+        def poll():
+            while True:
+                time.sleep(interval)
+                try:
+                    if self.load():
+                        print("[server] 静态资源已重新加载。")
+                except OSError as exc:
+                    print(f"[server] 静态资源重新加载失败: {exc}")
+
+        threading.Thread(target=poll, name="static-watch", daemon=True).start()
+
+    def count_not_modified(self):
+        self._count("notModified")
+
+    def stats(self):
+        assets = self._assets or {}
+        with self._counter_lock:
+            counters = dict(self._counters)
+        return dict(
+            counters,
+            files=len(assets),
+            bytes=sum(len(variant["body"]) for asset in assets.values() for variant in asset["variants"].values()),
         )
-        text = extract_responses_text(data)
+
+    def _count(self, name):
+        with self._counter_lock:
+            self._counters[name] += 1
+
+
+def build_static_asset(file_path, mtime):
+    body = file_path.read_bytes()
+    content_type = mimetypes.guess_type(file_path.name)[0] or "application/octet-stream"
+    if file_path.suffix in {".js", ".mjs"}:
+        content_type = "application/javascript"
+    compressible = content_type.startswith(COMPRESSIBLE_TYPES)
+    if content_type.startswith("text/") or content_type == "application/javascript":
+        content_type = f"{content_type}; charset=utf-8"
+    digest = hashlib.sha256(body).hexdigest()[:20]
+    variants = {"identity": {"body": body, "etag": f'"{digest}"'}}
+    if compressible:
+        compressed = gzip.compress(body, 9, mtime=0)
+        if len(compressed) < len(body):
+            variants["gzip"] = {"body": compressed, "etag": f'"{digest}-gz"'}
+        if brotli is not None:
+            compressed = brotli.compress(body)
+            if len(compressed) < len(body):
+                variants["br"] = {"body": compressed, "etag": f'"{digest}-br"'}
+    if file_path.suffix == ".html" or STATIC_MAX_AGE <= 0:
+        cache_control = "no-cache"
     else:
-        data = post_with_fallbacks(
-            f"{base_url}/chat/completions",
-            api_key,
-            [
-                {
-                    "model": model,
-                    "messages": messages,
-                    "max_tokens": 520,
-                    "response_format": {
-                        "type": "json_schema",
-                        "json_schema": {
-                            "name": "astro_chaos_reaction",
-                            "schema": AI_RESPONSE_SCHEMA,
-                            "strict": True,
-                        },
-                    },
-                },
-                {
-                    "model": model,
-                    "messages": messages,
-                    "max_tokens": 520,
-                    "response_format": {"type": "json_object"},
-                },
-                {"model": model, "messages": messages, "max_tokens": 520},
-            ],
-        )
-        text = extract_chat_text(data)
-    return parse_ai_response(text)
+        cache_control = f"public, max-age={STATIC_MAX_AGE}"
+    return {
+        "mtime": mtime,
+        "content_type": content_type,
+        "cache_control": cache_control,
+        "last_modified": formatdate(mtime, usegmt=True),
+        "variants": variants,
+    }
 
 
-def fetch_models(payload):
-    config = payload.get("config") or {}
-    api_key = config.get("token") or os.environ.get("OPENAI_API_KEY")
-    base_url = normalize_base_url(config.get("baseUrl") or os.environ.get("OPENAI_BASE_URL") or DEFAULT_BASE_URL)
-    current_model = config.get("model") or DEFAULT_MODEL
-    if not api_key:
-        raise RuntimeError("请先填写 API Token，再获取模型列表。")
-    if not base_url:
-        base_url = "https://api.openai.com/v1"
+def static_asset_response(path, request_headers):
+    asset = STATIC_ASSETS.get(unquote(urlsplit(path).path))
+    if asset is None:
+        return None
+    encoding = negotiate_content_encoding(request_headers.get("Accept-Encoding", ""), asset["variants"])
+    variant = asset["variants"][encoding]
+    headers = [
+        ("Content-Type", asset["content_type"]),
+        ("ETag", variant["etag"]),
+        ("Last-Modified", asset["last_modified"]),
+        ("Cache-Control", asset["cache_control"]),
+        ("Vary", "Accept-Encoding"),
+    ]
+    if encoding != "identity":
+        headers.append(("Content-Encoding", encoding))
+    if etag_matches(request_headers.get("If-None-Match"), variant["etag"]):
+        STATIC_ASSETS.count_not_modified()
+        return HTTPStatus.NOT_MODIFIED, headers, b""
+    headers.append(("Content-Length", str(len(variant["body"]))))
+    return HTTPStatus.OK, headers, variant["body"]
 
-    data = get_openai_compatible(f"{base_url}/models", api_key)
-    models = normalize_models_response(data)
-    if not models:
-        raise RuntimeError("模型列表为空，无法选择可用模型。")
-    selected = choose_model(models, current_model)
-    return {"models": models, "selected": selected}
 
+def negotiate_content_encoding(accept_encoding, variants):
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            quality = safe_number(params[2:])
+        if name:
+            accepted[name.strip().lower()] = quality
+    for encoding in ("br", "gzip"):
+        quality = accepted.get(encoding, accepted.get("*", 0))
+        if encoding in variants and quality > 0:
+            return encoding
+    return "identity"
 
-def post_openai_compatible(url, api_key, payload):
-    return request_openai_compatible_json(url, api_key, payload=payload, method="POST")
 
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    candidates = [item.strip() for item in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
 
-def post_with_fallbacks(url, api_key, payloads):
-    last_error = None
-    for index, payload in enumerate(payloads):
-        try:
-            return post_openai_compatible(url, api_key, payload)
-        except RuntimeError as exc:
-            last_error = exc
-            if index == len(payloads) - 1 or not looks_like_schema_rejection(str(exc)):
-                raise
-    raise last_error
 
+STATIC_ASSETS = StaticAssetCache(WEB_ROOT)
 
-def looks_like_schema_rejection(message):
-    lowered = message.lower()
-    return any(
-        token in lowered
-        for token in [
-            "json_schema",
-            "response_format",
-            "text.format",
-            "unsupported",
-            "unknown parameter",
-            "invalid parameter",
-        ]
-    )
 
+def build_ai_reaction(payload):
+    return reaction_response(*resolve_ai_reaction(payload))
 
-def get_openai_compatible(url, api_key):
-    return request_openai_compatible_json(url, api_key, method="GET")
 
+def reaction_response(request, result):
+    return with_state_version(deliver_reaction(request, result), request)
 
-def request_openai_compatible_json(url, api_key, payload=None, method="POST"):
-    data = None if payload is None else json.dumps(payload).encode("utf-8")
-    request = Request(
-        url,
-        data=data,
-        headers={
-            "Authorization": f"Bearer {api_key}",
-            "Accept": "application/json",
-            "Content-Type": "application/json",
-            "User-Agent": "Astro-Chaos/1.0",
-        },
-        method=method,
-    )
-    try:
-        with urlopen(request, timeout=45) as response:
-            raw = response.read().decode("utf-8", "replace")
-    except HTTPError as exc:
-        raw = exc.read().decode("utf-8", "replace")
-        raise RuntimeError(f"API HTTP {exc.code}: {summarize_api_error(raw)}") from exc
-    except URLError as exc:
-        raise RuntimeError(f"API 网络错误: {exc.reason}") from exc
 
-    try:
-        return json.loads(raw)
-    except json.JSONDecodeError as exc:
-        raise RuntimeError(f"API 返回非 JSON：{raw[:120]}") from exc
+def resolve_ai_reaction(payload):
+    with METRICS.stage("prepare"):
+        request = prepare_ai_request(payload)
+    with METRICS.stage("cache_lookup"):
+        result = lookup_cached_reaction(request)
+    if result is None:
+        with METRICS.stage("prefetch_claim"):
+            result = SPECULATIONS.claim(request)
+        if result is None:
+            with METRICS.stage("generate"):
+                result = generate_within_budget(request)
+        remember_reaction(request, result)
+    return request, result
 
 
-def normalize_models_response(response):
-    source = response.get("data") if isinstance(response, dict) else response
-    if not isinstance(source, list):
-        return []
+def with_state_version(result, request):
+    if request["state_version"] is None:
+        return result
+    return dict(result, stateVersion=request["state_version"])
 
-    models = []
-    seen = set()
-    for item in source:
-        if isinstance(item, str):
-            model_id = item.strip()
-            label = model_id
-        elif isinstance(item, dict):
-            model_id = str(item.get("id") or item.get("name") or "").strip()
-            label = str(item.get("display_name") or item.get("name") or model_id).strip()
-        else:
-            continue
-        if not model_id or model_id in seen:
-            continue
-        seen.add(model_id)
-        models.append({"id": model_id, "name": label or model_id})
-    return models
 
+class StaleSessionError(Exception):
+    pass
 
-def choose_model(models, current_model):
-    ids = [model["id"] for model in models]
-    if current_model in ids:
-        return current_model
-    for candidate in (DEFAULT_MODEL, "gpt-5.4", "gpt-5.4-mini", "gpt-5.2"):
-        if candidate in ids:
-            return candidate
-    text_like = [model_id for model_id in ids if "image" not in model_id.lower()]
-    return text_like[0] if text_like else ids[0]
 
+def resolve_session_state(payload):
+    # A full "state" (re)registers the session; a "delta" is applied on top of
+    # the acknowledged "baseVersion". Either way the handler sees a full state.
+    session_id = str(payload.get("sessionId") or "").strip()
+    if not session_id:
+        return payload
+    if isinstance(payload.get("state"), dict):
+        version = SESSIONS.register(session_id, payload["state"])
+        return dict(payload, stateVersion=version)
+    if "delta" in payload:
+        state, version = SESSIONS.apply(session_id, payload.get("baseVersion"), payload["delta"])
+        return dict(payload, state=state, stateVersion=version)
+    return payload
 
-def summarize_api_error(raw):
-    try:
-        data = json.loads(raw)
-    except json.JSONDecodeError:
-        return raw[:180]
-    error = data.get("error") if isinstance(data, dict) else None
-    if isinstance(error, dict):
-        message = error.get("message") or error.get("type") or error
-        return str(message)
-    return json.dumps(data, ensure_ascii=False)[:180]
 
+def apply_state_delta(state, delta):
+    if not isinstance(delta, dict):
+        raise ValueError("delta 格式无效。")
+    updated = copy.deepcopy(state)
+    if isinstance(delta.get("set"), dict):
+        updated.update(delta["set"])
 
-def extract_responses_text(response):
-    if isinstance(response, str):
-        return response
-    if not isinstance(response, dict):
-        return str(response)
-    output_text = response.get("output_text")
-    if isinstance(output_text, str):
-        return output_text
-    parts = []
-    for item in response.get("output", []) or []:
-        for content in item.get("content", []) or []:
-            if isinstance(content, dict):
-                text = content.get("text")
-                if isinstance(text, str):
-                    parts.append(text)
-    if parts:
-        return "\n".join(parts)
-    return json.dumps(response, ensure_ascii=False)
+    logs = delta.get("logs")
+    if isinstance(logs, dict):
+        keep = max(0, int(safe_number(logs.get("keep"))))
+        previous = updated.get("recentLogs") if isinstance(updated.get("recentLogs"), list) else []
+        updated["recentLogs"] = list(logs.get("add") or []) + previous[:keep]
 
+    # Students are matched by id, since generated names can repeat; older
+    # clients that send no id fall back to the name.
+    roster = delta.get("students")
+    if isinstance(roster, dict):
+        students = [item for item in updated.get("students") or [] if isinstance(item, dict)]
+        by_key = {student_key(student): student for student in students}
+        order = [student_key(student) for student in students]
+        for key in roster.get("remove") or []:
+            by_key.pop(key, None)
+        for patch in roster.get("upsert") or []:
+            if not isinstance(patch, dict) or not student_key(patch):
+                continue
+            key = student_key(patch)
+            if key not in by_key:
+                by_key[key] = {}
+                order.append(key)
+            by_key[key].update(patch)
+        if isinstance(roster.get("order"), list):
+            order = roster["order"]
+        updated["students"] = [by_key[key] for key in order if key in by_key]
+    return updated
 
-def extract_chat_text(response):
-    if isinstance(response, str):
-        return response
-    if isinstance(response, dict):
-        choices = response.get("choices") or []
-        if choices:
-            message = choices[0].get("message") or {}
-            content = message.get("content")
-            if isinstance(content, str):
-                return content
-        content = response.get("content")
-        return content if isinstance(content, str) else json.dumps(response, ensure_ascii=False)
 
-    choices = getattr(response, "choices", None)
-    if choices:
-        message = getattr(choices[0], "message", None)
-        content = getattr(message, "content", None)
-        if isinstance(content, str):
-            return content
-    content = getattr(response, "content", None)
-    return content if isinstance(content, str) else str(response)
+def student_key(student):
+    return student.get("id") or student.get("name")
 
 
-def normalize_base_url(base_url):
-    value = (base_url or "").strip().rstrip("/")
-    if not value:
-        return ""
-    if value.endswith("/v1"):
-        return value
-    return f"{value}/v1"
+def prompt_game_state(state):
+    # Student ids only serve delta sync; the model has no use for them.
+    if not isinstance(state, dict) or not isinstance(state.get("students"), list):
+        return state
+    students = [
+        {name: value for name, value in student.items() if name != "id"} if isinstance(student, dict) else student
+        for student in state["students"]
+    ]
+    return dict(state, students=students)
 
 
-def parse_ai_response(text):
-    raw = text.strip()
-    if not raw:
-        raise RuntimeError("AI 返回为空。")
-    lowered = raw[:80].lower()
-    if lowered.startswith("<!doctype") or lowered.startswith("<html"):
-        raise RuntimeError("AI 接口返回了 HTML 页面，请检查 Base URL 是否指向 OpenAI-compatible API 地址。")
-    data = decode_json_object(raw)
-    if data is None:
-        snippet = raw[:80].replace("\n", " ")
-        raise RuntimeError(f"AI 返回格式无效，未得到 JSON：{snippet}")
+class SessionStore:
+    # Last acknowledged serializeForAi state per session, LRU-bounded. With a
+    # directory configured every accepted version is appended to a JSONL log
+    # that is replayed on startup and compacted when it grows too large.
+    def __init__(self, limit=SESSION_LIMIT, directory=SESSION_DIR):
+        self.limit = max(1, limit)
+        self.log_path = Path(directory) / "sessions.jsonl" if directory else None
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"registered": 0, "deltas": 0, "stale": 0, "evicted": 0, "deltaBytes": 0, "stateBytes": 0}
+        self._load()
 
-    lines = data.get("lines") or []
-    lines = [clean_ai_line(line) for line in lines]
-    lines = [line for line in lines if line]
-    if not lines:
-        lines = ["AI 把吐槽写成教案了，已被当场塞回粉笔盒。"]
-    event = normalize_ai_event(data.get("event"))
-    return {"lines": lines[:2] or ["AI 没有给出有效反应。"], "event": event}
+    def register(self, session_id, state):
+        with self._lock:
+            previous = self._sessions.get(session_id)
+            version = previous[0] + 1 if previous else 1
+            self._store_locked(session_id, version, state)
+            self._counters["registered"] += 1
+            self._counters["stateBytes"] += len(json.dumps(state, ensure_ascii=False).encode("utf-8"))
+        return version
 
+    def apply(self, session_id, base_version, delta):
+        with self._lock:
+            current = self._sessions.get(session_id)
+            if current is None or current[0] != base_version:
+                self._counters["stale"] += 1
+                raise StaleSessionError("会话状态已过期，请重新上传完整局势。")
+            state = apply_state_delta(current[1], delta)
+            version = current[0] + 1
+            self._store_locked(session_id, version, state)
+            self._counters["deltas"] += 1
+            self._counters["deltaBytes"] += len(json.dumps(delta, ensure_ascii=False).encode("utf-8"))
+        return copy.deepcopy(state), version
 
-def clean_ai_line(line):
-    text = str(line).strip()
-    if not text:
-        return ""
-    if any(token in text for token in GUIDANCE_TOKENS):
-        return ""
-    return text[:60]
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, sessions=len(self._sessions))
 
+    def use_worker_file(self, index):
+        # Pre-forked workers each keep their own log on top of the shared one,
+        # so one worker's compaction never rewrites another's sessions.
+        if self.log_path is None:
+            return
+        with self._lock:
+            self.log_path = worker_file(self.log_path, index)
+            self._load()
 
-def decode_json_object(raw):
-    candidates = [raw, strip_code_fence(raw)]
-    decoder = json.JSONDecoder()
-    for candidate in candidates:
-        candidate = candidate.strip()
-        if not candidate:
-            continue
+    def _store_locked(self, session_id, version, state):
+        self._sessions[session_id] = (version, state)
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.limit:
+            self._sessions.popitem(last=False)
+            self._counters["evicted"] += 1
+        self._append_locked(session_id, version, state)
+
+    def _append_locked(self, session_id, version, state):
+        if self.log_path is None:
+            return
+        line = json.dumps({"sessionId": session_id, "version": version, "state": state}, ensure_ascii=False)
         try:
-            data = json.loads(candidate)
-            if isinstance(data, dict):
-                return data
-        except json.JSONDecodeError:
-            pass
+            self.log_path.parent.mkdir(parents=True, exist_ok=True)
+            with self.log_path.open("a", encoding="utf-8") as handle:
+                handle.write(line + "\n")
+            if self.log_path.stat().st_size > SESSION_LOG_MAX_BYTES:
+                self._compact_locked()
+        except OSError as exc:
+            print(f"[server] 无法写入会话快照 {self.log_path}: {exc}")
 
-    start = raw.find("{")
-    while start >= 0:
+    def _compact_locked(self):
+        temp_path = self.log_path.with_name(f"{self.log_path.name}.tmp")
+        with temp_path.open("w", encoding="utf-8") as handle:
+            for session_id, (version, state) in self._sessions.items():
+                record = {"sessionId": session_id, "version": version, "state": state}
+                handle.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(temp_path, self.log_path)
+
+    def _load(self):
+        if self.log_path is None or not self.log_path.exists():
+            return
         try:
-            data, _ = decoder.raw_decode(raw[start:])
-            if isinstance(data, dict):
-                return data
-        except json.JSONDecodeError:
-            pass
-        start = raw.find("{", start + 1)
-    return None
+            with self.log_path.open(encoding="utf-8") as handle:
+                for line in handle:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if not isinstance(record, dict) or not isinstance(record.get("state"), dict):
+                        continue
+                    self._sessions[str(record.get("sessionId"))] = (int(safe_number(record.get("version"))), record["state"])
+                    self._sessions.move_to_end(str(record.get("sessionId")))
+        except OSError as exc:
+            print(f"[server] 无法读取会话快照 {self.log_path}: {exc}")
+        while len(self._sessions) > self.limit:
+            self._sessions.popitem(last=False)
 
 
-def strip_code_fence(raw):
+SESSIONS = SessionStore()
+SESSION_STATE_ENDPOINTS = {"/api/react", "/api/react/batch", "/api/react/jobs"}
+
+
+def novelty_shingles(value, short):
+    # Character bigrams with punctuation and spacing removed, so "资料丢了！"
+    # and "资料又丢了" still overlap; short fields (titles) add single
+    # characters so one inserted word does not dominate.
+    text = "".join(char for char in str(value or "") if char.isalnum()).lower()
+    shingles = {text[index : index + 2] for index in range(len(text) - 1)}
+    if short or not shingles:
+        shingles.update(text)
+    return frozenset(shingles)
+
+
+def novelty_signature(field, value):
+    # MinHash over the shingles, one shake_128 digest per shingle supplying
+    # every permutation, cut into LSH bands tagged with the field name.
+    shingles = novelty_shingles(value, field == "title")
+    if not shingles:
+        return shingles, ()
+    rows = [NOVELTY_HASH.unpack(hashlib.shake_128(shingle.encode("utf-8")).digest(NOVELTY_HASH.size)) for shingle in shingles]
+    signature = list(map(min, zip(*rows)))
+    bands = tuple((field, band, tuple(signature[band * NOVELTY_ROWS : (band + 1) * NOVELTY_ROWS])) for band in range(NOVELTY_BANDS))
+    return shingles, bands
+
+
+class EventNoveltyIndex:
+    # Events one session has been shown, with title and text each MinHash-
+    # signed and bucketed by LSH band, so a lookup only compares against the
+    # few events sharing a band however long the game runs. Candidates are
+    # confirmed by exact Jaccard; either field matching makes a repeat.
+    def __init__(self, limit=NOVELTY_EVENTS):
+        self.limit = limit
+        self._entries = OrderedDict()
+        self._buckets = {}
+        self._next_id = 0
+
+    def match(self, fields, threshold):
+        for field, (shingles, bands) in fields.items():
+            checked = set()
+            for band in bands:
+                for entry_id in self._buckets.get(band, ()):
+                    if entry_id in checked:
+                        continue
+                    checked.add(entry_id)
+                    entry = self._entries[entry_id]
+                    seen = entry["fields"][field]
+                    if len(shingles & seen) / len(shingles | seen) >= threshold:
+                        return entry
+        return None
+
+    def add(self, hint, fields, origin):
+        entry_id = self._next_id
+        self._next_id += 1
+        bands = [band for _, field_bands in fields.values() for band in field_bands]
+        self._entries[entry_id] = {
+            "hint": hint,
+            "fields": {field: shingles for field, (shingles, _) in fields.items()},
+            "bands": bands,
+            "origin": origin,
+        }
+        for band in bands:
+            self._buckets.setdefault(band, set()).add(entry_id)
+        while len(self._entries) > self.limit:
+            old_id, old = self._entries.popitem(last=False)
+            for band in old["bands"]:
+                bucket = self._buckets[band]
+                bucket.discard(old_id)
+                if not bucket:
+                    del self._buckets[band]
+
+    def hints(self):
+        hints = []
+        for entry in reversed(self._entries.values()):
+            if entry["hint"] not in hints:
+                hints.append(entry["hint"])
+                if len(hints) == NOVELTY_HINTS:
+                    break
+        return hints
+
+
+class EventNovelty:
+    # Per-session EventNoveltyIndex, LRU-bounded like SESSIONS. Fresh events
+    # are screened before they are normalized and screened again, then
+    # recorded, when a reaction is handed to the page. Matching an event that
+    # was delivered for the very same request (a retry) is not a repeat.
+    def __init__(self, threshold=NOVELTY_THRESHOLD, limit=SESSION_LIMIT):
+        self.threshold = threshold
+        self.limit = max(1, limit)
+        self._sessions = OrderedDict()
+        self._signatures = {}
+        self._lock = threading.Lock()
+        self._counters = {"lookups": 0, "hits": 0, "dropped": 0, "indexed": 0, "hinted": 0, "evicted": 0}
+
+    def hints(self, session_id):
+        if self.threshold <= 0 or not session_id:
+            return []
+        with self._lock:
+            index = self._sessions.get(session_id)
+            hints = index.hints() if index is not None else []
+            self._counters["hinted"] += bool(hints)
+        return hints
+
+    def screen(self, session_id, event, origin, record=False):
+        # False when the event repeats one the session has already seen and
+        # should be dropped; with record=True a novel event is indexed.
+        if self.threshold <= 0 or not session_id or not isinstance(event, dict):
+            return True
+        title = str(event.get("title") or "").strip()
+        if title == AI_EVENT_DEFAULT_TITLE:
+            title = ""
+        fields = {field: self._signature(field, value) for field, value in (("title", title), ("text", event.get("text")))}
+        fields = {field: signature for field, signature in fields.items() if signature[0]}
+        if not fields:
+            return True
+        with self._lock:
+            self._counters["lookups"] += 1
+            index = self._sessions.get(session_id)
+            match = index.match(fields, self.threshold) if index is not None else None
+            if match is not None:
+                self._counters["hits"] += 1
+                if match["origin"] != origin:
+                    self._counters["dropped"] += 1
+                    return False
+                return True
+            if record:
+                if index is None:
+                    index = self._sessions[session_id] = EventNoveltyIndex()
+                    while len(self._sessions) > self.limit:
+                        self._sessions.popitem(last=False)
+                        self._counters["evicted"] += 1
+                self._sessions.move_to_end(session_id)
+                index.add(title[:18] or str(event.get("text") or "")[:18], fields, origin)
+                self._counters["indexed"] += 1
+        return True
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, sessions=len(self._sessions), threshold=self.threshold)
+
+    def _signature(self, field, value):
+        key = (field, str(value or ""))
+        with self._lock:
+            signature = self._signatures.get(key)
+        if signature is None:
+            signature = novelty_signature(field, value)
+            with self._lock:
+                if len(self._signatures) >= NOVELTY_MEMO_LIMIT:
+                    self._signatures.clear()
+                self._signatures[key] = signature
+        return signature
+
+
+EVENT_NOVELTY = EventNovelty()
+
+
+def deliver_reaction(request, result):
+    # Generated reactions are cached, prefetched and learned with their event
+    # intact, since another session may not have seen it; the per-session
+    # screen happens only here, on the way out, and records what was shown.
+    if EVENT_NOVELTY.screen(request["session_id"], result.get("event"), request["speculation_key"], record=True):
+        return result
+    return dict(result, event=None)
+
+
+def generate_within_budget(request):
+    # With a latency budget, a live generation that has not finished in time
+    # is answered from the local corpus; it keeps running, and its result is
+    # still cached and learned when it arrives.
+    if not request["latency_budget"]:
+        return generate_ai_reaction(request)
+    context = contextvars.copy_context()
+    future = BUDGET_EXECUTOR.submit(context.run, generate_ai_reaction, request)
+    wait([future], timeout=request["latency_budget"])
+    if not future.done():
+        with METRICS.stage("corpus_lookup"):
+            fallback = REACTION_CORPUS.lookup(request)
+        if fallback is not None:
+            future.add_done_callback(lambda done: finish_late_reaction(request, done))
+            return fallback
+    return future.result()
+
+
+def finish_late_reaction(request, future):
+    if future.cancelled() or future.exception() is not None:
+        return
+    remember_reaction(request, future.result())
+
+
+def generate_ai_reaction(request):
+    return hedged_call(request["providers"], lambda provider: request_ai_reaction(with_provider(request, provider)))
+
+
+def request_ai_reaction(request):
+    url, payloads = reaction_request_payloads(request)
+    data = post_with_fallbacks(url, request["api_key"], payloads, capability_key=request["capability_key"])
+    PROMPT_USAGE.record_usage(response_usage(data))
+    return parse_ai_response(extract_reaction_text(data, request["wire_api"]))
+
+
+def extract_reaction_text(data, wire_api):
+    if wire_api == "responses":
+        return extract_responses_text(data)
+    return extract_chat_text(data)
+
+
+def prefetch_ai_reactions(payload):
+    session_id = str(payload.get("sessionId") or "").strip()
+    if not session_id:
+        raise ValueError("缺少 sessionId。")
+    requests = []
+    for candidate in payload.get("candidates") or []:
+        if not isinstance(candidate, dict) or not candidate.get("trigger"):
+            continue
+        requests.append(
+            prepare_ai_request(
+                {
+                    "config": payload.get("config"),
+                    "sessionId": session_id,
+                    "trigger": candidate["trigger"],
+                    "state": candidate.get("state") or payload.get("state") or {},
+                }
+            )
+        )
+    return SPECULATIONS.prefetch(session_id, requests)
+
+
+def prepare_ai_request(payload):
+    config = payload.get("config") or {}
+    api_key = config.get("token") or os.environ.get("OPENAI_API_KEY")
+    base_url = normalize_base_url(config.get("baseUrl") or os.environ.get("OPENAI_BASE_URL") or DEFAULT_BASE_URL)
+    model = config.get("model") or DEFAULT_MODEL
+    mode = config.get("mode") or "events"
+    wire_api = config.get("wireApi") or DEFAULT_WIRE_API
+    if not api_key:
+        raise RuntimeError("请在网页设置里填写 API Token。")
+    if not base_url:
+        base_url = "https://api.openai.com/v1"
+
+    state = payload.get("state", {})
+    trigger = payload.get("trigger", "玩家推进了一周。")
+    budget_ms = payload.get("latencyBudgetMs")
+    budget_ms = LATENCY_BUDGET_MS if budget_ms is None else safe_number(budget_ms)
+    cache_key = None
+    if payload.get("cache") is not False:
+        cache_key = reaction_cache_key(trigger, mode, model, state)
+    return {
+        "session_id": str(payload.get("sessionId") or ""),
+        "state_version": payload.get("stateVersion"),
+        "speculation_key": speculation_key(trigger, mode, model, wire_api, base_url, state),
+        "api_key": api_key,
+        "base_url": base_url,
+        "model": model,
+        "mode": mode,
+        "wire_api": wire_api,
+        "state": state,
+        "trigger": trigger,
+        "cache_key": cache_key,
+        "latency_budget": max(0.0, budget_ms) / 1000,
+        "capability_key": (base_url, model, wire_api),
+        "providers": configured_providers(config, api_key, base_url, model, wire_api),
+    }
+
+
+def configured_providers(config, api_key, base_url, model, wire_api):
+    # The page's own endpoint first, then config.providers, then
+    # ASTRO_CHAOS_PROVIDERS. Extra entries inherit whatever they leave out.
+    providers = [provider_entry(base_url, model, wire_api, api_key)]
+    extra = config.get("providers") if isinstance(config.get("providers"), list) else []
+    for item in extra + ENV_PROVIDERS:
+        if not isinstance(item, dict):
+            continue
+        entry_url = normalize_base_url(str(item.get("baseUrl") or ""))
+        if not entry_url:
+            continue
+        entry = provider_entry(
+            entry_url,
+            str(item.get("model") or model),
+            str(item.get("wireApi") or wire_api),
+            str(item.get("token") or api_key),
+        )
+        if all(entry["label"] != provider["label"] for provider in providers):
+            providers.append(entry)
+    return providers
+
+
+def provider_entry(base_url, model, wire_api, api_key):
+    return {
+        "label": f"{model}@{base_url}" if wire_api == DEFAULT_WIRE_API else f"{model}@{base_url} ({wire_api})",
+        "base_url": base_url,
+        "model": model,
+        "wire_api": wire_api,
+        "api_key": api_key,
+    }
+
+
+def load_env_providers(raw):
+    if not raw.strip():
+        return []
+    try:
+        providers = json.loads(raw)
+    except ValueError:
+        print("ASTRO_CHAOS_PROVIDERS 不是合法的 JSON 数组，已忽略。")
+        return []
+    return providers if isinstance(providers, list) else []
+
+
+ENV_PROVIDERS = load_env_providers(EXTRA_PROVIDERS)
+
+
+def with_provider(request, provider):
+    if provider["label"] == request["providers"][0]["label"]:
+        return request
+    return dict(
+        request,
+        base_url=provider["base_url"],
+        model=provider["model"],
+        wire_api=provider["wire_api"],
+        api_key=provider["api_key"],
+        capability_key=(provider["base_url"], provider["model"], provider["wire_api"]),
+    )
+
+
+def lookup_cached_reaction(request):
+    if request["cache_key"] is None:
+        return None
+    return REACTION_CACHE.get(request["cache_key"])
+
+
+def remember_reaction(request, result):
+    # Corpus fallbacks are neither cached nor learned back into the corpus.
+    if result.get("source") == "corpus":
+        return
+    REACTION_CORPUS.learn(request, result)
+    if request["cache_key"] is not None:
+        REACTION_CACHE.put(request["cache_key"], result)
+
+
+def build_reaction_messages(request):
+    state, trimmed = trim_game_state(prompt_game_state(request["state"]), STATE_TOKEN_BUDGET)
+    prompt = {
+        "trigger": request["trigger"],
+        "mode": request["mode"],
+        "game_state": state,
+    }
+    seen = EVENT_NOVELTY.hints(request["session_id"])
+    if seen:
+        prompt["seen_events"] = seen
+    content = json.dumps(prompt, ensure_ascii=False, separators=(",", ":"))
+    PROMPT_USAGE.record_prompt(estimate_tokens(AI_SYSTEM_PROMPT) + estimate_tokens(content), trimmed)
+    return [
+        {"role": "system", "content": AI_SYSTEM_PROMPT},
+        {"role": "user", "content": content},
+    ]
+
+
+def estimate_tokens(text):
+    # Rough count without a tokenizer: CJK characters are about one token each,
+    # everything else about four characters per token.
+    wide, narrow = text_width(text)
+    return wide + (narrow + 3) // 4
+
+
+def text_width(text):
+    wide = sum(1 for char in text if ord(char) > 0x2E7F)
+    return wide, len(text) - wide
+
+
+def json_width(value):
+    return text_width(json.dumps(value, ensure_ascii=False, separators=(",", ":")))
+
+
+def trim_game_state(state, budget):
+    # Drops detail in a fixed order until the serialized state fits the budget:
+    # old log lines, then traits of the least notable students, then those
+    # students themselves, then the remaining logs. Every log line and student
+    # is measured once and its width subtracted when it is dropped.
+    if budget <= 0 or not isinstance(state, dict):
+        return state, False
+    base = dict(state)
+    logs = students = []
+    if isinstance(state.get("recentLogs"), list):
+        logs, base["recentLogs"] = list(state["recentLogs"]), []
+    if isinstance(state.get("students"), list):
+        students, base["students"] = list(state["students"]), []
+    log_widths = [json_width(line) for line in logs]
+    student_widths = [json_width(student) for student in students]
+    wide, narrow = json_width(base)
+    for width in log_widths + student_widths:
+        wide += width[0]
+        narrow += width[1]
+    # One comma between neighbouring items of each list.
+    narrow += max(len(logs) - 1, 0) + max(len(students) - 1, 0)
+
+    def fits():
+        return wide + (narrow + 3) // 4 <= budget
+
+    if fits():
+        return state, False
+
+    def drop_log():
+        nonlocal wide, narrow
+        logs.pop()
+        width = log_widths.pop()
+        wide -= width[0]
+        narrow -= width[1] + (1 if logs else 0)
+
+    while len(logs) > 2 and not fits():
+        drop_log()
+    order = sorted(range(len(students)), key=lambda index: student_prompt_priority(students[index]))
+    for index in order:
+        if fits():
+            break
+        student = students[index]
+        if isinstance(student, dict) and student.get("traits"):
+            students[index] = dict(student, traits=[])
+            width = json_width(students[index])
+            wide += width[0] - student_widths[index][0]
+            narrow += width[1] - student_widths[index][1]
+            student_widths[index] = width
+    omitted = 0
+    previous = json_width({"omittedStudents": state["omittedStudents"]}) if "omittedStudents" in state else None
+    dropped = set()
+    for index in order:
+        if len(students) - len(dropped) <= 1 or fits():
+            break
+        dropped.add(index)
+        wide -= student_widths[index][0]
+        narrow -= student_widths[index][1] + (1 if len(students) - len(dropped) else 0)
+        omitted += 1
+        # The counter joins the state as ,"omittedStudents":N (its braces aside).
+        width = json_width({"omittedStudents": omitted})
+        if previous is None:
+            narrow += width[1] - 1
+        else:
+            wide += width[0] - previous[0]
+            narrow += width[1] - previous[1]
+        previous = width
+    while logs and not fits():
+        drop_log()
+    trimmed = dict(state)
+    if isinstance(state.get("recentLogs"), list):
+        trimmed["recentLogs"] = logs
+    if isinstance(state.get("students"), list):
+        trimmed["students"] = [student for index, student in enumerate(students) if index not in dropped]
+    if omitted:
+        trimmed["omittedStudents"] = omitted
+    return trimmed, True
+
+
+def student_prompt_priority(student):
+    if not isinstance(student, dict):
+        return (0, 0, 0)
+    attrs = student.get("attrs") if isinstance(student.get("attrs"), dict) else {}
+    honors = student.get("honors") if isinstance(student.get("honors"), list) else []
+    return (len(honors), safe_number(student.get("stress")), sum(safe_number(value) for value in attrs.values()))
+
+
+class PromptUsageStats:
+    # Estimated prompt sizes and the token usage upstream reports back,
+    # including how much of the prompt it served from its prefix cache.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {
+            "prompts": 0,
+            "trimmedPrompts": 0,
+            "estimatedPromptTokens": 0,
+            "reportedResponses": 0,
+            "promptTokens": 0,
+            "cachedPromptTokens": 0,
+            "completionTokens": 0,
+        }
+
+    def record_prompt(self, estimated_tokens, trimmed):
+        with self._lock:
+            self._counters["prompts"] += 1
+            self._counters["trimmedPrompts"] += int(trimmed)
+            self._counters["estimatedPromptTokens"] += estimated_tokens
+
+    def record_usage(self, usage):
+        if not isinstance(usage, dict):
+            return
+        prompt_tokens = safe_number(usage.get("input_tokens", usage.get("prompt_tokens")))
+        completion_tokens = safe_number(usage.get("output_tokens", usage.get("completion_tokens")))
+        details = usage.get("input_tokens_details") or usage.get("prompt_tokens_details") or {}
+        cached_tokens = safe_number(details.get("cached_tokens")) if isinstance(details, dict) else 0
+        with self._lock:
+            self._counters["reportedResponses"] += 1
+            self._counters["promptTokens"] += int(prompt_tokens)
+            self._counters["cachedPromptTokens"] += int(cached_tokens)
+            self._counters["completionTokens"] += int(completion_tokens)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        prompt_tokens = counters["promptTokens"]
+        counters["cachedRatio"] = round(counters["cachedPromptTokens"] / prompt_tokens, 4) if prompt_tokens else 0.0
+        return counters
+
+
+def response_usage(data):
+    return data.get("usage") if isinstance(data, dict) else None
+
+
+def stream_chunk_usage(chunk, wire_api):
+    if wire_api == "responses":
+        if chunk.get("type") == "response.completed":
+            return response_usage(chunk.get("response"))
+        return None
+    return response_usage(chunk)
+
+
+PROMPT_USAGE = PromptUsageStats()
+
+
+def reaction_request_payloads(request, stream=False):
+    return structured_output_payloads(
+        request,
+        build_reaction_messages(request),
+        "astro_chaos_reaction",
+        AI_RESPONSE_SCHEMA,
+        520,
+        stream=stream,
+    )
+
+
+def structured_output_payloads(request, messages, schema_name, schema, max_tokens, stream=False):
+    model = request["model"]
+    if request["wire_api"] == "responses":
+        url = f"{request['base_url']}/responses"
+        payloads = [
+            {
+                "model": model,
+                "input": messages,
+                "max_output_tokens": max_tokens,
+                "text": {
+                    "format": {
+                        "type": "json_schema",
+                        "name": schema_name,
+                        "schema": schema,
+                        "strict": True,
+                    },
+                },
+            },
+            {
+                "model": model,
+                "input": messages,
+                "max_output_tokens": max_tokens,
+                "text": {"format": {"type": "json_object"}},
+            },
+            {"model": model, "input": messages, "max_output_tokens": max_tokens},
+        ]
+    else:
+        url = f"{request['base_url']}/chat/completions"
+        payloads = [
+            {
+                "model": model,
+                "messages": messages,
+                "max_tokens": max_tokens,
+                "response_format": {
+                    "type": "json_schema",
+                    "json_schema": {
+                        "name": schema_name,
+                        "schema": schema,
+                        "strict": True,
+                    },
+                },
+            },
+            {
+                "model": model,
+                "messages": messages,
+                "max_tokens": max_tokens,
+                "response_format": {"type": "json_object"},
+            },
+            {"model": model, "messages": messages, "max_tokens": max_tokens},
+        ]
+    if stream:
+        payloads = [dict(payload, stream=True) for payload in payloads]
+        if request["wire_api"] != "responses":
+            # Chat streams only report usage in a final chunk when asked to.
+            payloads = [dict(payload, stream_options={"include_usage": True}) for payload in payloads]
+    return url, payloads
+
+
+def build_ai_reaction_batch(payload):
+    return batch_response(*resolve_ai_reaction_batch(payload))
+
+
+def resolve_ai_reaction_batch(payload):
+    requests = prepare_batch_requests(payload)
+    results = [lookup_cached_reaction(request) for request in requests]
+    pending = [index for index, result in enumerate(results) if result is None]
+    if pending:
+        claimed = SPECULATIONS.claim_all([requests[index] for index in pending])
+        pending = claim_batch_speculations(requests, results, pending, claimed)
+    if pending:
+        try:
+            fresh = generate_ai_reaction_batch([requests[index] for index in pending])
+        except BatchReplyError:
+            # The provider refused or garbled the combined request; fall back
+            # to one ordinary reaction call per trigger, run in parallel.
+            # Timeouts and network errors are raised as they are, since
+            # repeating them once per trigger would only multiply the wait.
+            futures = [
+                BUDGET_EXECUTOR.submit(contextvars.copy_context().run, generate_reaction_or_error, requests[index])
+                for index in pending
+            ]
+            fresh = [future.result() for future in futures]
+        for index, result in zip(pending, fresh):
+            results[index] = result
+            if "error" not in result:
+                remember_reaction(requests[index], result)
+    return requests, results
+
+
+def claim_batch_speculations(requests, results, pending, claimed):
+    for index, result in zip(pending, claimed):
+        if result is not None:
+            results[index] = result
+            remember_reaction(requests[index], result)
+    return [index for index in pending if results[index] is None]
+
+
+def prepare_batch_requests(payload):
+    triggers = payload.get("triggers")
+    if not isinstance(triggers, list) or not triggers:
+        raise ValueError("triggers 必须是非空数组。")
+    if len(triggers) > MAX_BATCH_TRIGGERS:
+        raise ValueError(f"triggers 最多 {MAX_BATCH_TRIGGERS} 个。")
+    return [prepare_ai_request(dict(payload, trigger=str(trigger))) for trigger in triggers]
+
+
+def batch_response(requests, results):
+    results = [result if "error" in result else deliver_reaction(request, result) for request, result in zip(requests, results)]
+    response = {"reactions": results}
+    if requests[0]["state_version"] is not None:
+        response["stateVersion"] = requests[0]["state_version"]
+    return response
+
+
+def generate_ai_reaction_batch(requests):
+    if len(requests) == 1:
+        return [generate_ai_reaction(requests[0])]
+    return hedged_call(
+        requests[0]["providers"],
+        lambda provider: request_ai_reaction_batch([with_provider(request, provider) for request in requests]),
+    )
+
+
+def request_ai_reaction_batch(requests):
+    url, payloads = batch_request_payloads(requests)
+    try:
+        data = post_with_fallbacks(url, requests[0]["api_key"], payloads, capability_key=requests[0]["capability_key"])
+    except RuntimeError as exc:
+        raise batch_rejection(exc)
+    PROMPT_USAGE.record_usage(response_usage(data))
+    return read_batch_reply(data, requests)
+
+
+def generate_reaction_or_error(request):
+    try:
+        return generate_ai_reaction(request)
+    except RuntimeError as exc:
+        return {"error": str(exc)}
+
+
+def batch_request_payloads(requests):
+    state, trimmed = trim_game_state(prompt_game_state(requests[0]["state"]), STATE_TOKEN_BUDGET)
+    prompt = {
+        "triggers": [request["trigger"] for request in requests],
+        "mode": requests[0]["mode"],
+        "game_state": state,
+    }
+    seen = EVENT_NOVELTY.hints(requests[0]["session_id"])
+    if seen:
+        prompt["seen_events"] = seen
+    content = json.dumps(prompt, ensure_ascii=False, separators=(",", ":"))
+    messages = [
+        {"role": "system", "content": AI_SYSTEM_PROMPT},
+        {"role": "system", "content": AI_BATCH_PROMPT},
+        {"role": "user", "content": content},
+    ]
+    PROMPT_USAGE.record_prompt(estimate_tokens(AI_SYSTEM_PROMPT + AI_BATCH_PROMPT) + estimate_tokens(content), trimmed)
+    return structured_output_payloads(
+        requests[0],
+        messages,
+        "astro_chaos_reaction_batch",
+        AI_BATCH_RESPONSE_SCHEMA,
+        min(520 * len(requests), 2400),
+    )
+
+
+class BatchReplyError(RuntimeError):
+    # The provider rejected the batch schema or sent a combined reply that
+    # cannot be read; asking for each trigger separately may still work.
+    pass
+
+
+def batch_rejection(exc):
+    if isinstance(exc, UpstreamBusyError) or not looks_like_schema_rejection(str(exc)):
+        return exc
+    rejection = BatchReplyError(str(exc))
+    rejection.__cause__ = exc
+    return rejection
+
+
+def read_batch_reply(data, requests):
+    try:
+        return parse_ai_batch_response(extract_reaction_text(data, requests[0]["wire_api"]), requests)
+    except RuntimeError as exc:
+        raise BatchReplyError(str(exc)) from exc
+
+
+def parse_ai_batch_response(text, requests):
+    data = decode_ai_json(text)
+    reactions = data.get("reactions")
+    if not isinstance(reactions, list) or not reactions:
+        raise RuntimeError("AI 批量返回缺少 reactions 数组。")
+    results = []
+    for index, request in enumerate(requests):
+        entry = reactions[index] if index < len(reactions) else None
+        if not isinstance(entry, dict):
+            results.append({"error": "AI 没有给出这一条反应。"})
+            continue
+        results.append(normalize_ai_reaction(entry))
+    return results
+
+
+def stream_ai_reaction(payload):
+    request = prepare_ai_request(payload)
+    ready = lookup_cached_reaction(request)
+    if ready is None:
+        ready = SPECULATIONS.claim(request)
+        if ready is not None:
+            remember_reaction(request, ready)
+    if ready is not None:
+        yield from ready_reaction_events(request, ready)
+        return
+
+    request, response = open_reaction_stream(request)
+    parser = ReactionStreamParser(request)
+    try:
+        content_type = response.headers.get("Content-Type", "")
+        if "text/event-stream" in content_type:
+            for chunk in iter_sse_data(response):
+                PROMPT_USAGE.record_usage(stream_chunk_usage(chunk, request["wire_api"]))
+                delta = stream_text_delta(chunk, request["wire_api"])
+                if delta:
+                    yield from parser.feed(delta)
+        else:
+            # Gateway ignored "stream": true and answered with a plain JSON body.
+            data = decode_upstream_json(read_upstream_body(response))
+            PROMPT_USAGE.record_usage(response_usage(data))
+            yield from parser.feed(extract_reaction_text(data, request["wire_api"]))
+    finally:
+        response.close()
+    yield from finish_reaction_stream(request, parser)
+
+
+def open_reaction_stream(request):
+    # Lines are forwarded as they arrive, so a stream cannot be hedged; fail
+    # over to the next provider only while nothing has been sent yet.
+    last_error = None
+    for provider in PROVIDER_HEALTH.rank(request["providers"]):
+        attempt = with_provider(request, provider)
+        url, payloads = reaction_request_payloads(attempt, stream=True)
+        started = time.monotonic()
+        try:
+            response = post_with_fallbacks(
+                url,
+                attempt["api_key"],
+                payloads,
+                capability_key=attempt["capability_key"],
+                send=open_openai_stream,
+            )
+        except RuntimeError as exc:
+            PROVIDER_HEALTH.record(provider["label"], time.monotonic() - started, ok=False)
+            last_error = exc
+            continue
+        PROVIDER_HEALTH.record(provider["label"], None, ok=True)
+        return attempt, response
+    raise last_error
+
+
+def ready_reaction_events(request, result):
+    result = deliver_reaction(request, result)
+    for line in result["lines"]:
+        yield "line", {"text": line}
+    if result["event"] is not None:
+        yield "event", result["event"]
+    yield "done", with_state_version(result, request)
+
+
+def finish_reaction_stream(request, parser):
+    try:
+        result = parse_ai_response(parser.text)
+    except RuntimeError:
+        if not parser.lines:
+            raise
+        result = {"lines": list(parser.lines), "event": parser.event}
+    if parser.event_done:
+        result["event"] = parser.event
+    remember_reaction(request, result)
+    delivered = deliver_reaction(request, result)
+    if not parser.lines:
+        for line in delivered["lines"]:
+            yield "line", {"text": line}
+    if not parser.event_done and delivered["event"] is not None:
+        yield "event", delivered["event"]
+    yield "done", with_state_version(delivered, request)
+
+
+class ReactionStreamParser:
+    # Pulls complete "lines" strings and the "event" object out of a partially
+    # streamed model reply so they can be forwarded before the reply finishes.
+    def __init__(self, request=None):
+        self.request = request
+        self.text = ""
+        self.lines = []
+        self.event = None
+        self.event_done = False
+        self._lines_pos = None
+        self._lines_done = False
+        self._decoder = json.JSONDecoder()
+        self._scanner = JsonObjectScanner()
+
+    def feed(self, delta):
+        self._scanner.feed(delta)
+        self.text = self._scanner.text
+        found = []
+        if not self._lines_done:
+            found.extend(self._scan_lines())
+        if not self.event_done:
+            found.extend(self._scan_event())
+        return found
+
+    def _scan_lines(self):
+        if self._lines_pos is None:
+            match = STREAM_LINES_KEY.search(self.text)
+            if match is None:
+                return []
+            self._lines_pos = match.end()
+        found = []
+        while True:
+            pos = STREAM_LIST_GAP.match(self.text, self._lines_pos).end()
+            if pos >= len(self.text):
+                break
+            if self.text[pos] != '"':
+                self._lines_done = True
+                break
+            try:
+                value, end = self._decoder.raw_decode(self.text, pos)
+            except json.JSONDecodeError:
+                break
+            self._lines_pos = end
+            line = clean_ai_line(value)
+            if line and len(self.lines) < 2:
+                self.lines.append(line)
+                found.append(("line", {"text": line}))
+        return found
+
+    def _scan_event(self):
+        match = STREAM_EVENT_KEY.search(self.text)
+        if match is None:
+            return []
+        pos = match.end()
+        if self.text.startswith("null", pos):
+            self.event_done = True
+            return []
+        if not self.text.startswith("{", pos):
+            return []
+        if pos not in self._scanner.spans:
+            # The event object has not closed yet; no point decoding it.
+            return []
+        value = self._scanner.decode(pos)
+        self.event_done = True
+        self.event = normalize_ai_event(value)
+        if self.event is None:
+            return []
+        # Forwarded early only if the session has not seen it; the unscreened
+        # event still goes to the cache when the reply finishes.
+        if self.request is not None and not EVENT_NOVELTY.screen(self.request["session_id"], self.event, self.request["speculation_key"]):
+            return []
+        return [("event", self.event)]
+
+
+def open_openai_stream(url, api_key, payload):
+    data = json.dumps(payload).encode("utf-8")
+    with METRICS.stage("upstream_headers"):
+        response = open_limited_upstream(url, "POST", data, openai_headers(api_key, accept="text/event-stream"))
+    METRICS.record_upstream(response.status, len(data), 0)
+    if response.status >= 400:
+        try:
+            raw = read_upstream_body(response)
+        finally:
+            response.close()
+        raise upstream_http_error(response.status, raw)
+    return response
+
+
+def iter_sse_data(response):
+    finished = False
+    while True:
+        try:
+            line = response.readline()
+        except (http.client.HTTPException, OSError) as exc:
+            raise RuntimeError(f"API 网络错误: {exc}") from exc
+        if not line:
+            return
+        if finished:
+            # Keep reading to the end of the body so the connection can be reused.
+            continue
+        chunk = parse_sse_line(line)
+        if chunk is SSE_DONE:
+            finished = True
+        elif chunk is not None:
+            yield chunk
+
+
+def parse_sse_line(line):
+    line = line.decode("utf-8", "replace").strip()
+    if not line.startswith("data:"):
+        return None
+    data = line[5:].strip()
+    if data == "[DONE]":
+        return SSE_DONE
+    try:
+        chunk = json.loads(data)
+    except json.JSONDecodeError:
+        return None
+    return chunk if isinstance(chunk, dict) else None
+
+
+def stream_text_delta(chunk, wire_api):
+    if wire_api == "responses":
+        event_type = chunk.get("type")
+        if event_type == "response.output_text.delta":
+            delta = chunk.get("delta")
+            return delta if isinstance(delta, str) else ""
+        if event_type == "error":
+            raise RuntimeError(f"API 流式错误: {chunk.get('message') or chunk.get('code') or event_type}")
+        if event_type == "response.failed":
+            error = (chunk.get("response") or {}).get("error") or {}
+            raise RuntimeError(f"API 流式错误: {error.get('message') or event_type}")
+        return ""
+    if isinstance(chunk.get("error"), dict):
+        raise RuntimeError(f"API 流式错误: {chunk['error'].get('message') or chunk['error']}")
+    choices = chunk.get("choices") or []
+    if not choices or not isinstance(choices[0], dict):
+        return ""
+    delta = choices[0].get("delta") or {}
+    content = delta.get("content") if isinstance(delta, dict) else None
+    return content if isinstance(content, str) else ""
+
+
+def reaction_cache_key(trigger, mode, model, state):
+    canonical = {
+        "trigger": trigger,
+        "mode": mode,
+        "model": model,
+        "state": quantize_game_state(state),
+    }
+    encoded = json.dumps(canonical, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def quantize_game_state(value, key=None):
+    # Nearby states share a cache entry: stats are bucketed to REACTION_QUANTUM
+    # (money to 20x that) so a point of stress does not force a new upstream call.
+    # Counts are kept exact.
+    if isinstance(value, dict):
+        return {name: quantize_game_state(item, name) for name, item in value.items()}
+    if isinstance(value, list):
+        return [quantize_game_state(item, key) for item in value]
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or key in REACTION_EXACT_FIELDS:
+        return value
+    step = REACTION_QUANTUM * 20 if key == "money" else REACTION_QUANTUM
+    if step <= 1:
+        return round(value)
+    return int(round(value / step)) * step
+
+
+class ReactionCache:
+    # LRU keyed by reaction_cache_key digests, bounded by the encoded size of
+    # the stored reactions rather than by entry count.
+    def __init__(self, max_bytes=REACTION_CACHE_BYTES, ttl=REACTION_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "stores": 0, "evicted": 0, "expired": 0}
+
+    def get(self, key):
+        if self.max_bytes <= 0:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[1] > self.ttl:
+                self._drop(key)
+                self._counters["expired"] += 1
+                entry = None
+            if entry is None:
+                self._counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters["hits"] += 1
+        return copy.deepcopy(entry[0])
+
+    def put(self, key, value):
+        size = len(json.dumps(value, ensure_ascii=False).encode("utf-8")) + len(key)
+        if self.max_bytes <= 0 or size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (copy.deepcopy(value), time.monotonic(), size)
+            self._bytes += size
+            self._counters["stores"] += 1
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self._counters["evicted"] += 1
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            counters["entries"] = len(self._entries)
+            counters["bytes"] = self._bytes
+        lookups = counters["hits"] + counters["misses"]
+        counters["hitRate"] = round(counters["hits"] / lookups, 4) if lookups else 0.0
+        return counters
+
+    def _drop(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+
+REACTION_CACHE = ReactionCache()
+
+
+def speculation_key(trigger, mode, model, wire_api, base_url, state):
+    # A prefetched reaction is generated from a predicted next-week state whose
+    # random rolls (weather, exact gains) will not match the real one, so only
+    # the coarse shape of the week has to agree for a handover.
+    state = state if isinstance(state, dict) else {}
+    signature = [state.get(name) for name in ("date", "nextContest", "activeCount", "quitCount")]
+    encoded = json.dumps([trigger, mode, model, wire_api, base_url, signature], ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class SpeculativeReactions:
+    # Background generations started by /api/react/prefetch, grouped per
+    # session. The first real reaction request of a session takes over the
+    # matching generation and discards the rest. A discarded generation that
+    # is already running keeps counting against its session's limit until it
+    # finishes, so repeated prefetches cannot pile up paid calls.
+    def __init__(self, workers=PREFETCH_WORKERS, per_session=PREFETCH_PER_SESSION, ttl=PREFETCH_TTL):
+        self.per_session = per_session
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="prefetch")
+        self._sessions = {}
+        self._orphans = {}
+        self._lock = threading.Lock()
+        self._counters = {"started": 0, "skipped": 0, "claimed": 0, "missed": 0, "cancelled": 0, "expired": 0}
+
+    def prefetch(self, session_id, requests):
+        now = time.monotonic()
+        started = 0
+        with self._lock:
+            self._expire_locked(now)
+            entries = self._sessions.setdefault(session_id, {})
+            wanted = {request["speculation_key"]: request for request in requests}
+            for key in [key for key in entries if key not in wanted]:
+                self._cancel_locked(session_id, entries.pop(key))
+            running = self._orphans_locked(session_id)
+            for key, request in wanted.items():
+                if key in entries:
+                    continue
+                if len(entries) + running >= self.per_session:
+                    self._counters["skipped"] += 1
+                    continue
+                entries[key] = (self._executor.submit(generate_ai_reaction, request), now)
+                started += 1
+            self._counters["started"] += started
+            pending = len(entries)
+            if not entries:
+                del self._sessions[session_id]
+        return {"started": started, "pending": pending}
+
+    def claim(self, request):
+        return self.claim_all([request])[0]
+
+    def claim_all(self, requests):
+        results = []
+        for future in self.take_all(requests):
+            if future is None:
+                results.append(None)
+                continue
+            try:
+                results.append(future.result(timeout=UPSTREAM_TIMEOUT))
+            except Exception:
+                self.settle(False)
+                results.append(None)
+                continue
+            self.settle(True)
+        return results
+
+    def take(self, request):
+        return self.take_all([request])[0]
+
+    def take_all(self, requests):
+        # Requests of one session (a batch shares its session) take over their
+        # generations together; whatever none of them matches is discarded.
+        session_id = requests[0]["session_id"]
+        if not session_id:
+            return [None] * len(requests)
+        with self._lock:
+            self._expire_locked(time.monotonic())
+            entries = self._sessions.pop(session_id, None) or {}
+            speculated = bool(entries)
+            taken = [entries.pop(request["speculation_key"], None) for request in requests]
+            for other in entries.values():
+                self._cancel_locked(session_id, other)
+            if speculated:
+                self._counters["missed"] += sum(1 for entry in taken if entry is None)
+        return [entry[0] if entry is not None else None for entry in taken]
+
+    def settle(self, claimed):
+        # A taken generation only counts as claimed once its result is in;
+        # one that failed or timed out is a miss like any other.
+        with self._lock:
+            self._counters["claimed" if claimed else "missed"] += 1
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            counters["sessions"] = len(self._sessions)
+            counters["pending"] = sum(len(entries) for entries in self._sessions.values())
+            counters["orphaned"] = sum(self._orphans_locked(session_id) for session_id in list(self._orphans))
+        return counters
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _cancel_locked(self, session_id, entry, counter="cancelled"):
+        # A generation that is already running cannot be interrupted; its
+        # result is simply dropped when it finishes.
+        future = entry[0]
+        if not future.cancel() and not future.done():
+            self._orphans.setdefault(session_id, []).append(future)
+        self._counters[counter] += 1
+
+    def _orphans_locked(self, session_id):
+        running = [future for future in self._orphans.get(session_id, ()) if not future.done()]
+        if running:
+            self._orphans[session_id] = running
+        else:
+            self._orphans.pop(session_id, None)
+        return len(running)
+
+    def _expire_locked(self, now):
+        for session_id in list(self._sessions):
+            entries = self._sessions[session_id]
+            for key in [key for key, entry in entries.items() if now - entry[1] > self.ttl]:
+                self._cancel_locked(session_id, entries.pop(key), "expired")
+            if not entries:
+                del self._sessions[session_id]
+        for session_id in list(self._orphans):
+            self._orphans_locked(session_id)
+
+
+SPECULATIONS = SpeculativeReactions()
+
+
+class ReactionJobQueue:
+    # Reactions submitted through /api/react/jobs and collected by long-poll.
+    # A bounded pool runs them highest priority first, then earliest
+    # deadline; a job whose deadline passes while queued, or whose session
+    # has since submitted a later turn, is dropped without calling upstream.
+    # Results are delivered (and their event recorded as seen) only when a
+    # poll hands them out, so a job the player moved past leaves no trace.
+    def __init__(self, workers=JOB_WORKERS, limit=JOB_QUEUE_LIMIT, deadline=JOB_DEADLINE, ttl=JOB_RESULT_TTL):
+        self.limit = limit
+        self.deadline = deadline
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="job")
+        self._heap = []
+        self._jobs = {}
+        self._turns = {}
+        self._sequence = 0
+        self._queued = 0
+        self._running = 0
+        self._lock = threading.Lock()
+        self._counters = {
+            "submitted": 0,
+            "rejected": 0,
+            "done": 0,
+            "failed": 0,
+            "cancelled": 0,
+            "superseded": 0,
+            "expired": 0,
+            "discarded": 0,
+        }
+
+    def submit(self, payload):
+        now = time.monotonic()
+        batch = isinstance(payload.get("triggers"), list)
+        deadline_ms = safe_number(payload.get("deadlineMs"))
+        job = {
+            "id": os.urandom(12).hex(),
+            "session": str(payload.get("sessionId") or "").strip(),
+            "turn": payload.get("turn") if isinstance(payload.get("turn"), int) else None,
+            "priority": int(safe_number(payload.get("priority"))),
+            "deadline": now + (deadline_ms / 1000 if deadline_ms > 0 else self.deadline),
+            "payload": payload,
+            "stateVersion": payload.get("stateVersion"),
+            "run": resolve_ai_reaction_batch if batch else resolve_ai_reaction,
+            "deliver": batch_response if batch else reaction_response,
+            "status": "queued",
+            "created": now,
+            "finished": None,
+            "future": Future(),
+        }
+        with self._lock:
+            self._expire_locked(now)
+            if self._queued >= self.limit:
+                self._counters["rejected"] += 1
+                raise UpstreamBusyError("AI 任务排队过多，请稍后再试。")
+            stale = False
+            if job["session"] and job["turn"] is not None:
+                latest = self._turns.get(job["session"])
+                # A turn older than the latest means it arrived after the
+                # session already moved on.
+                stale = latest is not None and job["turn"] < latest
+                if not stale:
+                    self._turns[job["session"]] = job["turn"]
+                    for other in self._jobs.values():
+                        if (
+                            other["session"] == job["session"]
+                            and other["turn"] is not None
+                            and other["turn"] < job["turn"]
+                            and other["status"] in ("queued", "running")
+                        ):
+                            self._finish_locked(other, "superseded")
+            self._jobs[job["id"]] = job
+            self._queued += 1
+            self._counters["submitted"] += 1
+            if stale:
+                self._finish_locked(job, "superseded")
+            else:
+                self._sequence += 1
+                heapq.heappush(self._heap, (-job["priority"], job["deadline"], self._sequence, job))
+                self._executor.submit(self._run_next)
+        return self.describe(job)
+
+    def poll(self, job_id, timeout=0):
+        future = self.future(job_id)
+        if future is not None and timeout > 0:
+            wait([future], timeout=timeout)
+        return self.status(job_id)
+
+    def future(self, job_id):
+        job = self._jobs.get(job_id)
+        return None if job is None else job["future"]
+
+    def status(self, job_id):
+        job = self._jobs.get(job_id)
+        return None if job is None else self.describe(job)
+
+    def cancel(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job["status"] not in JOB_FINAL_STATES:
+                self._finish_locked(job, "cancelled")
+        return self.describe(job)
+
+    def describe(self, job):
+        with self._lock:
+            body = {"jobId": job["id"], "status": job["status"]}
+            if job["turn"] is not None:
+                body["turn"] = job["turn"]
+            if job["stateVersion"] is not None:
+                body["stateVersion"] = job["stateVersion"]
+            if job["status"] == "done":
+                if "result" not in job:
+                    # Delivery screens the event against what the session has
+                    # seen, so it happens once, for the first poll to ask.
+                    job["result"] = job["deliver"](*job.pop("output"))
+                body["result"] = job["result"]
+            elif job["status"] == "failed":
+                body.update(job["error"])
+        return body
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            counters["queued"] = self._queued
+            counters["running"] = self._running
+            counters["retained"] = len(self._jobs)
+        return counters
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run_next(self):
+        with self._lock:
+            job = None
+            while self._heap:
+                candidate = heapq.heappop(self._heap)[3]
+                if candidate["status"] != "queued":
+                    continue
+                if time.monotonic() > candidate["deadline"]:
+                    self._finish_locked(candidate, "expired")
+                    continue
+                job = candidate
+                break
+            if job is None:
+                return
+            self._queued -= 1
+            self._running += 1
+            job["status"] = "running"
+            payload = job["payload"]
+        METRICS.observe(("stage", "job_wait"), time.monotonic() - job["created"])
+        try:
+            with METRICS.stage("job_run"):
+                output = job["run"](payload)
+            error = None
+        except Exception as exc:
+            output = None
+            error = api_error_body(exc) if isinstance(exc, RuntimeError) else {"error": f"请求处理失败: {exc}"}
+        with self._lock:
+            self._running -= 1
+            if job["status"] != "running":
+                # Cancelled or superseded while upstream was working on it.
+                self._counters["discarded"] += 1
+            elif error is not None:
+                job["error"] = error
+                self._finish_locked(job, "failed")
+            else:
+                job["output"] = output
+                self._finish_locked(job, "done")
+        if error is None:
+            STARTUP.first_reaction(JOB_PATH, time.monotonic() - job["created"])
+
+    def _finish_locked(self, job, status):
+        if job["status"] == "queued":
+            self._queued -= 1
+        job["status"] = status
+        job["finished"] = time.monotonic()
+        job.pop("payload", None)
+        self._counters[status] += 1
+        job["future"].set_result(status)
+
+    def _expire_locked(self, now):
+        for job_id in [job_id for job_id, job in self._jobs.items() if job["finished"] is not None and now - job["finished"] > self.ttl]:
+            job = self._jobs.pop(job_id)
+            if job["session"] and not any(other["session"] == job["session"] for other in self._jobs.values()):
+                self._turns.pop(job["session"], None)
+
+
+REACTION_JOBS = ReactionJobQueue()
+
+
+def parse_job_target(target):
+    # "/api/react/jobs/<id>?wait=<seconds>" -> (id, seconds), or None for
+    # any other path. The wait is capped so a poll never outlives proxies.
+    parts = urlsplit(target)
+    if not parts.path.startswith(JOB_PATH + "/"):
+        return None
+    job_id = parts.path[len(JOB_PATH) + 1 :]
+    seconds = parse_qs(parts.query).get("wait", [JOB_POLL_SECONDS])[0]
+    try:
+        seconds = float(seconds)
+    except ValueError:
+        seconds = JOB_POLL_SECONDS
+    return job_id, max(0.0, min(seconds, JOB_POLL_MAX))
+
+
+def job_missing_body():
+    return {"error": "AI 任务不存在或已过期。"}
+
+
+def fetch_models(payload):
+    config = payload.get("config") or {}
+    api_key = config.get("token") or os.environ.get("OPENAI_API_KEY")
+    base_url = normalize_base_url(config.get("baseUrl") or os.environ.get("OPENAI_BASE_URL") or DEFAULT_BASE_URL)
+    current_model = config.get("model") or DEFAULT_MODEL
+    if not api_key:
+        raise RuntimeError("请先填写 API Token，再获取模型列表。")
+    if not base_url:
+        base_url = "https://api.openai.com/v1"
+
+    cache_key = hashlib.sha256(f"{base_url}\n{api_key}".encode("utf-8")).hexdigest()
+    models = MODELS_CACHE.get(
+        cache_key,
+        lambda: load_models(base_url, api_key),
+        force=bool(payload.get("refresh")),
+    )
+    selected = choose_model(models, current_model)
+    return {"models": models, "selected": selected}
+
+
+def load_models(base_url, api_key):
+    data = get_openai_compatible(f"{base_url}/models", api_key)
+    models = normalize_models_response(data)
+    if not models:
+        raise RuntimeError("模型列表为空，无法选择可用模型。")
+    return models
+
+
+class TTLSingleFlightCache:
+    # Fresh entries are served directly; entries past the TTL but inside the
+    # stale window are served while one background load refreshes them.
+    # Concurrent loads of the same key share a single loader call.
+    def __init__(self, ttl, stale_seconds=0, max_entries=64):
+        self.ttl = ttl
+        self.stale_seconds = stale_seconds
+        self.max_entries = max_entries
+        self._entries = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "staleHits": 0, "misses": 0, "coalesced": 0, "refreshes": 0, "errors": 0}
+
+    def get(self, key, loader, force=False):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not force:
+                value, stored_at = entry
+                age = now - stored_at
+                if age <= self.ttl:
+                    self._counters["hits"] += 1
+                    return value
+                if age <= self.ttl + self.stale_seconds:
+                    self._counters["staleHits"] += 1
+                    if key not in self._inflight:
+                        self._counters["refreshes"] += 1
+                        flight = self._inflight[key] = SingleFlight()
+                        threading.Thread(target=self._load, args=(key, loader, flight), daemon=True).start()
+                    return value
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = SingleFlight()
+                self._counters["misses"] += 1
+            else:
+                self._counters["coalesced"] += 1
+        if leader:
+            self._load(key, loader, flight)
+        return flight.result()
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            counters["entries"] = len(self._entries)
+            counters["inflight"] = len(self._inflight)
+        return counters
+
+    def _load(self, key, loader, flight):
+        try:
+            value = loader()
+        except Exception as exc:
+            with self._lock:
+                self._counters["errors"] += 1
+                self._inflight.pop(key, None)
+            flight.fail(exc)
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            if len(self._entries) > self.max_entries:
+                oldest = min(self._entries, key=lambda item: self._entries[item][1])
+                del self._entries[oldest]
+            self._inflight.pop(key, None)
+        flight.finish(value)
+
+
+class SingleFlight:
+    def __init__(self):
+        self._done = threading.Event()
+        self._value = None
+        self._error = None
+
+    def finish(self, value):
+        self._value = value
+        self._done.set()
+
+    def fail(self, error):
+        self._error = error
+        self._done.set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError("等待上游结果超时。")
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+MODELS_CACHE = TTLSingleFlightCache(MODELS_CACHE_TTL, MODELS_CACHE_STALE_SECONDS)
+
+
+def post_openai_compatible(url, api_key, payload):
+    return request_openai_compatible_json(url, api_key, payload=payload, method="POST")
+
+
+def post_with_fallbacks(url, api_key, payloads, capability_key=None, send=None):
+    send = send or post_openai_compatible
+    last_error = None
+    for index in range(fallback_start_index(url, api_key, payloads, capability_key), len(payloads)):
+        try:
+            data = send(url, api_key, payloads[index])
+        except RuntimeError as exc:
+            last_error = exc
+            if index == len(payloads) - 1 or not looks_like_schema_rejection(str(exc)):
+                raise
+            METRICS.count("formatRejected", RESPONSE_FORMAT_VARIANTS[index])
+            continue
+        METRICS.count("formatUsed", RESPONSE_FORMAT_VARIANTS[index])
+        if capability_key is not None:
+            FORMAT_CAPABILITIES.record(capability_key, index)
+        return data
+    raise last_error
+
+
+def fallback_start_index(url, api_key, payloads, capability_key):
+    if capability_key is None:
+        return 0
+    start = min(FORMAT_CAPABILITIES.start_index(capability_key), len(payloads) - 1)
+    if start > 0 and FORMAT_CAPABILITIES.claim_reprobe(capability_key):
+        threading.Thread(
+            target=reprobe_response_formats,
+            args=(url, api_key, payloads[:start], capability_key),
+            daemon=True,
+        ).start()
+    return start
+
+
+def reprobe_response_formats(url, api_key, stricter_payloads, capability_key):
+    for index, payload in enumerate(stricter_payloads):
+        payload = {key: value for key, value in payload.items() if key not in ("stream", "stream_options")}
+        try:
+            post_openai_compatible(url, api_key, payload)
+        except RuntimeError as exc:
+            if looks_like_schema_rejection(str(exc)):
+                continue
+            break
+        FORMAT_CAPABILITIES.record(capability_key, index)
+        break
+    FORMAT_CAPABILITIES.finish_reprobe(capability_key)
+
+
+class ProviderHealth:
+    # EWMA latency and error rate per provider, plus a window of recent
+    # latencies from which the hedge deadline is read.
+    def __init__(self, alpha=PROVIDER_EWMA_ALPHA, window=PROVIDER_LATENCY_WINDOW, limit=PROVIDER_LIMIT):
+        self.alpha = alpha
+        self.window = window
+        self.limit = limit
+        self._providers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, label, seconds, ok):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entry(label)
+            entry["requests"] += 1
+            entry["errorRate"] += self.alpha * ((0.0 if ok else 1.0) - entry["errorRate"])
+            if not ok:
+                entry["errors"] += 1
+                entry["lastError"] = now
+            elif seconds is not None:
+                entry["samples"].append(seconds)
+                if entry["latency"] is None:
+                    entry["latency"] = seconds
+                else:
+                    entry["latency"] += self.alpha * (seconds - entry["latency"])
+
+    def count(self, label, name):
+        with self._lock:
+            self._entry(label)[name] += 1
+
+    def rank(self, providers):
+        # Healthy providers with measurements first, fastest first; providers
+        # not measured yet keep their configured order behind them. A provider
+        # whose error rate is high and that failed recently goes last.
+        if len(providers) == 1:
+            return providers
+        now = time.monotonic()
+        with self._lock:
+            keys = []
+            for index, provider in enumerate(providers):
+                entry = self._providers.get(provider["label"])
+                if entry is None:
+                    keys.append((False, True, 0.0, index))
+                    continue
+                unhealthy = (
+                    entry["errorRate"] >= PROVIDER_UNHEALTHY_ERROR_RATE
+                    and now - entry["lastError"] < PROVIDER_COOLDOWN_SECONDS
+                )
+                measured = entry["latency"] is not None
+                score = (entry["latency"] or 0.0) * (1 + entry["errorRate"])
+                keys.append((unhealthy, not measured, score, index))
+        order = sorted(range(len(providers)), key=keys.__getitem__)
+        return [providers[index] for index in order]
+
+    def hedge_delay(self, label):
+        with self._lock:
+            entry = self._providers.get(label)
+            samples = sorted(entry["samples"]) if entry is not None else []
+        if len(samples) < PROVIDER_MIN_SAMPLES:
+            return HEDGE_INITIAL_DELAY
+        index = min(len(samples) - 1, int(len(samples) * HEDGE_PERCENTILE / 100))
+        return min(max(samples[index], HEDGE_MIN_DELAY), UPSTREAM_TIMEOUT)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            entries = [(label, dict(entry, samples=list(entry["samples"]))) for label, entry in self._providers.items()]
+        providers = {}
+        for label, entry in entries:
+            samples = sorted(entry["samples"])
+            providers[label] = {
+                "requests": entry["requests"],
+                "errors": entry["errors"],
+                "errorRate": round(entry["errorRate"], 4),
+                "latencyMs": None if entry["latency"] is None else round(entry["latency"] * 1000, 1),
+                "p90Ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.9))] * 1000, 1) if samples else None,
+                "hedgeDelayMs": round(self.hedge_delay(label) * 1000, 1),
+                "hedged": entry["hedged"],
+                "hedgeWins": entry["hedgeWins"],
+                "cancelled": entry["cancelled"],
+                "healthy": not (
+                    entry["errorRate"] >= PROVIDER_UNHEALTHY_ERROR_RATE
+                    and now - entry["lastError"] < PROVIDER_COOLDOWN_SECONDS
+                ),
+            }
+        return providers
+
+    def _entry(self, label):
+        entry = self._providers.get(label)
+        if entry is None:
+            entry = {
+                "requests": 0,
+                "errors": 0,
+                "errorRate": 0.0,
+                "latency": None,
+                "lastError": float("-inf"),
+                "samples": deque(maxlen=self.window),
+                "hedged": 0,
+                "hedgeWins": 0,
+                "cancelled": 0,
+            }
+            self._providers[label] = entry
+            while len(self._providers) > self.limit:
+                self._providers.popitem(last=False)
+        else:
+            self._providers.move_to_end(label)
+        return entry
+
+
+PROVIDER_HEALTH = ProviderHealth()
+HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="astro-chaos-hedge")
+
+
+class DeadlineTimers:
+    # A heap of (deadline, callback) served by one thread. Callbacks must be
+    # quick; anything slow is handed to an executor from inside them.
+    def __init__(self, name):
+        self.name = name
+        self._heap = []
+        self._sequence = 0
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def call_at(self, deadline, callback):
+        with self._cond:
+            self._sequence += 1
+            heapq.heappush(self._heap, (deadline, self._sequence, callback))
+            # Threads do not survive fork, so a worker starts its own.
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, callback = heapq.heappop(self._heap)
+            try:
+                callback()
+            except Exception as exc:
+                print(f"[server] {self.name} 定时任务出错: {exc}")
+
+
+HEDGE_TIMERS = DeadlineTimers("hedge-timer")
+UPSTREAM_CANCEL = contextvars.ContextVar("astro_chaos_upstream_cancel", default=None)
+
+
+class UpstreamCancelScope:
+    # Lets the thread waiting on a hedge abort a losing attempt: cancel() shuts
+    # down the socket the attempt is blocked on, and the attempt then fails.
+    def __init__(self):
+        self.cancelled = False
+        self._conn = None
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+
+    def watch(self, conn):
+        with self._lock:
+            if self.cancelled:
+                raise ConnectionAbortedError("hedged request cancelled")
+            self._conn = conn
+
+    def wait(self, seconds):
+        return self._event.wait(seconds)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            conn = self._conn
+        self._event.set()
+        sock = getattr(conn, "sock", None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def hedged_call(providers, attempt):
+    # Ask the best-ranked provider first. If it has not answered by its
+    # adaptive deadline (a latency percentile), start the next one; if it
+    # fails, move on at once. The first attempt to return a parsed result
+    # wins and the others are cancelled.
+    providers = PROVIDER_HEALTH.rank(providers)
+    if len(providers) == 1:
+        return run_provider_attempt(providers[0], attempt)
+    return HedgedCall(providers, attempt).run()
+
+
+class HedgedCall:
+    # One hedged_call. The calling thread runs the primary attempt, and any
+    # failover after an error, itself; HEDGE_EXECUTOR only runs the hedges,
+    # so a busy pool delays hedges instead of queueing primaries behind them.
+    # Hedge deadlines are kept by HEDGE_TIMERS, which hands an attempt to the
+    # pool only once its deadline passes.
+    def __init__(self, providers, attempt):
+        self.providers = providers
+        self.attempt = attempt
+        self.delay = PROVIDER_HEALTH.hedge_delay(providers[0]["label"])
+        self._context = contextvars.copy_context()
+        self._cond = threading.Condition()
+        self._next = 0
+        self._running = {}
+        self._settled = False
+        self._won = False
+        self._result = None
+        self._error = None
+
+    def run(self):
+        claimed = self._claim()
+        self._schedule()
+        try:
+            self._race(claimed)
+            with self._cond:
+                while not self._settled and self._running:
+                    self._cond.wait()
+                if self._won:
+                    return self._result
+            raise self._error
+        finally:
+            self._close()
+
+    def _schedule(self):
+        HEDGE_TIMERS.call_at(time.monotonic() + self.delay, self._hedge)
+
+    def _hedge(self):
+        with self._cond:
+            # With nothing running the last attempt failed, and the thread
+            # that saw it fail is already moving on to the next provider.
+            if self._settled or not self._running:
+                return
+            claimed = self._claim_locked()
+            more = self._next < len(self.providers)
+        if claimed is None:
+            return
+        PROVIDER_HEALTH.count(self.providers[claimed[0]]["label"], "hedged")
+        if more:
+            self._schedule()
+        HEDGE_EXECUTOR.submit(self._context.copy().run, self._race, claimed)
+
+    def _race(self, claimed):
+        # Whichever thread saw its attempt fail starts the next provider.
+        while claimed is not None:
+            self._attempt(*claimed)
+            claimed = self._claim()
+
+    def _claim(self):
+        with self._cond:
+            return self._claim_locked()
+
+    def _claim_locked(self):
+        if self._settled or self._next >= len(self.providers):
+            return None
+        index = self._next
+        self._next += 1
+        scope = UpstreamCancelScope()
+        self._running[index] = scope
+        return index, scope
+
+    def _attempt(self, index, scope):
+        try:
+            result = run_provider_attempt(self.providers[index], self.attempt, scope)
+        except Exception as exc:
+            with self._cond:
+                self._running.pop(index, None)
+                if not self._settled:
+                    self._error = exc
+                self._cond.notify_all()
+            return
+        with self._cond:
+            self._running.pop(index, None)
+            if self._settled:
+                return
+            self._won = True
+            self._result = result
+            self._settled = True
+            losers = list(self._running.items())
+            self._running.clear()
+            self._cond.notify_all()
+        if index:
+            PROVIDER_HEALTH.count(self.providers[index]["label"], "hedgeWins")
+        self._cancel(losers)
+
+    def _close(self):
+        with self._cond:
+            self._settled = True
+            losers = list(self._running.items())
+            self._running.clear()
+            self._cond.notify_all()
+        self._cancel(losers)
+
+    def _cancel(self, losers):
+        for index, scope in losers:
+            PROVIDER_HEALTH.count(self.providers[index]["label"], "cancelled")
+            scope.cancel()
+
+
+def run_provider_attempt(provider, attempt, scope=None):
+    token = UPSTREAM_CANCEL.set(scope)
+    started = time.monotonic()
+    try:
+        result = attempt(provider)
+    except RuntimeError:
+        if scope is None or not scope.cancelled:
+            PROVIDER_HEALTH.record(provider["label"], time.monotonic() - started, ok=False)
+        raise
+    finally:
+        UPSTREAM_CANCEL.reset(token)
+    PROVIDER_HEALTH.record(provider["label"], time.monotonic() - started, ok=True)
+    return result
+
+
+class FormatCapabilityCache:
+    # Remembers which structured-output variant each (base_url, model, wire_api)
+    # accepted, so requests skip variants the gateway is known to reject.
+    def __init__(self, path=CAPABILITY_FILE, ttl=CAPABILITY_TTL_SECONDS, reprobe_after=CAPABILITY_REPROBE_SECONDS):
+        self.path = Path(path) if path else None
+        self.ttl = ttl
+        self.reprobe_after = reprobe_after
+        self._lock = threading.Lock()
+        self._probing = set()
+        self._counters = {"hits": 0, "misses": 0, "reprobes": 0, "upgrades": 0}
+        self._entries = self._load()
+
+    def start_index(self, key):
+        entry_key = capability_entry_key(key)
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry and time.time() - entry.get("checkedAt", 0) > self.ttl:
+                del self._entries[entry_key]
+                entry = None
+            self._counters["hits" if entry else "misses"] += 1
+        if not entry or entry.get("format") not in RESPONSE_FORMAT_VARIANTS:
+            return 0
+        return RESPONSE_FORMAT_VARIANTS.index(entry["format"])
+
+    def record(self, key, index):
+        entry_key = capability_entry_key(key)
+        now = time.time()
+        with self._lock:
+            previous = self._entries.get(entry_key) or {}
+            format_name = RESPONSE_FORMAT_VARIANTS[index]
+            if previous.get("format") in RESPONSE_FORMAT_VARIANTS and RESPONSE_FORMAT_VARIANTS.index(previous["format"]) > index:
+                self._counters["upgrades"] += 1
+            changed = previous.get("format") != format_name
+            self._entries[entry_key] = {
+                "format": format_name,
+                "checkedAt": now if changed else previous.get("checkedAt", now),
+                "probedAt": previous.get("probedAt", now),
+            }
+            if changed:
+                self._save_locked()
+
+    def known(self, key):
+        # The recorded format, if still fresh; unlike start_index it does not
+        # count as a lookup.
+        with self._lock:
+            entry = self._entries.get(capability_entry_key(key))
+        if not entry or time.time() - entry.get("checkedAt", 0) > self.ttl:
+            return None
+        return entry.get("format") if entry.get("format") in RESPONSE_FORMAT_VARIANTS else None
+
+    def claim_reprobe(self, key):
+        entry_key = capability_entry_key(key)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry is None or entry_key in self._probing:
+                return False
+            if now - entry.get("probedAt", 0) < self.reprobe_after:
+                return False
+            entry["probedAt"] = now
+            self._probing.add(entry_key)
+            self._counters["reprobes"] += 1
+            return True
+
+    def finish_reprobe(self, key):
+        with self._lock:
+            self._probing.discard(capability_entry_key(key))
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            counters["entries"] = len(self._entries)
+        return counters
+
+    def use_worker_file(self, index):
+        if self.path is None:
+            return
+        with self._lock:
+            self.path = worker_file(self.path, index)
+            self._entries.update(self._load())
+
+    def _load(self):
+        if self.path is None:
+            return {}
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(data, dict):
+            return {}
+        now = time.time()
+        return {
+            key: entry
+            for key, entry in data.items()
+            if isinstance(entry, dict)
+            and entry.get("format") in RESPONSE_FORMAT_VARIANTS
+            and isinstance(entry.get("checkedAt"), (int, float))
+            and now - entry["checkedAt"] <= self.ttl
+        }
+
+    def _save_locked(self):
+        if self.path is None:
+            return
+        temp_path = self.path.with_name(f"{self.path.name}.tmp")
+        try:
+            temp_path.write_text(json.dumps(self._entries, ensure_ascii=False, indent=1), encoding="utf-8")
+            os.replace(temp_path, self.path)
+        except OSError as exc:
+            print(f"[server] 无法写入格式能力缓存 {self.path}: {exc}")
+
+
+def capability_entry_key(key):
+    base_url, model, wire_api = key
+    return f"{wire_api} {model} {base_url}"
+
+
+FORMAT_CAPABILITIES = FormatCapabilityCache()
+
+
+def looks_like_schema_rejection(message):
+    lowered = message.lower()
+    return any(
+        token in lowered
+        for token in [
+            "json_schema",
+            "response_format",
+            "text.format",
+            "unsupported",
+            "unknown parameter",
+            "invalid parameter",
+        ]
+    )
+
+
+def get_openai_compatible(url, api_key):
+    return request_openai_compatible_json(url, api_key, method="GET")
+
+
+class RateLimitState:
+    # AIMD concurrency window plus an optional token bucket for one
+    # (host, API key). The window grows by about one slot per window's worth
+    # of successes and shrinks on 429/5xx, but only for requests started after
+    # the last decrease, so one overload episode counts once.
+    def __init__(self, rate, burst, initial, maximum):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.maximum = max(1, maximum)
+        self.limit = float(min(max(1, initial), self.maximum))
+        self.inflight = 0
+        self.waiting = 0
+        self.tokens = self.burst
+        self.refilled = time.monotonic()
+        self.blocked_until = 0.0
+        self.decreased = float("-inf")
+        self.counters = {"requests": 0, "throttled": 0, "serverErrors": 0, "rejected": 0, "timeouts": 0}
+
+    def ready_in(self, now):
+        # 0 when a request may start now, seconds to wait for time-based
+        # limits, or None when it must wait for a running request to finish.
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.inflight >= int(self.limit):
+            return None
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+        return 0
+
+    def take(self, now):
+        self.inflight += 1
+        self.counters["requests"] += 1
+        if self.rate > 0:
+            self.tokens -= 1
+        return now
+
+    def finish(self, now, started, status, retry_after):
+        self.inflight = max(0, self.inflight - 1)
+        if status is None:
+            return
+        if status == 429 or status >= 500:
+            self.counters["throttled" if status == 429 else "serverErrors"] += 1
+            if started > self.decreased:
+                self.limit = max(1.0, self.limit * AIMD_DECREASE)
+                self.decreased = now
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+        elif status < 400:
+            self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+
+    def stats(self, now):
+        return dict(
+            self.counters,
+            limit=round(self.limit, 2),
+            inflight=self.inflight,
+            waiting=self.waiting,
+            blockedMs=round(max(0.0, self.blocked_until - now) * 1000),
+        )
+
+
+class UpstreamRateLimiter:
+    # Per-key limiter in front of every upstream call (threading engine). At
+    # most UPSTREAM_QUEUE_LIMIT requests wait per key, each until its own
+    # deadline; beyond that callers get UpstreamBusyError straight away.
+    def __init__(
+        self,
+        rate=UPSTREAM_RPS,
+        burst=UPSTREAM_BURST,
+        initial=UPSTREAM_CONCURRENCY,
+        maximum=UPSTREAM_MAX_CONCURRENCY,
+        queue_limit=UPSTREAM_QUEUE_LIMIT,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.initial = initial
+        self.maximum = maximum
+        self.queue_limit = queue_limit
+        self._states = OrderedDict()
+        self._cond = threading.Condition()
+
+    def acquire(self, key, deadline):
+        with self._cond:
+            state = self._state(key)
+            self._admit(state)
+            state.waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = state.ready_in(now)
+                    if delay == 0:
+                        return state.take(now)
+                    remaining = self._remaining(state, deadline, now)
+                    self._cond.wait(remaining if delay is None else min(delay, remaining))
+            finally:
+                state.waiting -= 1
+
+    def release(self, key, started, status, retry_after=None):
+        with self._cond:
+            self._state(key).finish(time.monotonic(), started, status, retry_after)
+            self._cond.notify_all()
+
+    def share(self, parts):
+        # Under --workers each process enforces its slice of every key's limits.
+        self.rate /= parts
+        self.burst = max(1.0, self.burst / parts)
+        self.initial = max(1, self.initial // parts)
+        self.maximum = max(1, self.maximum // parts)
+        self.queue_limit = max(1, self.queue_limit // parts)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._cond:
+            return {key: state.stats(now) for key, state in self._states.items()}
+
+    def _admit(self, state):
+        if state.waiting >= self.queue_limit and state.ready_in(time.monotonic()) != 0:
+            state.counters["rejected"] += 1
+            raise UpstreamBusyError("AI 接口繁忙（排队已满），请稍后再试。")
+
+    def _remaining(self, state, deadline, now):
+        if now >= deadline:
+            state.counters["timeouts"] += 1
+            raise UpstreamBusyError("AI 接口繁忙（排队超时），请稍后再试。")
+        return deadline - now
+
+    def _state(self, key):
+        state = self._states.get(key)
+        if state is None:
+            state = RateLimitState(self.rate, self.burst, self.initial, self.maximum)
+            self._states[key] = state
+            self._evict()
+        else:
+            self._states.move_to_end(key)
+        return state
+
+    def _evict(self):
+        while len(self._states) > PROVIDER_LIMIT:
+            key, state = next(iter(self._states.items()))
+            if state.inflight or state.waiting:
+                break
+            del self._states[key]
+
+
+class LimitedResponse:
+    # Holds a rate-limiter slot for as long as the upstream response is open.
+    def __init__(self, response, release):
+        self.response = response
+        self.status = response.status
+        self.headers = response.headers
+        self._release = release
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def read(self, *args):
+        return self.response.read(*args)
+
+    def readline(self):
+        return self.response.readline()
+
+    def close(self):
+        self.response.close()
+        release, self._release = self._release, None
+        if release is not None:
+            release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class UpstreamTape:
+    # --record / --replay. Recording appends every final upstream exchange
+    # (after retries) to DIR/upstream.jsonl, one JSON object per line, with the
+    # header latency and the offset of every chunk the proxy read. Replay
+    # indexes that file by a hash of the normalized request, answers matching
+    # requests in recorded order without touching the network, and can keep
+    # or drop the recorded timing.
+    def __init__(self):
+        self.mode = None
+        self.path = None
+        self.latency = True
+        self._handle = None
+        self._index = {}
+        self._cursor = {}
+        self._lock = threading.Lock()
+        self._counters = {"recorded": 0, "replayed": 0, "misses": 0}
+
+    def configure(self, mode, directory, latency=True):
+        self.mode = mode
+        self.path = Path(directory) / UPSTREAM_TAPE_FILE
+        self.latency = latency
+        if mode == "record":
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._handle = self.path.open("a", encoding="utf-8")
+            return 0
+        self._handle = self.path.open("rb")
+        offset = 0
+        for line in self._handle:
+            try:
+                key = json.loads(line).get("key")
+            except (ValueError, AttributeError):
+                key = None
+            if isinstance(key, str):
+                self._index.setdefault(key, []).append(offset)
+            offset += len(line)
+        return sum(len(offsets) for offsets in self._index.values())
+
+    def track(self, response, url, method, data, started, wrapper=None):
+        if self.mode != "record":
+            return response
+        entry = {
+            "key": tape_key(url, method, data),
+            "method": method,
+            "url": url,
+            "request": tape_body(data),
+            "status": response.status,
+            "contentType": response.headers.get("Content-Type"),
+            "headersMs": round((time.monotonic() - started) * 1000, 2),
+        }
+        return (wrapper or RecordingResponse)(response, self, entry, started)
+
+    def write(self, entry):
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            try:
+                self._handle.write(line + "\n")
+                self._handle.flush()
+            except (OSError, ValueError) as exc:
+                print(f"[server] 无法写入上游录制 {self.path}: {exc}")
+                return
+            self._counters["recorded"] += 1
+
+    def open(self, url, method, data):
+        response = self.replay(url, method, data, ReplayResponse)
+        time.sleep(response.due(response.headers_ms))
+        return response
+
+    async def async_open(self, url, method, data):
+        response = self.replay(url, method, data, AsyncReplayResponse)
+        await asyncio.sleep(response.due(response.headers_ms))
+        return response
+
+    def replay(self, url, method, data, response_class):
+        key = tape_key(url, method, data)
+        with self._lock:
+            offsets = self._index.get(key)
+            if not offsets:
+                self._counters["misses"] += 1
+                raise RuntimeError(f"回放记录中没有这个上游请求: {method} {urlsplit(url).path}")
+            position = self._cursor.get(key, 0)
+            self._cursor[key] = position + 1
+            self._handle.seek(offsets[position % len(offsets)])
+            entry = json.loads(self._handle.readline())
+            self._counters["replayed"] += 1
+        return response_class(entry, self.latency)
+
+    def reopen(self):
+        # A forked worker must not share the parent's file offset.
+        if self._handle is None:
+            return
+        self._handle.close()
+        if self.mode == "record":
+            self._handle = self.path.open("a", encoding="utf-8")
+        else:
+            self._handle = self.path.open("rb")
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, mode=self.mode, keys=len(self._index))
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+
+
+def tape_key(url, method, data):
+    # Host and credentials are left out so a tape recorded against one gateway
+    # replays for any Base URL; JSON bodies are compared with sorted keys.
+    body = json.dumps(tape_body(data), ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    digest = hashlib.sha256(f"{method} {urlsplit(url).path}\n{body}".encode("utf-8"))
+    return digest.hexdigest()[:32]
+
+
+def tape_body(data):
+    if data is None:
+        return None
+    try:
+        return json.loads(data)
+    except ValueError:
+        return data.decode("utf-8", "replace")
+
+
+class RecordingResponse:
+    # Passes an upstream response through and notes when each piece arrived;
+    # the exchange is written to the tape when the response is closed.
+    def __init__(self, response, tape, entry, started):
+        self.response = response
+        self.status = response.status
+        self.headers = response.headers
+        self.tape = tape
+        self.entry = entry
+        self.started = started
+        self.chunks = []
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def read(self, *args):
+        return self.note(self.response.read(*args))
+
+    def readline(self):
+        return self.note(self.response.readline())
+
+    def note(self, data):
+        if data:
+            self.chunks.append([round((time.monotonic() - self.started) * 1000, 2), data.decode("utf-8", "replace")])
+        return data
+
+    def close(self):
+        self.response.close()
+        entry, self.entry = self.entry, None
+        if entry is not None:
+            self.tape.write(dict(entry, chunks=self.chunks))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AsyncRecordingResponse(RecordingResponse):
+    async def read(self, *args):
+        return self.note(await self.response.read(*args))
+
+    async def readline(self):
+        return self.note(await self.response.readline())
+
+
+class ReplayResponse:
+    # A recorded exchange played back through the response interface the
+    # proxy reads from, sleeping until each chunk's recorded offset.
+    def __init__(self, entry, latency):
+        self.status = int(entry.get("status") or 200)
+        self.headers = http.client.HTTPMessage()
+        if entry.get("contentType"):
+            self.headers["Content-Type"] = entry["contentType"]
+        self.latency = latency
+        self.headers_ms = entry.get("headersMs")
+        self.started = time.monotonic()
+        self._chunks = deque(entry.get("chunks") or [])
+        self._buffer = b""
+
+    def due(self, offset_ms):
+        if not self.latency:
+            return 0
+        return max(0.0, self.started + safe_number(offset_ms) / 1000 - time.monotonic())
+
+    def take(self):
+        offset, text = self._chunks.popleft()
+        return self.due(offset), text.encode("utf-8")
+
+    def read(self, *args):
+        while self._chunks:
+            delay, data = self.take()
+            time.sleep(delay)
+            self._buffer += data
+        data, self._buffer = self._buffer, b""
+        return data
+
+    def readline(self):
+        while b"\n" not in self._buffer and self._chunks:
+            delay, data = self.take()
+            time.sleep(delay)
+            self._buffer += data
+        return self.split_line()
+
+    def split_line(self):
+        index = self._buffer.find(b"\n")
+        if index < 0:
+            line, self._buffer = self._buffer, b""
+        else:
+            line, self._buffer = self._buffer[: index + 1], self._buffer[index + 1 :]
+        return line
+
+    def close(self):
+        self._chunks.clear()
+        self._buffer = b""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AsyncReplayResponse(ReplayResponse):
+    async def read(self, *args):
+        while self._chunks:
+            delay, data = self.take()
+            await asyncio.sleep(delay)
+            self._buffer += data
+        data, self._buffer = self._buffer, b""
+        return data
+
+    async def readline(self):
+        while b"\n" not in self._buffer and self._chunks:
+            delay, data = self.take()
+            await asyncio.sleep(delay)
+            self._buffer += data
+        return self.split_line()
+
+
+UPSTREAM_TAPE = UpstreamTape()
+
+
+def rate_limit_key(url, headers):
+    parts = urlsplit(url)
+    token = (headers or {}).get("Authorization", "")
+    return f"{(parts.hostname or '').lower()}#{hashlib.sha256(token.encode('utf-8')).hexdigest()[:8]}"
+
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(0.0, seconds), UPSTREAM_RETRY_AFTER_MAX)
+
+
+def retry_delay(attempt, retry_after):
+    # Full jitter, so throttled requests do not come back in lockstep; a
+    # Retry-After from the provider is a floor, not the whole wait.
+    jitter = random.uniform(0, min(UPSTREAM_BACKOFF_CAP, UPSTREAM_BACKOFF_BASE * 2**attempt))
+    return (retry_after or 0) + jitter
+
+
+UPSTREAM_LIMITER = UpstreamRateLimiter()
+
+
+class UpstreamConnectionPool:
+    # Idle keep-alive connections keyed by (scheme, host, port). A connection is
+    # owned by one handler thread while in use and only returns to the idle list
+    # after its response body has been fully read.
+    def __init__(self, max_idle=POOL_MAX_IDLE, idle_seconds=POOL_IDLE_SECONDS):
+        self.max_idle = max(0, max_idle)
+        self.idle_seconds = idle_seconds
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "retries": 0, "evicted": 0}
+
+    def open(self, method, url, body=None, headers=None, timeout=UPSTREAM_TIMEOUT):
+        key, target = upstream_pool_key(url)
+        conn, reused = self._acquire(key, timeout)
+        try:
+            return PooledResponse(self, key, conn, self._send(conn, method, target, body, headers, timeout))
+        except STALE_CONNECTION_ERRORS:
+            conn.close()
+            if not reused:
+                raise
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            raise
+        self._count("retries")
+        conn = self._connect(key, timeout)
+        try:
+            return PooledResponse(self, key, conn, self._send(conn, method, target, body, headers, timeout))
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            raise
+
+    def request(self, method, url, body=None, headers=None, timeout=UPSTREAM_TIMEOUT):
+        with self.open(method, url, body=body, headers=headers, timeout=timeout) as response:
+            return response.status, response.headers, response.read()
+
+    def warm(self, url, timeout=UPSTREAM_TIMEOUT):
+        # DNS, TCP and TLS for url's host now, parked as an idle connection.
+        key, _ = upstream_pool_key(url)
+        conn = self._connect(key, timeout)
+        try:
+            conn.connect()
+        except OSError:
+            conn.close()
+            raise
+        self._release(key, conn)
+
+    def stats(self):
+        with self._lock:
+            idle = sum(len(items) for items in self._idle.values())
+            counters = dict(self._counters)
+        lookups = counters["hits"] + counters["misses"]
+        counters["idle"] = idle
+        counters["hitRate"] = round(counters["hits"] / lookups, 4) if lookups else 0.0
+        return counters
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for items in idle.values():
+            for conn, _ in items:
+                conn.close()
+
+    def _send(self, conn, method, target, body, headers, timeout):
+        scope = UPSTREAM_CANCEL.get()
+        if conn.sock is None:
+            conn.connect()
+        conn.sock.settimeout(timeout)
+        if scope is not None:
+            scope.watch(conn)
+        conn.request(method, target, body=body, headers=headers or {})
+        return conn.getresponse()
+
+    def _acquire(self, key, timeout):
+        now = time.monotonic()
+        stale = []
+        conn = None
+        with self._lock:
+            items = self._idle.get(key, [])
+            while items:
+                candidate, last_used = items.pop()
+                if now - last_used > self.idle_seconds or not connection_is_alive(candidate):
+                    stale.append(candidate)
+                    continue
+                conn = candidate
+                break
+            self._counters["evicted"] += len(stale)
+            self._counters["hits" if conn is not None else "misses"] += 1
+        for candidate in stale:
+            candidate.close()
+        if conn is not None:
+            return conn, True
+        return self._connect(key, timeout), False
+
+    def _connect(self, key, timeout):
+        scheme, host, port = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=timeout)
+        return http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def _release(self, key, conn):
+        with self._lock:
+            items = self._idle.setdefault(key, [])
+            if len(items) < self.max_idle:
+                items.append((conn, time.monotonic()))
+                return
+            self._counters["evicted"] += 1
+        conn.close()
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+
+def upstream_pool_key(url):
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    if scheme not in {"http", "https"} or not parts.hostname:
+        raise URLError(f"unsupported URL: {url}")
+    key = (scheme, parts.hostname.lower(), parts.port or (443 if scheme == "https" else 80))
+    target = parts.path or "/"
+    if parts.query:
+        target = f"{target}?{parts.query}"
+    return key, target
+
+
+class PooledResponse:
+    # Wraps an http.client response; close() hands the connection back to the
+    # pool only when the body was fully consumed and the server keeps it open.
+    def __init__(self, pool, key, conn, response):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.headers = response.headers
+        self._closed = False
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+    def readline(self):
+        return self.response.readline()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self.response.isclosed() and self.conn.sock is not None:
+            self.pool._release(self.key, self.conn)
+            return
+        self.response.close()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def connection_is_alive(conn):
+    sock = conn.sock
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    # An idle keep-alive socket has nothing to read; readable means EOF or junk.
+    return not readable
+
+
+UPSTREAM_POOL = UpstreamConnectionPool()
+
+
+CURRENT_TRACE = contextvars.ContextVar("astro_chaos_trace", default=None)
+
+
+class RequestTrace:
+    def __init__(self, endpoint, bytes_in):
+        self.endpoint = endpoint
+        self.bytes_in = bytes_in
+        self.bytes_out = 0
+        self.status = None
+        self.started = time.perf_counter()
+        self.stages = {}
+
+
+class RequestMetrics:
+    # Latency histograms per endpoint and per stage, plus upstream, fallback
+    # and byte counters. Stages nest freely; the current request's trace is
+    # carried in a context variable so both engines share the instrumentation.
+    def __init__(self, slow_ms=SLOW_REQUEST_MS, buckets=METRIC_BUCKETS):
+        self.slow_ms = slow_ms
+        self.buckets = buckets
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._requests = {}
+        self._counters = {"upstreamStatus": {}, "upstreamRetries": {}, "formatRejected": {}, "formatUsed": {}, "aiValidation": {}}
+        self._bytes = {"in": 0, "out": 0, "upstreamIn": 0, "upstreamOut": 0}
+        self._slow = deque(maxlen=20)
+        self.inflight = 0
+
+    def begin(self, path, bytes_in=0):
+        endpoint = path if path in METRIC_ENDPOINTS else "other"
+        trace = RequestTrace(endpoint, bytes_in)
+        with self._lock:
+            self.inflight += 1
+        return trace, CURRENT_TRACE.set(trace)
+
+    def finish(self, trace, token):
+        CURRENT_TRACE.reset(token)
+        elapsed = time.perf_counter() - trace.started
+        status = str(trace.status or 0)
+        self.observe(("request", trace.endpoint), elapsed)
+        if trace.endpoint in FIRST_REACTION_ENDPOINTS and trace.status is not None and trace.status < 400:
+            STARTUP.first_reaction(trace.endpoint, elapsed)
+        with self._lock:
+            self.inflight -= 1
+            statuses = self._requests.setdefault(trace.endpoint, {})
+            statuses[status] = statuses.get(status, 0) + 1
+            self._bytes["in"] += trace.bytes_in
+            self._bytes["out"] += trace.bytes_out
+        if self.slow_ms and elapsed * 1000 >= self.slow_ms:
+            entry = {
+                "endpoint": trace.endpoint,
+                "status": trace.status,
+                "ms": round(elapsed * 1000, 1),
+                "stages": {name: round(value * 1000, 1) for name, value in trace.stages.items()},
+            }
+            with self._lock:
+                self._slow.append(entry)
+            breakdown = " ".join(f"{name}={value}ms" for name, value in entry["stages"].items())
+            print(f"[slow] {trace.endpoint} {status} {entry['ms']}ms {breakdown}")
+
+    def note_response(self, status, size):
+        trace = CURRENT_TRACE.get()
+        if trace is not None:
+            trace.status = int(status) if trace.status is None else trace.status
+            trace.bytes_out += size
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.observe(("stage", name), elapsed)
+            trace = CURRENT_TRACE.get()
+            if trace is not None:
+                trace.stages[name] = trace.stages.get(name, 0) + elapsed
+
+    def observe(self, key, seconds):
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {"buckets": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            index = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+            histogram["buckets"][index] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    def count(self, group, key):
+        with self._lock:
+            bucket = self._counters[group]
+            bucket[str(key)] = bucket.get(str(key), 0) + 1
+
+    def record_upstream(self, status, bytes_out, bytes_in):
+        self.count("upstreamStatus", status)
+        with self._lock:
+            self._bytes["upstreamOut"] += bytes_out
+            self._bytes["upstreamIn"] += bytes_in
+
+    def stats(self):
+        with self._lock:
+            histograms = {key: copy.deepcopy(value) for key, value in self._histograms.items()}
+            result = {
+                "uptimeSeconds": round(time.time() - self.started, 1),
+                "inflight": self.inflight,
+                "requests": copy.deepcopy(self._requests),
+                "bytes": dict(self._bytes),
+                **copy.deepcopy(self._counters),
+                "slowRequests": list(self._slow),
+            }
+        for family in ("request", "stage"):
+            result[f"{family}Latency"] = {
+                name: self.summarize_histogram(histogram)
+                for (kind, name), histogram in sorted(histograms.items())
+                if kind == family
+            }
+        result["tokens"] = PROMPT_USAGE.stats()
+        result["startup"] = STARTUP.stats()
+        return result
+
+    def summarize_histogram(self, histogram):
+        count = histogram["count"]
+        summary = {"count": count, "meanMs": round(histogram["sum"] / count * 1000, 2) if count else 0.0}
+        for label, fraction in (("p50Ms", 0.5), ("p95Ms", 0.95), ("p99Ms", 0.99)):
+            summary[label] = self.bucket_quantile(histogram, fraction)
+        return summary
+
+    def bucket_quantile(self, histogram, fraction):
+        # Upper bound of the bucket holding the quantile, as Prometheus would report.
+        target = histogram["count"] * fraction
+        seen = 0
+        for bound, count in zip(self.buckets, histogram["buckets"]):
+            seen += count
+            if count and seen >= target:
+                return bound * 1000
+        return None if histogram["count"] else 0.0
+
+    def prometheus(self):
+        stats = self.stats()
+        with self._lock:
+            histograms = {key: copy.deepcopy(value) for key, value in self._histograms.items()}
+        lines = [
+            "# TYPE astro_chaos_requests_total counter",
+            *(
+                f'astro_chaos_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}'
+                for endpoint, statuses in sorted(stats["requests"].items())
+                for status, count in sorted(statuses.items())
+            ),
+        ]
+        for family, label in (("request", "endpoint"), ("stage", "stage")):
+            name = f"astro_chaos_{family}_seconds"
+            lines.append(f"# TYPE {name} histogram")
+            for (kind, key), histogram in sorted(histograms.items()):
+                if kind != family:
+                    continue
+                cumulative = 0
+                for bound, count in zip((*self.buckets, "+Inf"), histogram["buckets"]):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{label}="{key}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{{label}="{key}"}} {histogram["sum"]:.6f}')
+                lines.append(f'{name}_count{{{label}="{key}"}} {histogram["count"]}')
+        for group, metric, label in (
+            ("upstreamStatus", "astro_chaos_upstream_responses_total", "status"),
+            ("upstreamRetries", "astro_chaos_upstream_retries_total", "status"),
+            ("formatRejected", "astro_chaos_format_rejections_total", "format"),
+            ("formatUsed", "astro_chaos_format_used_total", "format"),
+            ("aiValidation", "astro_chaos_ai_validation_issues_total", "issue"),
+        ):
+            lines.append(f"# TYPE {metric} counter")
+            lines.extend(f'{metric}{{{label}="{key}"}} {count}' for key, count in sorted(stats[group].items()))
+        lines.append("# TYPE astro_chaos_bytes_total counter")
+        lines.extend(f'astro_chaos_bytes_total{{direction="{key}"}} {count}' for key, count in stats["bytes"].items())
+        lines.append("# TYPE astro_chaos_tokens_total counter")
+        for kind, key in (("prompt", "promptTokens"), ("cached_prompt", "cachedPromptTokens"), ("completion", "completionTokens")):
+            lines.append(f'astro_chaos_tokens_total{{kind="{kind}"}} {stats["tokens"][key]}')
+        lines.extend(STARTUP.prometheus())
+        return "\n".join(lines) + "\n"
+
+
+METRICS = RequestMetrics()
+
+
+def metrics_response(target, accept):
+    query = urlsplit(target).query
+    if "format=prometheus" in query or ("text/plain" in (accept or "") and "format=json" not in query):
+        return METRICS.prometheus().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+    return json.dumps(METRICS.stats(), ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8"
+
+
+def collect_server_stats():
+    return {
+        "process": dict(PROCESS_INFO, pid=os.getpid()),
+        "upstreamPool": UPSTREAM_POOL.stats(),
+        "formatCapabilities": FORMAT_CAPABILITIES.stats(),
+        "modelsCache": MODELS_CACHE.stats(),
+        "reactionCache": REACTION_CACHE.stats(),
+        "prefetch": SPECULATIONS.stats(),
+        "staticAssets": STATIC_ASSETS.stats(),
+        "promptUsage": PROMPT_USAGE.stats(),
+        "sessions": SESSIONS.stats(),
+        "providers": PROVIDER_HEALTH.stats(),
+        "rateLimits": dict(UPSTREAM_LIMITER.stats(), **ASYNC_UPSTREAM_LIMITER.stats()),
+        "reactionCorpus": REACTION_CORPUS.stats(),
+        "upstreamTape": UPSTREAM_TAPE.stats(),
+        "eventNovelty": EVENT_NOVELTY.stats(),
+        "reactionJobs": REACTION_JOBS.stats(),
+        "startup": STARTUP.stats(),
+    }
+
+
+def request_openai_compatible_json(url, api_key, payload=None, method="POST"):
+    data = None if payload is None else json.dumps(payload).encode("utf-8")
+    status, raw = send_upstream_request(url, method, data, openai_headers(api_key))
+    if status >= 400:
+        raise upstream_http_error(status, raw)
+    return decode_upstream_json(raw)
+
+
+class UpstreamBusyError(RuntimeError):
+    # The provider is throttling this key (or our queue for it is full); the
+    # player should simply try again later rather than lose AI for the game.
+    pass
+
+
+def upstream_http_error(status, raw):
+    error = UpstreamBusyError if status == 429 else RuntimeError
+    return error(f"API HTTP {status}: {summarize_api_error(raw)}")
+
+
+def api_error_body(exc):
+    if isinstance(exc, UpstreamBusyError):
+        return {"error": str(exc), "retryable": True}
+    return {"error": str(exc)}
+
+
+def api_error_status(exc):
+    if isinstance(exc, UpstreamBusyError):
+        return HTTPStatus.TOO_MANY_REQUESTS
+    return HTTPStatus.SERVICE_UNAVAILABLE
+
+
+def openai_headers(api_key, accept="application/json"):
+    return {
+        "Authorization": f"Bearer {api_key}",
+        "Accept": accept,
+        "Content-Type": "application/json",
+        "User-Agent": "Astro-Chaos/1.0",
+    }
+
+
+def decode_upstream_json(raw):
+    try:
+        return json.loads(raw)
+    except json.JSONDecodeError as exc:
+        raise RuntimeError(f"API 返回非 JSON：{raw[:120]}") from exc
+
+
+def send_upstream_request(url, method, data, headers):
+    with METRICS.stage("upstream"):
+        response = open_limited_upstream(url, method, data, headers)
+        try:
+            raw = read_upstream_body(response)
+        finally:
+            response.close()
+    METRICS.record_upstream(response.status, len(data or b""), len(raw.encode("utf-8")))
+    return response.status, raw
+
+
+def open_limited_upstream(url, method, data, headers):
+    # Every upstream call takes a slot from its key's limiter first. 429 and
+    # 5xx answers are retried after Retry-After or a jittered backoff while the
+    # request's queue deadline allows; the slot is held until the returned
+    # response is closed.
+    if UPSTREAM_TAPE.mode == "replay":
+        return UPSTREAM_TAPE.open(url, method, data)
+    key = rate_limit_key(url, headers)
+    deadline = time.monotonic() + UPSTREAM_QUEUE_TIMEOUT
+    for attempt in range(UPSTREAM_RETRIES + 1):
+        with METRICS.stage("upstream_queue"):
+            started = UPSTREAM_LIMITER.acquire(key, deadline)
+        opened = time.monotonic()
+        try:
+            response = open_upstream(url, method, data, headers)
+        except RuntimeError:
+            UPSTREAM_LIMITER.release(key, started, None)
+            raise
+        status = response.status
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        delay = retry_delay(attempt, retry_after)
+        if status not in UPSTREAM_RETRY_STATUSES or attempt == UPSTREAM_RETRIES or time.monotonic() + delay > deadline:
+            limited = LimitedResponse(response, lambda: UPSTREAM_LIMITER.release(key, started, status, retry_after))
+            return UPSTREAM_TAPE.track(limited, url, method, data, opened)
+        try:
+            raw = read_upstream_body(response)
+        except RuntimeError:
+            raw = ""
+        finally:
+            response.close()
+            UPSTREAM_LIMITER.release(key, started, status, retry_after)
+        METRICS.record_upstream(status, len(data or b""), len(raw.encode("utf-8")))
+        METRICS.count("upstreamRetries", str(status))
+        backoff_sleep(delay)
+
+
+def backoff_sleep(seconds):
+    scope = UPSTREAM_CANCEL.get()
+    if scope is None:
+        time.sleep(seconds)
+    elif scope.wait(seconds):
+        raise RuntimeError("API 请求已取消。")
+
+
+def open_upstream(url, method, data, headers):
+    if uses_http_proxy(url):
+        try:
+            return urlopen(Request(url, data=data, headers=headers, method=method), timeout=UPSTREAM_TIMEOUT)
+        except HTTPError as exc:
+            return exc
+        except URLError as exc:
+            raise RuntimeError(f"API 网络错误: {exc.reason}") from exc
+    try:
+        return UPSTREAM_POOL.open(method, url, body=data, headers=headers)
+    except URLError as exc:
+        raise RuntimeError(f"API 网络错误: {exc.reason}") from exc
+    except (http.client.HTTPException, OSError) as exc:
+        raise RuntimeError(f"API 网络错误: {exc}") from exc
+
+
+def read_upstream_body(response):
+    try:
+        return response.read().decode("utf-8", "replace")
+    except (http.client.HTTPException, OSError) as exc:
+        raise RuntimeError(f"API 网络错误: {exc}") from exc
+
+
+def uses_http_proxy(url):
+    parts = urlsplit(url)
+    proxies = getproxies()
+    if parts.scheme.lower() not in proxies:
+        return False
+    return not proxy_bypass(parts.hostname or "")
+
+
+def normalize_models_response(response):
+    source = response.get("data") if isinstance(response, dict) else response
+    if not isinstance(source, list):
+        return []
+
+    models = []
+    seen = set()
+    for item in source:
+        if isinstance(item, str):
+            model_id = item.strip()
+            label = model_id
+        elif isinstance(item, dict):
+            model_id = str(item.get("id") or item.get("name") or "").strip()
+            label = str(item.get("display_name") or item.get("name") or model_id).strip()
+        else:
+            continue
+        if not model_id or model_id in seen:
+            continue
+        seen.add(model_id)
+        models.append({"id": model_id, "name": label or model_id})
+    return models
+
+
+def choose_model(models, current_model):
+    ids = [model["id"] for model in models]
+    if current_model in ids:
+        return current_model
+    for candidate in (DEFAULT_MODEL, "gpt-5.4", "gpt-5.4-mini", "gpt-5.2"):
+        if candidate in ids:
+            return candidate
+    text_like = [model_id for model_id in ids if "image" not in model_id.lower()]
+    return text_like[0] if text_like else ids[0]
+
+
+def summarize_api_error(raw):
+    try:
+        data = json.loads(raw)
+    except json.JSONDecodeError:
+        return raw[:180]
+    error = data.get("error") if isinstance(data, dict) else None
+    if isinstance(error, dict):
+        message = error.get("message") or error.get("type") or error
+        return str(message)
+    return json.dumps(data, ensure_ascii=False)[:180]
+
+
+def extract_responses_text(response):
+    if isinstance(response, str):
+        return response
+    if not isinstance(response, dict):
+        return str(response)
+    output_text = response.get("output_text")
+    if isinstance(output_text, str):
+        return output_text
+    parts = []
+    for item in response.get("output", []) or []:
+        for content in item.get("content", []) or []:
+            if isinstance(content, dict):
+                text = content.get("text")
+                if isinstance(text, str):
+                    parts.append(text)
+    if parts:
+        return "\n".join(parts)
+    return json.dumps(response, ensure_ascii=False)
+
+
+def extract_chat_text(response):
+    if isinstance(response, str):
+        return response
+    if isinstance(response, dict):
+        choices = response.get("choices") or []
+        if choices:
+            message = choices[0].get("message") or {}
+            content = message.get("content")
+            if isinstance(content, str):
+                return content
+        content = response.get("content")
+        return content if isinstance(content, str) else json.dumps(response, ensure_ascii=False)
+
+    choices = getattr(response, "choices", None)
+    if choices:
+        message = getattr(choices[0], "message", None)
+        content = getattr(message, "content", None)
+        if isinstance(content, str):
+            return content
+    content = getattr(response, "content", None)
+    return content if isinstance(content, str) else str(response)
+
+
+def normalize_base_url(base_url):
+    value = (base_url or "").strip().rstrip("/")
+    if not value:
+        return ""
+    if value.endswith("/v1"):
+        return value
+    return f"{value}/v1"
+
+
+def parse_ai_response(text):
+    data = decode_ai_json(text)
+    with METRICS.stage("normalize"):
+        return normalize_ai_reaction(data)
+
+
+def decode_ai_json(text):
+    raw = text.strip()
+    if not raw:
+        raise RuntimeError("AI 返回为空。")
+    lowered = raw[:80].lower()
+    if lowered.startswith("<!doctype") or lowered.startswith("<html"):
+        raise RuntimeError("AI 接口返回了 HTML 页面，请检查 Base URL 是否指向 OpenAI-compatible API 地址。")
+    with METRICS.stage("decode"):
+        data = decode_json_object(raw)
+    if data is None:
+        snippet = raw[:80].replace("\n", " ")
+        raise RuntimeError(f"AI 返回格式无效，未得到 JSON：{snippet}")
+    return data
+
+
+def normalize_ai_reaction(data):
+    result, issues = REACTION_VALIDATOR.validate(data)
+    record_validation_issues(issues)
+    return result
+
+
+def normalize_ai_event(event):
+    issues = []
+    result = REACTION_VALIDATOR.event(event, issues)
+    record_validation_issues(issues)
+    return result
+
+
+def clean_ai_line(line):
+    checked = REACTION_VALIDATOR.line(line, [])
+    return "" if checked is AI_DROP else checked
+
+
+def record_validation_issues(issues):
+    for path, reason, _ in issues:
+        METRICS.count("aiValidation", f"{path}:{reason}")
+
+
+def decode_json_object(raw, max_chars=JSON_SCAN_MAX_CHARS):
+    raw = raw[:max_chars]
+    for candidate in (raw.strip(), strip_code_fence(raw)):
+        if candidate.startswith("{"):
+            try:
+                data = json.loads(candidate)
+            except JSON_DECODE_ERRORS:
+                continue
+            if isinstance(data, dict):
+                return data
+    scanner = JsonObjectScanner(max_chars)
+    scanner.feed(raw)
+    return best_json_object(scanner)
+
+
+class JsonObjectScanner:
+    # One forward pass over (possibly streamed) model output that tracks string
+    # and brace state, recording every balanced {...} span. Text past
+    # max_chars is ignored, so a runaway reply cannot pin a worker.
+    def __init__(self, max_chars=JSON_SCAN_MAX_CHARS):
+        self.max_chars = max_chars
+        self.text = ""
+        self.spans = {}
+        self.top_level = []
+        self.exhausted = False
+        self._pos = 0
+        self._stack = []
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, chunk):
+        if self.exhausted:
+            return []
+        room = self.max_chars - len(self.text)
+        if len(chunk) > room:
+            chunk = chunk[:room]
+            self.exhausted = True
+        self.text += chunk
+        known = len(self.top_level)
+        self._scan()
+        return self.top_level[known:]
+
+    def _scan(self):
+        text, pos, end = self.text, self._pos, len(self.text)
+        while pos < end:
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                    pos += 1
+                    continue
+                match = JSON_STRING_END.search(text, pos)
+                if match is None:
+                    pos = end
+                    break
+                pos = match.end()
+                if match.group() == "\\":
+                    self._escaped = True
+                else:
+                    self._in_string = False
+                continue
+            match = JSON_STRUCTURE.search(text, pos)
+            if match is None:
+                pos = end
+                break
+            char, pos = match.group(), match.end()
+            if char == "{":
+                self._stack.append(match.start())
+            elif char == "}":
+                if self._stack:
+                    start = self._stack.pop()
+                    self.spans[start] = pos
+                    if not self._stack:
+                        self.top_level.append((start, pos))
+            elif self._stack:
+                # Quotes only open strings inside an object; prose may use them freely.
+                self._in_string = True
+        self._pos = pos
+
+    def plausible(self, start):
+        return start in self.spans and JSON_OBJECT_START.match(self.text, start) is not None
+
+    def decode(self, start):
+        if not self.plausible(start):
+            return None
+        end = self.spans[start]
+        try:
+            data = json.loads(self.text[start:end])
+        except JSON_DECODE_ERRORS:
+            return None
+        return data if isinstance(data, dict) else None
+
+
+def best_json_object(scanner):
+    # Top-level objects first, then nested ones (a stray "{" in the prose can
+    # swallow the real reply), then raw_decode from each '{"' in case stray
+    # quotes confused the scanner. Every stage shares one work budget
+    # proportional to the text, and the most reply-shaped object wins.
+    budget = JSON_SCAN_WORK_FACTOR * len(scanner.text) + 4096
+    best, best_score = None, -1
+    for start, end in scanner.top_level:
+        budget -= end - start
+        data = scanner.decode(start)
+        if data is not None and json_shape_score(data) > best_score:
+            best, best_score = data, json_shape_score(data)
+    if best is not None:
+        return best
+
+    for start in sorted(scanner.spans):
+        if budget <= 0:
+            return best
+        if not scanner.plausible(start):
+            continue
+        budget -= scanner.spans[start] - start
+        data = scanner.decode(start)
+        if data is not None and json_shape_score(data) > best_score:
+            best, best_score = data, json_shape_score(data)
+    if best is not None:
+        return best
+
+    decoder = json.JSONDecoder()
+    text = scanner.text
+    for match in JSON_OBJECT_START.finditer(text):
+        if budget <= 0:
+            break
+        # Decoding a suffix costs its length (JSONDecodeError also counts
+        # lines up to the failure), so charge the whole suffix.
+        budget -= len(text) - match.start()
+        try:
+            data, _ = decoder.raw_decode(text[match.start():])
+        except JSON_DECODE_ERRORS:
+            continue
+        if isinstance(data, dict) and json_shape_score(data) > best_score:
+            best, best_score = data, json_shape_score(data)
+    return best
+
+
+def json_shape_score(data):
+    return sum(1 for key in RESPONSE_SHAPE_KEYS if key in data)
+
+
+def strip_code_fence(raw):
     lines = raw.strip().splitlines()
     if lines and lines[0].strip().startswith("```"):
         lines = lines[1:]
@@ -486,105 +4045,1768 @@ def strip_code_fence(raw):
     return "\n".join(lines).strip()
 
 
-def normalize_ai_event(event):
-    if not isinstance(event, dict):
+def safe_number(value):
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+class SchemaNode:
+    # One field of AI_RESPONSE_SCHEMA as ReactionValidator walks it.
+    __slots__ = (
+        "path", "check", "nullable", "object", "rule", "plain",
+        "names", "known", "fields", "reordered", "required", "prefix",
+        "item", "min_items", "max_items", "limit", "choices",
+    )
+
+    def __init__(self, path, check, nullable, rule):
+        self.path = path
+        self.check = check
+        self.nullable = nullable
+        self.rule = rule
+        self.object = False
+        self.plain = None
+        self.limit = None
+        self.choices = frozenset()
+
+
+class ReactionValidator:
+    # Checks, coerces and repairs a decoded reply in one walk over
+    # AI_RESPONSE_SCHEMA, collecting (path, reason, detail) issues on the way.
+    # The schema is flattened once into a SchemaNode per field path; each
+    # node names the check for its type plus what that check needs. What the
+    # schema cannot express -- length limits, guidance filtering, kind
+    # inference and the mixed-effect rules for events -- hangs off the
+    # matching path in AI_FIELD_RULES and runs on the coerced value.
+    def __init__(self, schema, rules, gates=()):
+        self.rules = rules
+        self.gates = frozenset(gates)
+        self.checks = {
+            "object": self.check_object,
+            "array": self.check_array,
+            "string": self.check_string,
+            "number": self.check_number,
+        }
+        self.nodes = {}
+        self.root = self.index(schema, "")
+
+    def index(self, schema, path):
+        nullable = "anyOf" in schema
+        if nullable:
+            # The schema only uses anyOf for "X or null".
+            schema = next(option for option in schema["anyOf"] if option.get("type") != "null")
+        kind = schema["type"]
+        node = SchemaNode(path, self.checks[kind], nullable, self.rules.get(path))
+        if kind == "object":
+            prefix = f"{path}." if path else ""
+            # A gate field that comes out empty voids the whole object, so it
+            # is checked first and the remaining fields are only walked behind it.
+            names = sorted(schema["properties"], key=lambda name: prefix + name not in self.gates)
+            node.object = True
+            node.names = tuple(schema["properties"])
+            node.known = frozenset(schema["properties"])
+            node.required = sorted(schema.get("required", ()))
+            node.prefix = prefix
+            node.fields = [
+                (name, self.index(schema["properties"][name], prefix + name), prefix + name in self.gates)
+                for name in names
+            ]
+            node.reordered = tuple(names) != node.names
+        elif kind == "array":
+            node.item = self.index(schema["items"], f"{path}[]")
+            node.min_items = schema.get("minItems", 0)
+            node.max_items = schema.get("maxItems")
+        elif kind == "string":
+            node.limit = AI_FIELD_LIMITS.get(path)
+            node.choices = frozenset(schema.get("enum", ()))
+        # Scalars with nothing beyond their type check; a well-typed value of
+        # one of these is taken as is without a full walk.
+        if (
+            kind in ("string", "number")
+            and not nullable
+            and node.rule is None
+            and node.limit is None
+            and not node.choices
+            and path not in self.gates
+        ):
+            node.plain = kind
+        self.nodes[path] = node
+        return node
+
+    def validate(self, data):
+        issues = []
+        return self.walk(self.root, data, issues), issues
+
+    def event(self, value, issues):
+        return self.walk(self.nodes["event"], value, issues)
+
+    def line(self, value, issues):
+        return self.walk(self.nodes["lines[]"], value, issues)
+
+    def walk(self, node, value, issues):
+        if not node.nullable:
+            result = node.check(node, value, issues)
+        elif value is None:
+            result = None
+        elif node.object and not isinstance(value, dict):
+            # A wrong-typed object becomes null; other values are coerced.
+            issues.append((node.path, "type", type(value).__name__))
+            result = None
+        else:
+            result = node.check(node, value, issues)
+        if node.rule is not None:
+            result = node.rule(result, value, issues)
+        return result
+
+    def check_object(self, node, value, issues):
+        if not isinstance(value, dict):
+            if value is not None:
+                issues.append((node.path, "type", type(value).__name__))
+            value = {}
+        elif value.keys() != node.known:
+            for name in node.required:
+                if name not in value:
+                    issues.append((node.prefix + name, "missing", ""))
+            for name in value.keys() - node.known:
+                issues.append((node.prefix + str(name), "unknown", ""))
+        result = {}
+        for name, field, gate in node.fields:
+            raw = value.get(name)
+            plain = field.plain
+            if plain == "number":
+                if type(raw) is int or type(raw) is float and raw - raw == 0:
+                    result[name] = float(raw)
+                    continue
+            elif plain == "string" and type(raw) is str:
+                result[name] = raw.strip()
+                continue
+            result[name] = checked = self.walk(field, raw, issues)
+            if gate and not checked:
+                issues.append((field.path, "empty", ""))
+                return None
+        if node.reordered:
+            return {name: result[name] for name in node.names}
+        return result
+
+    def check_array(self, node, value, issues):
+        if isinstance(value, str):
+            issues.append((node.path, "type", "str"))
+            value = [value]
+        elif not isinstance(value, list):
+            if value is not None:
+                issues.append((node.path, "type", type(value).__name__))
+            value = []
+        item, max_items = node.item, node.max_items
+        result = []
+        for index, raw in enumerate(value):
+            if len(result) == max_items:
+                issues.append((node.path, "maxItems", str(len(value) - index)))
+                break
+            checked = self.walk(item, raw, issues)
+            if checked is not AI_DROP:
+                result.append(checked)
+        if len(result) < node.min_items:
+            issues.append((node.path, "minItems", str(len(result))))
+        return result
+
+    def check_string(self, node, value, issues):
+        if type(value) is str:
+            text = value.strip()
+        elif value is None:
+            text = ""
+        else:
+            issues.append((node.path, "type", type(value).__name__))
+            text = str(value).strip() if value else ""
+        if node.limit is not None and len(text) > node.limit:
+            issues.append((node.path, "maxLength", str(len(text))))
+            text = text[:node.limit]
+        if node.choices and text not in node.choices:
+            if text.lower() in node.choices:
+                return text.lower()
+            if text:
+                issues.append((node.path, "enum", text[:20]))
+            return ""
+        return text
+
+    def check_number(self, node, value, issues):
+        if type(value) is int or type(value) is float and math.isfinite(value):
+            return float(value)
+        if value is not None:
+            issues.append((node.path, "type", type(value).__name__))
+        try:
+            number = float(value or 0)
+        except (TypeError, ValueError):
+            number = 0.0
+        if not math.isfinite(number):
+            issues.append((node.path, "nonFinite", str(number)))
+            number = 0.0
+        return number
+
+
+def check_ai_line(line, raw, issues):
+    # A line that is blank, or reads like advice, is dropped rather than
+    # shown to the player.
+    if raw is None or isinstance(raw, (dict, list)):
+        if raw is None:
+            issues.append(("lines[]", "type", "NoneType"))
+        return AI_DROP
+    if not line:
+        issues.append(("lines[]", "empty", ""))
+        return AI_DROP
+    if GUIDANCE_PATTERN.search(line):
+        issues.append(("lines[]", "guidance", line[:20]))
+        return AI_DROP
+    if len(line) > AI_LINE_MAX_CHARS:
+        issues.append(("lines[]", "maxLength", str(len(line))))
+        return line[:AI_LINE_MAX_CHARS]
+    return line
+
+
+def check_ai_lines(lines, raw, issues):
+    return lines or [AI_LINE_FALLBACK]
+
+
+def check_ai_event(event, raw, issues):
+    if event is None:
+        return None
+    event["title"] = event["title"] or AI_EVENT_DEFAULT_TITLE
+    kind = event["kind"]
+    if not kind and not raw.get("kind"):
+        kind = str(raw.get("type") or "").strip().lower()
+    if kind not in AI_EVENT_KINDS:
+        kind = "passive" if raw.get("passive") is True else "optional"
+    if kind == "optional" and looks_like_passive_event(event["title"], event["text"]):
+        issues.append(("event.kind", "passiveWording", ""))
+        kind = "passive"
+    event["kind"] = kind
+    event["target"] = event["target"] if raw.get("target") else None
+    repair_mixed_effects(kind, event["effects"], issues)
+    return event
+
+
+def repair_mixed_effects(kind, effects, issues):
+    # Optional events must offer something; passive ones must cut both ways.
+    # Culture is counted apart because the repair may raise it to 1.
+    attrs = effects["attrs"]
+    culture = attrs["culture"]
+    benefit = (
+        attrs["theory"] > 0 or attrs["observe"] > 0 or attrs["practice"] > 0 or culture > 0
+        or effects["money"] > 0 or effects["morale"] > 0 or effects["equipment"] > 0 or effects["stress"] < 0
+    )
+    penalty = (
+        attrs["theory"] < 0 or attrs["observe"] < 0 or attrs["practice"] < 0
+        or effects["money"] < 0 or effects["morale"] < 0 or effects["equipment"] < 0 or effects["stress"] > 0
+    )
+    if not benefit:
+        issues.append(("event.effects", "noBenefit", kind))
+        attrs["culture"] = max(culture, 1)
+        if kind == "optional":
+            effects["stress"] = max(effects["stress"], 1)
+    if kind == "passive" and not (penalty or attrs["culture"] < 0):
+        issues.append(("event.effects", "noPenalty", kind))
+        effects["stress"] = max(effects["stress"], 1)
+
+
+def looks_like_passive_event(title, text):
+    return PASSIVE_EVENT_PATTERN.search(title) is not None or PASSIVE_EVENT_PATTERN.search(text) is not None
+
+
+AI_DROP = object()
+AI_FIELD_RULES = {"lines[]": check_ai_line, "lines": check_ai_lines, "event": check_ai_event}
+REACTION_VALIDATOR = ReactionValidator(AI_RESPONSE_SCHEMA, AI_FIELD_RULES, gates=("event.text",))
+
+
+def situation_key(trigger, state):
+    # Coarse description of the situation a reaction was written for: which
+    # kind of trigger, the upcoming contest, the weather and banded numbers.
+    state = state if isinstance(state, dict) else {}
+    trigger = str(trigger or "")
+    if "刚刚结束" in trigger or "晋级" in trigger:
+        phase = "contest"
+    elif "刚执行了" in trigger:
+        phase = "plan"
+    else:
+        phase = "other"
+    contest, _, when = str(state.get("nextContest") or "").partition("（")
+    contest = "" if contest.strip() == "无" else contest.strip()
+    weeks = CONTEST_WEEKS.match(when)
+    soon = bool(contest) and ("本周" in when or (weeks is not None and int(weeks.group(1)) <= 2))
+    honors = set()
+    for student in state.get("students") or []:
+        if isinstance(student, dict) and isinstance(student.get("honors"), list):
+            honors.update(str(honor) for honor in student["honors"])
+    return (
+        phase,
+        contest,
+        soon,
+        str(state.get("weather") or ""),
+        feature_band(state.get("money"), (0, 800, 3000)),
+        feature_band(state.get("avgStress"), (35, 55, 75)),
+        feature_band(state.get("quitCount"), (1, 3)),
+        max((CORPUS_HONORS.index(honor) + 1 for honor in honors if honor in CORPUS_HONORS), default=0),
+    )
+
+
+def feature_band(value, bounds):
+    value = safe_number(value)
+    return sum(1 for bound in bounds if value >= bound)
+
+
+def situation_distance(query, key):
+    # Weighted per-feature distance; banded features count how many bands
+    # apart they are, and a feature the corpus entry leaves open costs half.
+    total = 0.0
+    for name, wanted, have in zip(CORPUS_FEATURES, query, key):
+        weight = CORPUS_WEIGHTS[name]
+        if have is None:
+            total += weight / 2
+        elif name in CORPUS_ORDINAL_FEATURES:
+            total += weight * abs(wanted - have)
+        elif wanted != have:
+            total += weight
+    return total
+
+
+class ReactionCorpus:
+    # Local reactions served when the model misses a request's latency
+    # budget: the hand-written seed file plus reactions the model produced
+    # earlier, bucketed by situation_key. A lookup picks the nearest bucket
+    # (memoized per key until buckets change) and rotates through it. Learned
+    # buckets are LRU-bounded and appended to a JSONL file that is replayed
+    # on startup; seed entries are never evicted. The file is written (and
+    # compacted) by a background thread, never on the request path.
+    def __init__(self, seed_path=CORPUS_SEED_FILE, path=CORPUS_FILE, limit=CORPUS_SIZE, per_key=CORPUS_PER_KEY):
+        self.limit = max(0, limit)
+        self.per_key = max(1, per_key)
+        self.log_path = Path(path) if path else None
+        self._seed = {}
+        self._learned = OrderedDict()
+        self._nearest = {}
+        self._size = 0
+        self._log_lines = 0
+        self._pending = []
+        self._handle = None
+        self._writer = None
+        self._wake = threading.Event()
+        self._lookup_seconds = 0.0
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._counters = {"lookups": 0, "served": 0, "empty": 0, "learned": 0, "evicted": 0}
+        self._load_seed(Path(seed_path))
+        self._load()
+
+    def lookup(self, request):
+        started = time.perf_counter()
+        query = situation_key(request["trigger"], request["state"])
+        with self._lock:
+            self._counters["lookups"] += 1
+            key = self._nearest.get(query)
+            if key is None:
+                key = self._nearest_locked(query)
+                if len(self._nearest) >= CORPUS_MEMO_LIMIT:
+                    self._nearest.clear()
+                self._nearest[query] = key
+            bucket = self._learned.get(key) or self._seed.get(key)
+            if bucket is None:
+                self._counters["empty"] += 1
+                self._lookup_seconds += time.perf_counter() - started
+                return None
+            if key in self._learned:
+                self._learned.move_to_end(key)
+            reaction = bucket["reactions"][bucket["next"] % len(bucket["reactions"])]
+            bucket["next"] += 1
+            self._counters["served"] += 1
+            self._lookup_seconds += time.perf_counter() - started
+        event = copy.deepcopy(reaction["event"]) if request["mode"] == "events" else None
+        return {"lines": list(reaction["lines"]), "event": event, "source": "corpus"}
+
+    def learn(self, request, result):
+        if self.limit <= 0 or not isinstance(result, dict):
+            return
+        # Lines that name a student, and events aimed at one, only make sense
+        # for that roster.
+        state = request["state"] if isinstance(request["state"], dict) else {}
+        names = [str(student.get("name")) for student in state.get("students") or [] if isinstance(student, dict) and student.get("name")]
+        lines = [line for line in result.get("lines") or [] if isinstance(line, str) and not any(name in line for name in names)]
+        if not lines:
+            return
+        event = result.get("event")
+        if not isinstance(event, dict) or event.get("target"):
+            event = None
+        entry = {"lines": lines, "event": event}
+        key = situation_key(request["trigger"], request["state"])
+        with self._lock:
+            if not self._add_locked(key, entry):
+                return
+            self._counters["learned"] += 1
+            if self.log_path is None:
+                return
+            self._pending.append(json.dumps({"key": list(key), **entry}, ensure_ascii=False) + "\n")
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="corpus-writer", daemon=True)
+                self._writer.start()
+        self._wake.set()
+
+    def flush(self):
+        with self._io_lock:
+            with self._lock:
+                if not self._pending or self.log_path is None:
+                    return
+                path = self.log_path
+                lines, self._pending = self._pending, []
+                compact = self._log_lines + len(lines) > 2 * self.limit
+                if compact:
+                    lines = [
+                        json.dumps({"key": list(key), **entry}, ensure_ascii=False) + "\n"
+                        for key, bucket in self._learned.items()
+                        for entry in bucket["reactions"]
+                    ]
+                    self._log_lines = len(lines)
+                else:
+                    self._log_lines += len(lines)
+            try:
+                if compact:
+                    self._close_handle()
+                    temp_path = path.with_name(f"{path.name}.tmp")
+                    temp_path.write_text("".join(lines), encoding="utf-8")
+                    os.replace(temp_path, path)
+                    return
+                if self._handle is None:
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    self._handle = path.open("a", encoding="utf-8")
+                self._handle.write("".join(lines))
+                self._handle.flush()
+            except OSError as exc:
+                print(f"[server] 无法写入反应语料 {path}: {exc}")
+
+    def close(self):
+        self.flush()
+        with self._io_lock:
+            self._close_handle()
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            counters["seedBuckets"] = len(self._seed)
+            counters["learnedBuckets"] = len(self._learned)
+            counters["learnedReactions"] = self._size
+            lookups = counters["lookups"]
+            counters["avgLookupUs"] = round(self._lookup_seconds / lookups * 1e6, 2) if lookups else 0.0
+        return counters
+
+    def _nearest_locked(self, query):
+        candidates = [key for key in (*self._seed, *self._learned) if key[0] in (query[0], None)]
+        if not candidates:
+            candidates = [*self._seed, *self._learned]
+        return min(candidates, key=lambda key: situation_distance(query, key), default=None)
+
+    def _add_locked(self, key, entry):
+        bucket = self._learned.get(key)
+        if bucket is None:
+            bucket = self._learned[key] = {"reactions": deque(maxlen=self.per_key), "next": 0}
+            self._nearest.clear()
+        elif entry in bucket["reactions"]:
+            return False
+        self._learned.move_to_end(key)
+        if len(bucket["reactions"]) == self.per_key:
+            self._size -= 1
+            self._counters["evicted"] += 1
+        bucket["reactions"].append(entry)
+        self._size += 1
+        while self._size > self.limit:
+            oldest_key, oldest = next(iter(self._learned.items()))
+            oldest["reactions"].popleft()
+            self._size -= 1
+            self._counters["evicted"] += 1
+            if not oldest["reactions"]:
+                del self._learned[oldest_key]
+                self._nearest.clear()
+        return True
+
+    def use_worker_file(self, index):
+        if self.log_path is None:
+            return
+        with self._io_lock:
+            self._close_handle()
+            with self._lock:
+                self.log_path = worker_file(self.log_path, index)
+                self._log_lines = 0
+                self._pending = []
+                # Threads do not survive fork; the worker starts its own.
+                self._writer = None
+                self._load()
+
+    def _write_loop(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            self.flush()
+
+    def _close_handle(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def _load_seed(self, path):
+        try:
+            entries = json.loads(path.read_text(encoding="utf-8")).get("entries") or []
+        except (OSError, ValueError, AttributeError) as exc:
+            print(f"[server] 无法读取预置反应语料 {path}: {exc}")
+            return
+        for item in entries:
+            if not isinstance(item, dict) or not isinstance(item.get("when"), dict):
+                continue
+            reaction, _ = REACTION_VALIDATOR.validate({"lines": item.get("lines"), "event": item.get("event")})
+            if reaction["lines"] == [AI_LINE_FALLBACK]:
+                continue
+            key = tuple(item["when"].get(name) for name in CORPUS_FEATURES)
+            bucket = self._seed.setdefault(key, {"reactions": [], "next": 0})
+            bucket["reactions"].append(reaction)
+
+    def _load(self):
+        if self.log_path is None or not self.log_path.exists():
+            return
+        try:
+            with self.log_path.open(encoding="utf-8") as handle:
+                for line in handle:
+                    self._log_lines += 1
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if not isinstance(record, dict) or not isinstance(record.get("key"), list):
+                        continue
+                    if len(record["key"]) != len(CORPUS_FEATURES) or not isinstance(record.get("lines"), list):
+                        continue
+                    self._add_locked(tuple(record["key"]), {"lines": record["lines"], "event": record.get("event")})
+        except OSError as exc:
+            print(f"[server] 无法读取反应语料 {self.log_path}: {exc}")
+
+
+REACTION_CORPUS = ReactionCorpus()
+BUDGET_EXECUTOR = ThreadPoolExecutor(max_workers=BUDGET_WORKERS, thread_name_prefix="astro-chaos-budget")
+
+
+class AsyncUpstreamPool:
+    # asyncio counterpart of UpstreamConnectionPool used by the asyncio engine.
+    def __init__(self, max_idle=POOL_MAX_IDLE, idle_seconds=POOL_IDLE_SECONDS):
+        self.max_idle = max(0, max_idle)
+        self.idle_seconds = idle_seconds
+        self._idle = {}
+        self._ssl_context = None
+        self._counters = {"hits": 0, "misses": 0, "retries": 0, "evicted": 0}
+
+    async def open(self, method, url, body=None, headers=None, timeout=UPSTREAM_TIMEOUT):
+        key, target = upstream_pool_key(url)
+        stream, reused = self._acquire(key)
+        if stream is None:
+            stream = await self._connect(key, timeout)
+        try:
+            return await self._send(stream, key, method, target, body, headers, timeout)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            stream[1].close()
+            if not reused:
+                raise
+        except BaseException:
+            stream[1].close()
+            raise
+        self._counters["retries"] += 1
+        stream = await self._connect(key, timeout)
+        try:
+            return await self._send(stream, key, method, target, body, headers, timeout)
+        except BaseException:
+            stream[1].close()
+            raise
+
+    async def warm(self, url, timeout=UPSTREAM_TIMEOUT):
+        key, _ = upstream_pool_key(url)
+        self._release(key, await self._connect(key, timeout))
+
+    def stats(self):
+        counters = dict(self._counters)
+        lookups = counters["hits"] + counters["misses"]
+        counters["idle"] = sum(len(items) for items in self._idle.values())
+        counters["hitRate"] = round(counters["hits"] / lookups, 4) if lookups else 0.0
+        return counters
+
+    def close(self):
+        idle, self._idle = self._idle, {}
+        for items in idle.values():
+            for (_, writer), _ in items:
+                writer.close()
+
+    async def _send(self, stream, key, method, target, body, headers, timeout):
+        reader, writer = stream
+        scheme, host, port = key
+        default_port = 443 if scheme == "https" else 80
+        lines = [f"{method} {target} HTTP/1.1", f"Host: {host if port == default_port else f'{host}:{port}'}"]
+        lines.extend(f"{name}: {value}" for name, value in (headers or {}).items())
+        lines.append(f"Content-Length: {len(body or b'')}")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body or b""))
+        await asyncio.wait_for(writer.drain(), timeout)
+
+        while True:
+            status_line = await asyncio.wait_for(reader.readline(), timeout)
+            if not status_line:
+                raise ConnectionResetError("upstream closed the connection")
+            raw_headers = b""
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                raw_headers += line
+            status = int(status_line.split()[1])
+            if status != 100:
+                break
+        return AsyncUpstreamResponse(self, key, stream, status, http.client.parse_headers(io.BytesIO(raw_headers)), timeout)
+
+    def _acquire(self, key):
+        now = time.monotonic()
+        items = self._idle.get(key, [])
+        while items:
+            stream, last_used = items.pop()
+            if now - last_used > self.idle_seconds or stream[0].at_eof():
+                stream[1].close()
+                self._counters["evicted"] += 1
+                continue
+            self._counters["hits"] += 1
+            return stream, True
+        self._counters["misses"] += 1
+        return None, False
+
+    async def _connect(self, key, timeout):
+        scheme, host, port = key
+        context = None
+        if scheme == "https":
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            context = self._ssl_context
+        return await asyncio.wait_for(asyncio.open_connection(host, port, ssl=context), timeout)
+
+    def _release(self, key, stream):
+        items = self._idle.setdefault(key, [])
+        if len(items) < self.max_idle:
+            items.append((stream, time.monotonic()))
+            return
+        self._counters["evicted"] += 1
+        stream[1].close()
+
+
+class AsyncUpstreamResponse:
+    def __init__(self, pool, key, stream, status, headers, timeout):
+        self.pool = pool
+        self.key = key
+        self.stream = stream
+        self.status = status
+        self.headers = headers
+        self.timeout = timeout
+        self._chunked = "chunked" in headers.get("Transfer-Encoding", "").lower()
+        length = headers.get("Content-Length")
+        self._remaining = int(length) if length and not self._chunked else None
+        self._keep_alive = headers.get("Connection", "").lower() != "close" and (self._chunked or self._remaining is not None)
+        self._buffer = b""
+        self._eof = False
+        self._closed = False
+
+    async def read(self):
+        while not self._eof:
+            await self._fill()
+        data, self._buffer = self._buffer, b""
+        return data
+
+    async def readline(self):
+        while b"\n" not in self._buffer and not self._eof:
+            await self._fill()
+        index = self._buffer.find(b"\n")
+        if index < 0:
+            line, self._buffer = self._buffer, b""
+        else:
+            line, self._buffer = self._buffer[: index + 1], self._buffer[index + 1 :]
+        return line
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._eof and not self._buffer and self._keep_alive:
+            self.pool._release(self.key, self.stream)
+        else:
+            self.stream[1].close()
+
+    async def _fill(self):
+        reader = self.stream[0]
+        if self._chunked:
+            size_line = await asyncio.wait_for(reader.readline(), self.timeout)
+            if not size_line:
+                raise ConnectionResetError("upstream closed the connection")
+            size = int(size_line.split(b";")[0].strip() or b"0", 16)
+            if size == 0:
+                while await asyncio.wait_for(reader.readline(), self.timeout) not in (b"\r\n", b"\n", b""):
+                    pass
+                self._eof = True
+                return
+            self._buffer += await asyncio.wait_for(reader.readexactly(size + 2), self.timeout)
+            self._buffer = self._buffer[:-2]
+        elif self._remaining is not None:
+            if self._remaining <= 0:
+                self._eof = True
+                return
+            data = await asyncio.wait_for(reader.read(min(65536, self._remaining)), self.timeout)
+            if not data:
+                raise ConnectionResetError("upstream closed the connection")
+            self._remaining -= len(data)
+            self._buffer += data
+        else:
+            data = await asyncio.wait_for(reader.read(65536), self.timeout)
+            if not data:
+                self._eof = True
+            self._buffer += data
+
+
+ASYNC_UPSTREAM_POOL = AsyncUpstreamPool()
+
+
+class AsyncUpstreamRateLimiter(UpstreamRateLimiter):
+    # Same per-key limits for the asyncio engine; waiters park on futures that
+    # release() wakes, and are only touched from the event loop thread.
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._waiters = []
+
+    async def acquire(self, key, deadline):
+        state = self._state(key)
+        self._admit(state)
+        state.waiting += 1
+        try:
+            while True:
+                now = time.monotonic()
+                delay = state.ready_in(now)
+                if delay == 0:
+                    return state.take(now)
+                remaining = self._remaining(state, deadline, now)
+                waiter = asyncio.get_running_loop().create_future()
+                self._waiters.append(waiter)
+                try:
+                    await asyncio.wait_for(waiter, remaining if delay is None else min(delay, remaining))
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+        finally:
+            state.waiting -= 1
+
+    def release(self, key, started, status, retry_after=None):
+        self._state(key).finish(time.monotonic(), started, status, retry_after)
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def stats(self):
+        now = time.monotonic()
+        return {key: state.stats(now) for key, state in self._states.items()}
+
+
+ASYNC_UPSTREAM_LIMITER = AsyncUpstreamRateLimiter()
+# Generations that outlived their latency budget; asyncio only keeps weak
+# references to running tasks.
+LATE_REACTIONS = set()
+
+
+async def async_build_ai_reaction(payload):
+    with METRICS.stage("prepare"):
+        request = prepare_ai_request(payload)
+    with METRICS.stage("cache_lookup"):
+        result = lookup_cached_reaction(request)
+    if result is None:
+        with METRICS.stage("prefetch_claim"):
+            result = await async_claim_speculation(request)
+        if result is None:
+            with METRICS.stage("generate"):
+                result = await async_generate_within_budget(request)
+        remember_reaction(request, result)
+    return reaction_response(request, result)
+
+
+async def async_build_ai_reaction_batch(payload):
+    requests = prepare_batch_requests(payload)
+    results = [lookup_cached_reaction(request) for request in requests]
+    pending = [index for index, result in enumerate(results) if result is None]
+    if pending:
+        futures = SPECULATIONS.take_all([requests[index] for index in pending])
+        claimed = await asyncio.gather(*(async_speculation_result(future) for future in futures))
+        pending = claim_batch_speculations(requests, results, pending, claimed)
+    if pending:
+        try:
+            fresh = await async_generate_ai_reaction_batch([requests[index] for index in pending])
+        except BatchReplyError:
+            fresh = await asyncio.gather(*(async_generate_reaction_or_error(requests[index]) for index in pending))
+        for index, result in zip(pending, fresh):
+            results[index] = result
+            if "error" not in result:
+                remember_reaction(requests[index], result)
+    return batch_response(requests, results)
+
+
+async def async_generate_ai_reaction_batch(requests):
+    if len(requests) == 1:
+        return [await async_generate_ai_reaction(requests[0])]
+    return await async_hedged_call(
+        requests[0]["providers"],
+        lambda provider: async_request_ai_reaction_batch([with_provider(request, provider) for request in requests]),
+    )
+
+
+async def async_request_ai_reaction_batch(requests):
+    url, payloads = batch_request_payloads(requests)
+    try:
+        data = await async_post_with_fallbacks(url, requests[0]["api_key"], payloads, capability_key=requests[0]["capability_key"])
+    except RuntimeError as exc:
+        raise batch_rejection(exc)
+    PROMPT_USAGE.record_usage(response_usage(data))
+    return read_batch_reply(data, requests)
+
+
+async def async_generate_reaction_or_error(request):
+    try:
+        return await async_generate_ai_reaction(request)
+    except RuntimeError as exc:
+        return {"error": str(exc)}
+
+
+async def async_generate_within_budget(request):
+    if not request["latency_budget"]:
+        return await async_generate_ai_reaction(request)
+    task = asyncio.ensure_future(async_generate_ai_reaction(request))
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), request["latency_budget"])
+    except asyncio.TimeoutError:
+        with METRICS.stage("corpus_lookup"):
+            fallback = REACTION_CORPUS.lookup(request)
+        if fallback is None:
+            return await task
+    LATE_REACTIONS.add(task)
+    task.add_done_callback(LATE_REACTIONS.discard)
+    task.add_done_callback(lambda done: finish_late_reaction(request, done))
+    return fallback
+
+
+async def async_generate_ai_reaction(request):
+    return await async_hedged_call(request["providers"], lambda provider: async_request_ai_reaction(with_provider(request, provider)))
+
+
+async def async_request_ai_reaction(request):
+    url, payloads = reaction_request_payloads(request)
+    data = await async_post_with_fallbacks(url, request["api_key"], payloads, capability_key=request["capability_key"])
+    PROMPT_USAGE.record_usage(response_usage(data))
+    return parse_ai_response(extract_reaction_text(data, request["wire_api"]))
+
+
+async def async_hedged_call(providers, attempt):
+    # Same policy as hedged_call; losing attempts are cancelled as tasks,
+    # which closes their upstream connections.
+    providers = PROVIDER_HEALTH.rank(providers)
+    if len(providers) == 1:
+        return await async_run_provider_attempt(providers[0], attempt)
+    delay = PROVIDER_HEALTH.hedge_delay(providers[0]["label"])
+    waiting = list(providers)
+    running = {}
+    last_error = None
+
+    def launch():
+        provider = waiting.pop(0)
+        running[asyncio.ensure_future(async_run_provider_attempt(provider, attempt))] = provider
+
+    launch()
+    try:
+        while running:
+            done, _ = await asyncio.wait(running, timeout=delay if waiting else None, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                PROVIDER_HEALTH.count(waiting[0]["label"], "hedged")
+                launch()
+                continue
+            for task in done:
+                provider = running.pop(task)
+                try:
+                    result = task.result()
+                except RuntimeError as exc:
+                    last_error = exc
+                    continue
+                if provider is not providers[0]:
+                    PROVIDER_HEALTH.count(provider["label"], "hedgeWins")
+                return result
+            if waiting:
+                launch()
+    finally:
+        for task, provider in running.items():
+            PROVIDER_HEALTH.count(provider["label"], "cancelled")
+            task.cancel()
+    raise last_error
+
+
+async def async_run_provider_attempt(provider, attempt):
+    started = time.monotonic()
+    try:
+        result = await attempt(provider)
+    except RuntimeError:
+        PROVIDER_HEALTH.record(provider["label"], time.monotonic() - started, ok=False)
+        raise
+    PROVIDER_HEALTH.record(provider["label"], time.monotonic() - started, ok=True)
+    return result
+
+
+async def async_claim_speculation(request):
+    return await async_speculation_result(SPECULATIONS.take(request))
+
+
+async def async_speculation_result(future):
+    if future is None:
         return None
-    title = str(event.get("title") or "突发事件").strip()[:18]
-    text = str(event.get("text") or "").strip()[:90]
-    if not text:
+    try:
+        result = await asyncio.wait_for(asyncio.wrap_future(future), UPSTREAM_TIMEOUT)
+    except Exception:
+        SPECULATIONS.settle(False)
         return None
-    kind = str(event.get("kind") or event.get("type") or "").strip().lower()
-    if kind not in {"passive", "optional"}:
-        kind = "passive" if event.get("passive") is True else "optional"
-    target = event.get("target")
-    target = str(target).strip()[:16] if target else None
-    effects = event.get("effects") if isinstance(event.get("effects"), dict) else {}
-    if kind == "optional" and looks_like_passive_event(title, text):
-        kind = "passive"
-    effects = repair_event_effects(kind, effects)
+    SPECULATIONS.settle(True)
+    return result
+
+
+async def async_stream_ai_reaction(payload):
+    request = prepare_ai_request(payload)
+    ready = lookup_cached_reaction(request)
+    if ready is None:
+        ready = await async_claim_speculation(request)
+        if ready is not None:
+            remember_reaction(request, ready)
+    if ready is not None:
+        for item in ready_reaction_events(request, ready):
+            yield item
+        return
+
+    if uses_http_proxy(request["base_url"]):
+        # urllib handles proxies; pump its blocking stream from a worker thread.
+        events = stream_ai_reaction(dict(payload, cache=False))
+        try:
+            while True:
+                item = await asyncio.to_thread(next, events, None)
+                if item is None:
+                    break
+                if item[0] == "done":
+                    remember_reaction(request, item[1])
+                yield item
+        finally:
+            events.close()
+        return
+
+    request, response = await async_open_reaction_stream(request)
+    parser = ReactionStreamParser(request)
+    try:
+        if "text/event-stream" in response.headers.get("Content-Type", ""):
+            finished = False
+            while True:
+                line = await async_read_upstream(response.readline())
+                if not line:
+                    break
+                chunk = None if finished else parse_sse_line(line)
+                if chunk is SSE_DONE:
+                    finished = True
+                elif chunk is not None:
+                    PROMPT_USAGE.record_usage(stream_chunk_usage(chunk, request["wire_api"]))
+                    delta = stream_text_delta(chunk, request["wire_api"])
+                    if delta:
+                        for item in parser.feed(delta):
+                            yield item
+        else:
+            data = decode_upstream_json((await async_read_upstream(response.read())).decode("utf-8", "replace"))
+            PROMPT_USAGE.record_usage(response_usage(data))
+            for item in parser.feed(extract_reaction_text(data, request["wire_api"])):
+                yield item
+    finally:
+        response.close()
+    for item in finish_reaction_stream(request, parser):
+        yield item
+
+
+async def async_open_reaction_stream(request):
+    last_error = None
+    for provider in PROVIDER_HEALTH.rank(request["providers"]):
+        attempt = with_provider(request, provider)
+        url, payloads = reaction_request_payloads(attempt, stream=True)
+        started = time.monotonic()
+        try:
+            response = await async_post_with_fallbacks(
+                url,
+                attempt["api_key"],
+                payloads,
+                capability_key=attempt["capability_key"],
+                send=async_open_openai_stream,
+            )
+        except RuntimeError as exc:
+            PROVIDER_HEALTH.record(provider["label"], time.monotonic() - started, ok=False)
+            last_error = exc
+            continue
+        PROVIDER_HEALTH.record(provider["label"], None, ok=True)
+        return attempt, response
+    raise last_error
+
+
+async def async_post_with_fallbacks(url, api_key, payloads, capability_key=None, send=None):
+    send = send or async_post_openai_compatible
+    last_error = None
+    for index in range(fallback_start_index(url, api_key, payloads, capability_key), len(payloads)):
+        try:
+            data = await send(url, api_key, payloads[index])
+        except RuntimeError as exc:
+            last_error = exc
+            if index == len(payloads) - 1 or not looks_like_schema_rejection(str(exc)):
+                raise
+            METRICS.count("formatRejected", RESPONSE_FORMAT_VARIANTS[index])
+            continue
+        METRICS.count("formatUsed", RESPONSE_FORMAT_VARIANTS[index])
+        if capability_key is not None:
+            FORMAT_CAPABILITIES.record(capability_key, index)
+        return data
+    raise last_error
+
+
+async def async_post_openai_compatible(url, api_key, payload):
+    data = json.dumps(payload).encode("utf-8")
+    status, raw = await async_send_upstream_request(url, "POST", data, openai_headers(api_key))
+    if status >= 400:
+        raise upstream_http_error(status, raw)
+    return decode_upstream_json(raw)
+
+
+async def async_open_openai_stream(url, api_key, payload):
+    data = json.dumps(payload).encode("utf-8")
+    with METRICS.stage("upstream_headers"):
+        response = await async_open_limited_upstream(url, "POST", data, openai_headers(api_key, accept="text/event-stream"))
+    METRICS.record_upstream(response.status, len(data), 0)
+    if response.status >= 400:
+        try:
+            raw = (await async_read_upstream(response.read())).decode("utf-8", "replace")
+        finally:
+            response.close()
+        raise upstream_http_error(response.status, raw)
+    return response
+
+
+async def async_send_upstream_request(url, method, data, headers):
+    if uses_http_proxy(url):
+        return await asyncio.to_thread(send_upstream_request, url, method, data, headers)
+    with METRICS.stage("upstream"):
+        response = await async_open_limited_upstream(url, method, data, headers)
+        try:
+            raw = await async_read_upstream(response.read())
+        finally:
+            response.close()
+    METRICS.record_upstream(response.status, len(data or b""), len(raw))
+    return response.status, raw.decode("utf-8", "replace")
+
+
+async def async_open_limited_upstream(url, method, data, headers):
+    if UPSTREAM_TAPE.mode == "replay":
+        return await UPSTREAM_TAPE.async_open(url, method, data)
+    key = rate_limit_key(url, headers)
+    deadline = time.monotonic() + UPSTREAM_QUEUE_TIMEOUT
+    for attempt in range(UPSTREAM_RETRIES + 1):
+        with METRICS.stage("upstream_queue"):
+            started = await ASYNC_UPSTREAM_LIMITER.acquire(key, deadline)
+        opened = time.monotonic()
+        try:
+            response = await async_open_upstream(url, method, data, headers)
+        except BaseException:
+            ASYNC_UPSTREAM_LIMITER.release(key, started, None)
+            raise
+        status = response.status
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        delay = retry_delay(attempt, retry_after)
+        if status not in UPSTREAM_RETRY_STATUSES or attempt == UPSTREAM_RETRIES or time.monotonic() + delay > deadline:
+            limited = LimitedResponse(response, lambda: ASYNC_UPSTREAM_LIMITER.release(key, started, status, retry_after))
+            return UPSTREAM_TAPE.track(limited, url, method, data, opened, AsyncRecordingResponse)
+        try:
+            raw = await async_read_upstream(response.read())
+        except RuntimeError:
+            raw = b""
+        finally:
+            response.close()
+            ASYNC_UPSTREAM_LIMITER.release(key, started, status, retry_after)
+        METRICS.record_upstream(status, len(data or b""), len(raw))
+        METRICS.count("upstreamRetries", str(status))
+        await asyncio.sleep(delay)
+
+
+async def async_open_upstream(url, method, data, headers):
+    try:
+        return await ASYNC_UPSTREAM_POOL.open(method, url, body=data, headers=headers)
+    except URLError as exc:
+        raise RuntimeError(f"API 网络错误: {exc.reason}") from exc
+    except asyncio.TimeoutError as exc:
+        raise RuntimeError("API 网络错误: timed out") from exc
+    except (ValueError, asyncio.IncompleteReadError, OSError) as exc:
+        raise RuntimeError(f"API 网络错误: {exc}") from exc
+
+
+async def async_read_upstream(awaitable):
+    try:
+        return await awaitable
+    except asyncio.TimeoutError as exc:
+        raise RuntimeError("API 网络错误: timed out") from exc
+    except (ValueError, asyncio.IncompleteReadError, OSError) as exc:
+        raise RuntimeError(f"API 网络错误: {exc}") from exc
+
+
+class AsyncAstroChaosServer:
+    # Single-threaded alternative to ThreadingHTTPServer + AstroChaosHandler.
+    # API calls share a global concurrency limit plus a per-client cap, and
+    # identical concurrent /api/react bodies share one upstream call.
+    def __init__(self, max_concurrency=ASYNC_MAX_CONCURRENCY, per_client=ASYNC_PER_CLIENT):
+        self.per_client = per_client
+        self._slots = asyncio.Semaphore(max(1, max_concurrency))
+        self._active_clients = {}
+        self._inflight_reactions = {}
+        self._counters = {"requests": 0, "apiRequests": 0, "rejected": 0, "coalesced": 0}
+
+    async def handle_client(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        client = peer[0] if peer else "-"
+        try:
+            while True:
+                request = await read_http_request(reader)
+                if request is None:
+                    break
+                self._counters["requests"] += 1
+                keep_alive = await self.dispatch(request, writer, client)
+                print(f'[server] {client} - "{request["method"]} {request["target"]} {request["version"]}" {request["status"]} -')
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, request, writer, client):
+        path = urlsplit(request["target"]).path
+        if request["method"] in {"GET", "HEAD"}:
+            if path == "/api/stats":
+                return await self.write_json(writer, request, self.collect_stats())
+            if path == "/api/metrics":
+                body, content_type = metrics_response(request["target"], request["headers"].get("accept"))
+                return await self.write_response(writer, request, HTTPStatus.OK, body, content_type)
+            job = parse_job_target(request["target"])
+            if job is not None:
+                return await self.poll_job(writer, request, *job)
+            return await self.serve_static(writer, request, path)
+        if request["method"] == "DELETE":
+            job = parse_job_target(request["target"])
+            body = REACTION_JOBS.cancel(job[0]) if job is not None else None
+            return await self.write_json(writer, request, body or job_missing_body(), HTTPStatus.OK if body else HTTPStatus.NOT_FOUND)
+        if request["method"] != "POST":
+            return await self.write_json(writer, request, {"error": "Unsupported method"}, HTTPStatus.METHOD_NOT_ALLOWED)
+        trace = METRICS.begin(path, len(request["body"]))
+        try:
+            return await self.dispatch_post(path, request, writer, client)
+        finally:
+            METRICS.finish(*trace)
+
+    async def dispatch_post(self, path, request, writer, client):
+        handlers = {
+            "/api/react": self.coalesced_reaction,
+            "/api/react/batch": lambda payload: async_build_ai_reaction_batch(resolve_session_state(payload)),
+            "/api/react/prefetch": lambda payload: asyncio.to_thread(prefetch_ai_reactions, payload),
+            "/api/react/jobs": lambda payload: asyncio.to_thread(REACTION_JOBS.submit, resolve_session_state(payload)),
+            "/api/models": lambda payload: asyncio.to_thread(fetch_models, payload),
+        }
+        if path != "/api/react/stream" and path not in handlers:
+            return await self.write_json(writer, request, {"error": "Unknown endpoint"}, HTTPStatus.NOT_FOUND)
+        if self._active_clients.get(client, 0) >= self.per_client:
+            self._counters["rejected"] += 1
+            return await self.write_json(writer, request, {"error": "请求过于频繁，请稍后再试。"}, HTTPStatus.TOO_MANY_REQUESTS)
+
+        self._counters["apiRequests"] += 1
+        self._active_clients[client] = self._active_clients.get(client, 0) + 1
+        try:
+            async with self._slots:
+                try:
+                    payload = json.loads(request["body"].decode("utf-8")) if request["body"] else {}
+                except ValueError as exc:
+                    return await self.write_json(writer, request, {"error": f"请求处理失败: {exc}"}, HTTPStatus.BAD_REQUEST)
+                try:
+                    if path == "/api/react/stream":
+                        payload = resolve_session_state(payload)
+                        await self.write_event_stream(writer, request, async_stream_ai_reaction(payload))
+                        return False
+                    result = await handlers[path](payload)
+                except StaleSessionError as exc:
+                    return await self.write_json(writer, request, {"error": str(exc), "resync": True}, HTTPStatus.CONFLICT)
+                except RuntimeError as exc:
+                    return await self.write_json(writer, request, api_error_body(exc), api_error_status(exc))
+                except Exception as exc:
+                    return await self.write_json(writer, request, {"error": f"请求处理失败: {exc}"}, HTTPStatus.BAD_REQUEST)
+                return await self.write_json(writer, request, result, HTTPStatus.ACCEPTED if path == JOB_PATH else HTTPStatus.OK)
+        finally:
+            self._active_clients[client] -= 1
+            if not self._active_clients[client]:
+                del self._active_clients[client]
+
+    async def coalesced_reaction(self, payload):
+        key = hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+        task = self._inflight_reactions.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.resolved_reaction(payload))
+            self._inflight_reactions[key] = task
+            task.add_done_callback(lambda _: self._inflight_reactions.pop(key, None))
+        else:
+            self._counters["coalesced"] += 1
+        return await asyncio.shield(task)
+
+    async def resolved_reaction(self, payload):
+        return await async_build_ai_reaction(resolve_session_state(payload))
+
+    async def poll_job(self, writer, request, job_id, seconds):
+        # Long-poll without a worker thread: wait on the job's future from
+        # the event loop, and only touch the queue again to describe it.
+        future = REACTION_JOBS.future(job_id)
+        if future is not None and seconds > 0:
+            await asyncio.wait([asyncio.wrap_future(future)], timeout=seconds)
+        body = REACTION_JOBS.status(job_id)
+        return await self.write_json(writer, request, body or job_missing_body(), HTTPStatus.OK if body else HTTPStatus.NOT_FOUND)
+
+    async def serve_static(self, writer, request, path):
+        response = static_asset_response(path, request["headers"])
+        if response is not None:
+            status, headers, body = response
+            return await self.write_response(writer, request, status, body, extra_headers=headers)
+        relative = unquote(path).lstrip("/") or "index.html"
+        target = (WEB_ROOT / relative).resolve()
+        if target.is_dir():
+            target = target / "index.html"
+        if WEB_ROOT.resolve() not in target.parents or not target.is_file():
+            return await self.write_json(writer, request, {"error": "File not found"}, HTTPStatus.NOT_FOUND)
+        body = await asyncio.to_thread(target.read_bytes)
+        content_type = mimetypes.guess_type(target.name)[0] or "application/octet-stream"
+        if content_type.startswith("text/") or content_type.endswith("javascript"):
+            content_type = f"{content_type}; charset=utf-8"
+        return await self.write_response(writer, request, HTTPStatus.OK, body, content_type)
+
+    async def write_json(self, writer, request, payload, status=HTTPStatus.OK):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        return await self.write_response(writer, request, status, data, "application/json; charset=utf-8")
+
+    async def write_response(self, writer, request, status, body, content_type=None, extra_headers=None):
+        request["status"] = int(status)
+        METRICS.note_response(status, len(body))
+        keep_alive = request["keep_alive"]
+        head = [f"HTTP/1.1 {int(status)} {status.phrase}"]
+        if content_type is not None:
+            head.append(f"Content-Type: {content_type}")
+            head.append(f"Content-Length: {len(body)}")
+        head.extend(f"{name}: {value}" for name, value in extra_headers or ())
+        head.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+        if request["method"] != "HEAD":
+            writer.write(body)
+        await writer.drain()
+        return keep_alive
+
+    async def write_event_stream(self, writer, request, events):
+        request["status"] = HTTPStatus.OK
+        head = [
+            "HTTP/1.1 200 OK",
+            "Content-Type: text/event-stream; charset=utf-8",
+            "Cache-Control: no-cache",
+            "X-Accel-Buffering: no",
+            "Connection: close",
+        ]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+        try:
+            async for name, data in events:
+                chunk = format_sse(name, data)
+                METRICS.note_response(HTTPStatus.OK, len(chunk))
+                writer.write(chunk)
+                await writer.drain()
+        except ConnectionError:
+            return
+        except RuntimeError as exc:
+            writer.write(format_sse("error", api_error_body(exc)))
+        except Exception as exc:
+            writer.write(format_sse("error", {"error": f"请求处理失败: {exc}"}))
+        finally:
+            await events.aclose()
+        await writer.drain()
+
+    def collect_stats(self):
+        stats = collect_server_stats()
+        stats["asyncEngine"] = dict(
+            self._counters,
+            activeClients=len(self._active_clients),
+            inflightReactions=len(self._inflight_reactions),
+        )
+        stats["asyncUpstreamPool"] = ASYNC_UPSTREAM_POOL.stats()
+        return stats
+
+
+async def read_http_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, target, version = request_line.decode("latin-1").split()
+    raw_headers = b""
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        raw_headers += line
+        if len(raw_headers) > 65536:
+            raise ValueError("request headers too large")
+    headers = http.client.parse_headers(io.BytesIO(raw_headers))
+    length = int(headers.get("Content-Length") or 0)
+    if length < 0 or length > MAX_REQUEST_BODY:
+        raise ValueError("request body too large")
+    body = await reader.readexactly(length) if length else b""
+    connection = headers.get("Connection", "").lower()
+    if version == "HTTP/1.1":
+        keep_alive = connection != "close"
+    else:
+        keep_alive = connection == "keep-alive"
     return {
-        "kind": kind,
-        "target": target,
-        "title": title or "突发事件",
-        "text": text,
-        "effects": effects,
+        "method": method.upper(),
+        "target": "/index.html" if target == "/" else target,
+        "version": version,
+        "headers": headers,
+        "body": body,
+        "keep_alive": keep_alive,
+        "status": 0,
     }
 
 
-def looks_like_passive_event(title, text):
-    combined = f"{title}{text}"
-    return any(word in combined for word in PASSIVE_EVENT_WORDS)
-
-
-def repair_event_effects(kind, effects):
-    fixed = dict(effects) if isinstance(effects, dict) else {}
-    attrs = fixed.get("attrs") if isinstance(fixed.get("attrs"), dict) else {}
-    fixed["attrs"] = {
-        "theory": safe_number(attrs.get("theory")),
-        "observe": safe_number(attrs.get("observe")),
-        "practice": safe_number(attrs.get("practice")),
-        "culture": safe_number(attrs.get("culture")),
-    }
-    fixed["stress"] = safe_number(fixed.get("stress"))
-    fixed["money"] = safe_number(fixed.get("money"))
-    fixed["morale"] = safe_number(fixed.get("morale"))
-    fixed["equipment"] = safe_number(fixed.get("equipment"))
-
-    if kind == "optional" and not has_effect_benefit(fixed):
-        fixed["attrs"]["culture"] = max(fixed["attrs"]["culture"], 1)
-        fixed["stress"] = max(fixed["stress"], 1)
-    if kind == "passive":
-        if not has_effect_benefit(fixed):
-            fixed["attrs"]["culture"] = max(fixed["attrs"]["culture"], 1)
-        if not has_effect_penalty(fixed):
-            fixed["stress"] = max(fixed["stress"], 1)
-    return fixed
-
-
-def has_effect_benefit(effects):
-    attrs = effects.get("attrs") if isinstance(effects, dict) and isinstance(effects.get("attrs"), dict) else {}
-    return (
-        sum(max(0, safe_number(value)) for value in attrs.values()) > 0
-        or safe_number(effects.get("money")) > 0
-        or safe_number(effects.get("morale")) > 0
-        or safe_number(effects.get("equipment")) > 0
-        or safe_number(effects.get("stress")) < 0
-    )
+def format_sse(name, data):
+    body = json.dumps(data, ensure_ascii=False)
+    return f"event: {name}\ndata: {body}\n\n".encode("utf-8")
 
 
-def has_effect_penalty(effects):
-    attrs = effects.get("attrs") if isinstance(effects, dict) and isinstance(effects.get("attrs"), dict) else {}
-    return (
-        sum(min(0, safe_number(value)) for value in attrs.values()) < 0
-        or safe_number(effects.get("money")) < 0
-        or safe_number(effects.get("morale")) < 0
-        or safe_number(effects.get("equipment")) < 0
-        or safe_number(effects.get("stress")) > 0
-    )
+async def serve_asyncio(host, port, warmup=False):
+    app = AsyncAstroChaosServer()
+    server = await asyncio.start_server(app.handle_client, host, port)
+    STARTUP.mark("listening")
+    warming = asyncio.ensure_future(STARTUP.run_async()) if warmup else None
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if warming is not None:
+            warming.cancel()
+        ASYNC_UPSTREAM_POOL.close()
 
 
-def is_mixed_effect(effects):
-    return has_effect_benefit(effects) and has_effect_penalty(effects)
+class StartupWarmup:
+    # --warmup: with a key in the environment, open the gateway connection and
+    # load the model list while the server is already listening, so the first
+    # turn pays for neither. The response format comes from the capability
+    # file when it has one; otherwise --warmup-probe spends one minimal call
+    # to learn it. Also keeps the startup timeline (listening, warm-up, first
+    # reaction), measured from process start.
+    def __init__(self, started=PROCESS_STARTED):
+        self.started = started
+        self.probe = False
+        self._lock = threading.Lock()
+        self._marks = {}
+        self._warmup = {"status": "off"}
+        self._first = None
 
+    def mark(self, name):
+        with self._lock:
+            self._marks.setdefault(name, self._since_start())
 
-def safe_number(value):
+    def first_reaction(self, endpoint, seconds):
+        with self._lock:
+            if self._first is None:
+                self._first = {
+                    "endpoint": endpoint,
+                    "ms": round(seconds * 1000, 1),
+                    "atMs": self._since_start(),
+                    "warm": self._warmup["status"] == "done",
+                }
+
+    def run(self):
+        target = self._begin()
+        if target is None:
+            return
+        request = None
+        try:
+            with self._step("connect"):
+                if UPSTREAM_TAPE.mode != "replay" and not uses_http_proxy(target):
+                    UPSTREAM_POOL.warm(target)
+            with self._step("models"):
+                model = self._choose_model()
+            request = self._probe_request(model)
+            if self._wants_probe(request):
+                with self._step("probe"):
+                    url, payloads = warmup_probe_payloads(request)
+                    post_with_fallbacks(url, request["api_key"], payloads, capability_key=request["capability_key"])
+        except Exception as exc:
+            self._finish(request, exc)
+            return
+        self._finish(request)
+
+    async def run_async(self):
+        target = self._begin()
+        if target is None:
+            return
+        request = None
+        try:
+            with self._step("connect"):
+                if UPSTREAM_TAPE.mode != "replay" and not uses_http_proxy(target):
+                    await ASYNC_UPSTREAM_POOL.warm(target)
+            with self._step("models"):
+                model = await asyncio.to_thread(self._choose_model)
+            request = self._probe_request(model)
+            if self._wants_probe(request):
+                with self._step("probe"):
+                    url, payloads = warmup_probe_payloads(request)
+                    await async_post_with_fallbacks(url, request["api_key"], payloads, capability_key=request["capability_key"])
+        except Exception as exc:
+            self._finish(request, exc)
+            return
+        self._finish(request)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "marksMs": dict(self._marks),
+                "warmup": copy.deepcopy(self._warmup),
+                "firstReaction": dict(self._first) if self._first else None,
+            }
+
+    def prometheus(self):
+        stats = self.stats()
+        lines = ["# TYPE astro_chaos_startup_seconds gauge"]
+        lines.extend(f'astro_chaos_startup_seconds{{phase="{name}"}} {ms / 1000:.4f}' for name, ms in stats["marksMs"].items())
+        if stats["firstReaction"]:
+            lines.append("# TYPE astro_chaos_first_reaction_seconds gauge")
+            lines.append(f'astro_chaos_first_reaction_seconds {stats["firstReaction"]["ms"] / 1000:.4f}')
+        return lines
+
+    def _begin(self):
+        api_key = os.environ.get("OPENAI_API_KEY")
+        if not api_key:
+            with self._lock:
+                self._warmup = {"status": "skipped"}
+            print("[warmup] 未设置 OPENAI_API_KEY，跳过预热。")
+            return None
+        with self._lock:
+            self._warmup = {"status": "running", "stepsMs": {}}
+        return normalize_base_url(os.environ.get("OPENAI_BASE_URL") or DEFAULT_BASE_URL) or "https://api.openai.com/v1"
+
+    @contextmanager
+    def _step(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._warmup["stepsMs"][name] = round((time.monotonic() - started) * 1000, 1)
+
+    def _choose_model(self):
+        # Gateways without /models still get a probe, with the default model.
+        try:
+            return fetch_models({})["selected"]
+        except RuntimeError as exc:
+            with self._lock:
+                self._warmup["modelsError"] = str(exc)
+            return DEFAULT_MODEL
+
+    def _probe_request(self, model):
+        request = prepare_ai_request({"config": {"model": model}, "state": {}, "cache": False})
+        with self._lock:
+            self._warmup["model"] = model
+        return request
+
+    def _wants_probe(self, request):
+        if FORMAT_CAPABILITIES.known(request["capability_key"]):
+            probe = "recorded"
+        else:
+            probe = "sent" if self.probe else "off"
+        with self._lock:
+            self._warmup["probe"] = probe
+        return probe == "sent"
+
+    def _finish(self, request, error=None):
+        with self._lock:
+            self._warmup["status"] = "failed" if error else "done"
+            if error:
+                self._warmup["error"] = str(error)
+            elif request is not None:
+                self._warmup["format"] = FORMAT_CAPABILITIES.known(request["capability_key"])
+            self._marks["warmup"] = self._since_start()
+            report = dict(self._warmup)
+        steps = " ".join(f"{name}={ms}ms" for name, ms in report["stepsMs"].items())
+        if error:
+            print(f"[warmup] 预热失败：{error}（{steps}）")
+        else:
+            print(f"[warmup] 预热完成：模型 {report['model']}，格式 {report['format'] or '未探测'}（{steps}）")
+
+    def _since_start(self):
+        return round((time.monotonic() - self.started) * 1000, 1)
+
+
+STARTUP = StartupWarmup()
+
+
+def warmup_probe_payloads(request):
+    return structured_output_payloads(request, WARMUP_PROBE_MESSAGES, "astro_chaos_probe", WARMUP_PROBE_SCHEMA, WARMUP_PROBE_TOKENS)
+
+
+# Which pre-forked worker this process is, reported by /api/stats.
+PROCESS_INFO = {"worker": None, "workers": 1}
+
+
+class WorkerSupervisor:
+    # --workers N: the parent owns the listening socket and forks N serving
+    # processes that inherit it. A worker that dies is restarted (at most once
+    # per WORKER_RESTART_BACKOFF); SIGTERM or Ctrl+C asks every worker to stop
+    # accepting and finish its in-flight requests, and stragglers are killed
+    # once the drain period is over.
+    def __init__(self, count, start):
+        self.count = count
+        self.start = start
+        self.children = {}
+        self.started = {}
+        self.stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGALRM, self.kill)
+        for index in range(self.count):
+            self.spawn(index)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index = self.children.pop(pid, None)
+            if index is None or self.stopping:
+                continue
+            print(f"[server] 工作进程 {index}（pid {pid}）{describe_exit_status(status)}，正在重启。")
+            uptime = time.monotonic() - self.started[index]
+            if uptime < WORKER_RESTART_BACKOFF:
+                time.sleep(WORKER_RESTART_BACKOFF - uptime)
+            if not self.stopping:
+                self.spawn(index)
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                for signum in (signal.SIGTERM, signal.SIGALRM):
+                    signal.signal(signum, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                self.start(index)
+                code = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        self.children[pid] = index
+        self.started[index] = time.monotonic()
+
+    def stop(self, signum, frame):
+        if self.stopping:
+            self.kill()
+            return
+        self.stopping = True
+        print("\n正在停止工作进程……")
+        for pid in self.children:
+            self.signal(pid, signal.SIGTERM)
+        signal.alarm(max(1, int(WORKER_DRAIN_SECONDS) + 5))
+
+    def kill(self, signum=None, frame=None):
+        for pid in self.children:
+            self.signal(pid, signal.SIGKILL)
+
+    def signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+
+def describe_exit_status(status):
+    if os.WIFSIGNALED(status):
+        return f"被信号 {os.WTERMSIG(status)} 终止"
+    return f"退出码 {os.WEXITSTATUS(status)}"
+
+
+def serve_workers(args):
+    sock = socket.create_server((args.host, args.port), backlog=WORKER_BACKLOG)
+    print(f"天文闹赛网页端已启动 ({args.engine}, {args.workers} 个工作进程): http://{args.host}:{args.port}/")
+    print("AI 默认开启；可在页面右上角配置 API Token、可选 Base URL 和模型。")
     try:
-        return float(value or 0)
-    except (TypeError, ValueError):
-        return 0
+        WorkerSupervisor(args.workers, lambda index: run_worker(index, sock, args)).run()
+    finally:
+        sock.close()
+    print("服务已停止。")
+
+
+def run_worker(index, sock, args):
+    # Caches, sessions and limiter state stay per process; the limiter only
+    # admits this worker's share of each key's budget.
+    PROCESS_INFO.update(worker=index, workers=args.workers)
+    random.seed()
+    UPSTREAM_TAPE.reopen()
+    SESSIONS.use_worker_file(index)
+    REACTION_CORPUS.use_worker_file(index)
+    FORMAT_CAPABILITIES.use_worker_file(index)
+    UPSTREAM_LIMITER.share(args.workers)
+    ASYNC_UPSTREAM_LIMITER.share(args.workers)
+    if args.watch_static:
+        STATIC_ASSETS.watch()
+    try:
+        if args.engine == "asyncio":
+            asyncio.run(serve_asyncio_worker(sock, args.warmup))
+        else:
+            serve_threading_worker(sock, args.warmup)
+    finally:
+        SPECULATIONS.shutdown()
+        REACTION_JOBS.shutdown()
+        REACTION_CORPUS.close()
+        UPSTREAM_POOL.close()
+        UPSTREAM_TAPE.close()
+
+
+def worker_file(path, index):
+    # sessions.jsonl -> sessions.worker0.jsonl
+    return path.with_name(f"{path.stem}.worker{index}{path.suffix}")
+
+
+def serve_threading_worker(sock, warmup=False):
+    server = ThreadingHTTPServer(sock.getsockname()[:2], AstroChaosHandler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    STARTUP.mark("listening")
+    if warmup:
+        threading.Thread(target=STARTUP.run, name="warmup", daemon=True).start()
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, so it cannot run on
+        # the thread that is inside serve_forever().
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    server.serve_forever()
+    deadline = time.monotonic() + WORKER_DRAIN_SECONDS
+    while METRICS.inflight and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+async def serve_asyncio_worker(sock, warmup=False):
+    app = AsyncAstroChaosServer()
+    server = await asyncio.start_server(app.handle_client, sock=sock)
+    STARTUP.mark("listening")
+    warming = asyncio.ensure_future(STARTUP.run_async()) if warmup else None
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+    try:
+        await stopping.wait()
+        server.close()
+        deadline = time.monotonic() + WORKER_DRAIN_SECONDS
+        while METRICS.inflight and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+    finally:
+        if warming is not None:
+            warming.cancel()
+        ASYNC_UPSTREAM_POOL.close()
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Run the Astro Chaos web game.")
     parser.add_argument("--host", default="127.0.0.1", help="Host to bind. Defaults to 127.0.0.1.")
     parser.add_argument("--port", type=int, default=8765, help="Port to bind. Defaults to 8765.")
+    parser.add_argument(
+        "--engine",
+        choices=("threading", "asyncio"),
+        default="threading",
+        help="Server core. Defaults to threading; asyncio serves API calls without a thread per request.",
+    )
+    parser.add_argument("--watch-static", action="store_true", help="Reload web/ files into memory when they change.")
+    parser.add_argument(
+        "--warmup",
+        action="store_true",
+        help="With OPENAI_API_KEY set, connect to the gateway and pick the model while the server starts.",
+    )
+    parser.add_argument(
+        "--warmup-probe",
+        action="store_true",
+        help="Implies --warmup. When no response format is recorded for the gateway, learn it with one minimal generation.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Pre-fork this many server processes sharing the listening socket. Defaults to 1 (no forking).",
+    )
+    tape = parser.add_mutually_exclusive_group()
+    tape.add_argument("--record", metavar="DIR", help="Append every upstream AI exchange to DIR/upstream.jsonl.")
+    tape.add_argument("--replay", metavar="DIR", help="Answer upstream AI calls from DIR/upstream.jsonl instead of the network.")
+    parser.add_argument(
+        "--replay-latency",
+        choices=("recorded", "none"),
+        default="recorded",
+        help="Replay with the recorded upstream timing (default) or answer immediately.",
+    )
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
-    server = ThreadingHTTPServer((args.host, args.port), AstroChaosHandler)
+    args.warmup = args.warmup or args.warmup_probe
+    STARTUP.probe = args.warmup_probe
     url = f"http://{args.host}:{args.port}/"
+    if args.workers > 1 and not hasattr(os, "fork"):
+        raise SystemExit("--workers 需要支持 fork 的系统（Linux / macOS）。")
+    STATIC_ASSETS.load()
+    if args.record:
+        UPSTREAM_TAPE.configure("record", args.record)
+        print(f"正在录制上游请求: {UPSTREAM_TAPE.path}")
+    elif args.replay:
+        try:
+            count = UPSTREAM_TAPE.configure("replay", args.replay, latency=args.replay_latency == "recorded")
+        except OSError as exc:
+            raise SystemExit(f"无法读取上游录制: {exc}")
+        print(f"回放上游请求: {UPSTREAM_TAPE.path}（{count} 条，{'按录制耗时' if UPSTREAM_TAPE.latency else '不等待'}）")
+    if args.workers > 1:
+        serve_workers(args)
+        return
+    if args.watch_static:
+        STATIC_ASSETS.watch()
+    if args.engine == "asyncio":
+        print(f"天文闹赛网页端已启动 (asyncio): {url}")
+        print("AI 默认开启；可在页面右上角配置 API Token、可选 Base URL 和模型。")
+        try:
+            asyncio.run(serve_asyncio(args.host, args.port, args.warmup))
+        except KeyboardInterrupt:
+            print("\n服务已停止。")
+        finally:
+            SPECULATIONS.shutdown()
+            REACTION_JOBS.shutdown()
+            REACTION_CORPUS.close()
+            UPSTREAM_POOL.close()
+            UPSTREAM_TAPE.close()
+        return
+
+    server = ThreadingHTTPServer((args.host, args.port), AstroChaosHandler)
+    STARTUP.mark("listening")
+    if args.warmup:
+        threading.Thread(target=STARTUP.run, name="warmup", daemon=True).start()
     print(f"天文闹赛网页端已启动: {url}")
     print("AI 默认开启；可在页面右上角配置 API Token、可选 Base URL 和模型。")
     try:
@@ -593,6 +5815,11 @@ def main():
         print("\n服务已停止。")
     finally:
         server.server_close()
+        SPECULATIONS.shutdown()
+        REACTION_JOBS.shutdown()
+        REACTION_CORPUS.close()
+        UPSTREAM_POOL.close()
+        UPSTREAM_TAPE.close()
 
 
 if __name__ == "__main__":
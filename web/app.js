@@ -34,8 +34,17 @@ const STAT_HELP = {
   avgStress: "在社学生平均压力。压力过高可能导致退社。",
 };
 
+const PREFETCH_CANDIDATES = 2;
+const AI_JOB_POLL_SECONDS = 20;
+const AI_JOB_FINAL = new Set(["done", "failed", "cancelled", "superseded", "expired"]);
+const sessionId = crypto.randomUUID ? crypto.randomUUID() : `${Date.now()}-${Math.random()}`;
+
 let state = createInitialState(6);
 startWeek(state);
+let aiSync = { version: 0, state: null };
+let aiTurn = 0;
+let aiJob = null;
+let aiStream = null;
 
 const els = {};
 
@@ -70,6 +79,7 @@ function init() {
     "apiToken",
     "apiBaseUrl",
     "apiModel",
+    "apiProviders",
     "refreshModels",
     "modelStatus",
     "wireApi",
@@ -85,7 +95,9 @@ function init() {
     state.aiEnabled = els.aiToggle.checked;
     if (state.aiEnabled) {
       await requestAiReaction("玩家开启了实时 AI 反应。");
+      prefetchAiReactions();
     } else {
+      cancelAiReaction();
       state.aiLines = [];
       state.availablePlans = state.availablePlans.filter((plan) => !plan.aiEvent);
     }
@@ -96,11 +108,14 @@ function init() {
     const count = Number(els.studentCount.value) || 6;
     const settings = state.aiSettings;
     const aiEnabled = state.aiEnabled;
+    cancelAiReaction();
     state = createInitialState(count);
+    aiSync = { version: 0, state: null };
     state.aiSettings = settings;
     state.aiEnabled = aiEnabled;
     startWeek(state);
     render();
+    prefetchAiReactions();
   });
 
   els.settingsButton.addEventListener("click", async () => {
@@ -112,7 +127,7 @@ function init() {
   });
 
   els.refreshModels.addEventListener("click", async () => {
-    await refreshModels();
+    await refreshModels({ force: true });
   });
 
   els.saveSettings.addEventListener("click", () => {
@@ -120,6 +135,7 @@ function init() {
       token: els.apiToken.value.trim(),
       baseUrl: els.apiBaseUrl.value.trim(),
       model: els.apiModel.value || "gpt-5.4",
+      providers: parseProviders(els.apiProviders.value),
       wireApi: els.wireApi.value,
       mode: els.aiMode.value,
     };
@@ -129,19 +145,32 @@ function init() {
   });
 
   els.advance.addEventListener("click", async () => {
-    if (state.gameOver || state.aiBusy) return;
+    if (state.gameOver) return;
     const selected = state.selectedPlanId || state.availablePlans[0]?.id;
     const selectedPlan = state.availablePlans.find((plan) => plan.id === selected);
     const result = executePlan(state, selected);
     if (!result.ok) showToast(result.reason);
     render();
     if (result.ok && state.aiEnabled && !state.gameOver) {
-      const planName = selectedPlan?.name || selected || "本周安排";
-      await requestAiReaction(`玩家刚执行了“${planName}”，游戏已经进入新一周。只吐槽刚才的局势；如果生成 optional 事件，它会作为新一周的可选行动。`);
+      const trigger = planTrigger(selectedPlan?.name || selected || "本周安排");
+      const reaction = state.contestResults
+        ? requestAiReactionBatch([trigger, contestTrigger(state.contestResults)])
+        : requestAiReaction(trigger);
+      reaction.then(prefetchAiReactions);
     }
   });
 
   render();
+  prefetchAiReactions();
+}
+
+function planTrigger(planName) {
+  return `玩家刚执行了“${planName}”，游戏已经进入新一周。只吐槽刚才的局势；如果生成 optional 事件，它会作为新一周的可选行动。`;
+}
+
+function contestTrigger({ contest, scored }) {
+  const passed = scored.filter((item) => item.passed).length;
+  return `${contest.name}刚刚结束，${scored.length} 人参赛、${passed} 人晋级。只吐槽这场比赛的结果。`;
 }
 
 function render() {
@@ -157,7 +186,7 @@ function render() {
   els.activeCount.textContent = `👥 ${stats.activeCount}/${state.students.length}`;
   els.avgStress.textContent = `${stressEmoji(stats.avgStress)} ${Math.round(stats.avgStress)}/100`;
   els.aiToggle.checked = state.aiEnabled;
-  els.aiStatus.textContent = state.aiEnabled ? (state.aiBusy ? "等待中" : "已开启") : "关闭";
+  els.aiStatus.textContent = state.aiEnabled ? (state.aiPending ? "生成中" : "已开启") : "关闭";
 
   renderTeamBars(stats);
   renderStudents();
@@ -233,7 +262,6 @@ function renderStudents() {
 }
 
 function renderPlans() {
-  const blocked = Boolean(state.aiBusy);
   els.planList.innerHTML = state.availablePlans
     .map((plan) => {
       const selected = state.selectedPlanId === plan.id;
@@ -242,7 +270,7 @@ function renderPlans() {
         .join(" / ") || "无属性收益";
       const effectText = formatPlanEffects(plan);
       return `
-        <button class="plan ${selected ? "is-selected" : ""}" data-plan="${plan.id}" type="button" ${blocked ? "disabled" : ""}>
+        <button class="plan ${selected ? "is-selected" : ""}" data-plan="${plan.id}" type="button">
           <span class="plan-type">${plan.type}</span>
           <strong>${plan.name}</strong>
           <small>${plan.desc}</small>
@@ -258,20 +286,20 @@ function renderPlans() {
 
   els.planList.querySelectorAll("[data-plan]").forEach((button) => {
     button.addEventListener("click", () => {
-      if (state.aiBusy) return;
       state.selectedPlanId = button.dataset.plan;
       renderPlans();
+      prefetchAiReactions();
     });
   });
 }
 
 function renderLogs() {
   const aiPendingItems = [];
-  if (state.aiBusy) {
+  if (state.aiPending) {
     aiPendingItems.push(`
       <li class="neutral ai-log">
         <span>AI</span>
-        <p>正在等 AI 锐评，本回合暂时不能继续推进。</p>
+        <p>AI 正在后台锐评，可以继续推进；过时的锐评会自动作废。</p>
       </li>
     `);
   }
@@ -311,8 +339,8 @@ function renderContest() {
 function renderEnding() {
   if (!state.gameOver) {
     els.ending.hidden = true;
-    els.advance.disabled = Boolean(state.aiBusy);
-    els.advance.textContent = state.aiBusy ? "等待 AI 反应..." : "执行并推进一周";
+    els.advance.disabled = false;
+    els.advance.textContent = "执行并推进一周";
     return;
   }
 
@@ -327,47 +355,323 @@ function renderEnding() {
 }
 
 async function requestAiReaction(trigger) {
-  state.aiBusy = true;
+  // A single reaction streams, so its first line shows up as soon as the
+  // model writes it rather than when the whole reply is done.
+  await runAiTurn((turn) => streamAiReaction({ trigger }, turn));
+}
+
+async function requestAiReactionBatch(triggers) {
+  // Several things happened in one week (plan plus contest); ask for all the
+  // reactions in a single job and apply them in order.
+  await runAiTurn(async (turn) => {
+    const job = await awaitAiJob({ triggers }, turn);
+    if (turn !== aiTurn) return;
+    if (job.status === "done") {
+      applyAiReactions((job.result || {}).reactions || []);
+    } else if (job.status === "failed") {
+      throw aiError(job);
+    } else if (job.status === "expired") {
+      throw aiError({ error: "AI 排队太久，本次锐评已作废。", retryable: true });
+    }
+  });
+}
+
+async function runAiTurn(run) {
+  // The player keeps playing while a reaction is generated. Each request
+  // carries the turn it was asked for; once the player has moved on, the old
+  // stream is aborted or the old job cancelled, and anything that still
+  // arrives for it is ignored.
+  cancelAiReaction();
+  const turn = aiTurn;
+  state.aiPending = true;
   render();
   try {
-    const response = await fetch("/api/react", {
+    await run(turn);
+  } catch (error) {
+    if (turn === aiTurn) handleAiError(error);
+  } finally {
+    if (turn === aiTurn) {
+      state.aiPending = false;
+      aiJob = null;
+      aiStream = null;
+      render();
+    }
+  }
+}
+
+async function streamAiReaction(body, turn) {
+  aiStream = new AbortController();
+  const { response, uploaded } = await postAiReaction("/api/react/stream", body, aiStream.signal);
+  if (!response.ok) {
+    throw aiError(await response.json().catch(() => ({})));
+  }
+  state.aiLines = [];
+  let streamedEvent = null;
+  let result = null;
+  await readEventStream(response, (name, data) => {
+    if (name === "line" && data.text) {
+      state.aiLines.push(data.text);
+      addLog(state, "AI锐评", data.text, "neutral");
+      render();
+    } else if (name === "event") {
+      streamedEvent = data;
+    } else if (name === "done") {
+      result = data;
+    } else if (name === "error") {
+      throw aiError(data);
+    }
+  });
+  if (!result) {
+    throw new Error("AI 响应中断。");
+  }
+  if (result.stateVersion) {
+    aiSync = { version: result.stateVersion, state: uploaded };
+  }
+  if (state.aiLines.length) {
+    applyClientAiEvent(streamedEvent || result.event);
+  } else {
+    applyAiReactions([{ ...result, event: streamedEvent || result.event }]);
+  }
+}
+
+async function awaitAiJob(body, turn) {
+  const { response, uploaded } = await postAiReaction("/api/react/jobs", { ...body, turn });
+  let job = await response.json().catch(() => ({}));
+  if (!response.ok) {
+    throw aiError(job);
+  }
+  if (turn !== aiTurn) return job;
+  aiJob = job.jobId;
+  if (job.stateVersion) {
+    aiSync = { version: job.stateVersion, state: uploaded };
+  }
+  while (!AI_JOB_FINAL.has(job.status) && turn === aiTurn) {
+    const poll = await fetch(`/api/react/jobs/${job.jobId}?wait=${AI_JOB_POLL_SECONDS}`);
+    if (poll.status === 404 && turn === aiTurn) {
+      // Jobs live in the process that accepted them; under --workers a poll
+      // can reach another one, so ask for the reactions directly instead.
+      return requestAiReactionDirect(body);
+    }
+    job = await poll.json().catch(() => ({}));
+    if (!poll.ok) {
+      throw aiError({ ...job, retryable: true });
+    }
+  }
+  return job;
+}
+
+async function requestAiReactionDirect(body) {
+  const { response, uploaded } = await postAiReaction("/api/react/batch", body);
+  const result = await response.json().catch(() => ({}));
+  if (!response.ok) {
+    throw aiError(result);
+  }
+  if (result.stateVersion) {
+    aiSync = { version: result.stateVersion, state: uploaded };
+  }
+  return { status: "done", result };
+}
+
+function cancelAiReaction() {
+  aiTurn += 1;
+  state.aiPending = false;
+  if (aiStream) {
+    aiStream.abort();
+    aiStream = null;
+  }
+  if (aiJob) {
+    fetch(`/api/react/jobs/${aiJob}`, { method: "DELETE" }).catch(() => {});
+    aiJob = null;
+  }
+}
+
+function applyAiReactions(reactions) {
+  state.aiLines = [];
+  let lastError = null;
+  for (const reaction of reactions) {
+    const lines = Array.isArray(reaction.lines) ? reaction.lines.filter(Boolean) : [];
+    if (!lines.length) {
+      lastError = reaction.error || "AI 没有返回有效内容。";
+      continue;
+    }
+    for (const line of lines) {
+      state.aiLines.push(line);
+      addLog(state, "AI锐评", line, "neutral");
+    }
+    applyClientAiEvent(reaction.event);
+  }
+  if (!state.aiLines.length) {
+    throw new Error(lastError || "AI 没有返回有效内容。");
+  }
+}
+
+function applyClientAiEvent(rawEvent) {
+  const event = normalizeClientAiEvent(rawEvent);
+  if (!event) return;
+  if (event.kind === "passive") {
+    const applied = applyAiEvent(state, event);
+    if (!applied.ok) showToast(applied.reason);
+  } else {
+    addAiEventPlan(state, event);
+  }
+}
+
+function aiError(payload) {
+  const error = new Error(payload.error || "AI 服务不可用。");
+  error.retryable = Boolean(payload.retryable);
+  return error;
+}
+
+function handleAiError(error) {
+  if (!error.retryable) {
+    disableAi(error);
+    return;
+  }
+  // The provider is throttling; skip this reaction but keep AI on.
+  state.aiLines = [];
+  showToast(error.message);
+  addLog(state, "AI", `AI 暂时繁忙，本次跳过：${error.message}`, "warn");
+}
+
+function disableAi(error) {
+  state.aiEnabled = false;
+  els.aiToggle.checked = false;
+  state.aiLines = [];
+  showToast(error.message);
+  addLog(state, "AI", `AI 反应关闭：${error.message}`, "warn");
+}
+
+async function postAiReaction(url, body, signal) {
+  // After the first upload the server keeps the session state, so later turns
+  // only send what changed since the last acknowledged version.
+  for (let attempt = 0; ; attempt += 1) {
+    const current = serializeForAi(state);
+    const upload = aiSync.version
+      ? { baseVersion: aiSync.version, delta: diffAiState(aiSync.state, current) }
+      : { state: current };
+    const response = await fetch(url, {
       method: "POST",
       headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ trigger, state: serializeForAi(state), config: state.aiSettings }),
+      body: JSON.stringify({ ...body, sessionId, ...upload, config: state.aiSettings }),
+      signal,
     });
-    if (!response.ok) {
-      const error = await response.json().catch(() => ({ error: "AI 服务不可用。" }));
-      throw new Error(error.error || "AI 服务不可用。");
+    if (response.status === 409 && attempt === 0) {
+      aiSync = { version: 0, state: null };
+      continue;
     }
-    const payload = await response.json();
-    state.aiLines = Array.isArray(payload.lines) ? payload.lines.filter(Boolean) : [];
-    if (!state.aiLines.length) {
-      throw new Error(payload.error || "AI 没有返回有效内容。");
+    return { response, uploaded: current };
+  }
+}
+
+function diffAiState(previous, current) {
+  const delta = {};
+  const changed = {};
+  for (const [key, value] of Object.entries(current)) {
+    if (key === "recentLogs" || key === "students") continue;
+    if (JSON.stringify(value) !== JSON.stringify(previous[key])) changed[key] = value;
+  }
+  if (Object.keys(changed).length) delta.set = changed;
+  const logs = diffAiLogs(previous.recentLogs || [], current.recentLogs || []);
+  if (logs) delta.logs = logs;
+  const students = diffAiStudents(previous.students || [], current.students || []);
+  if (students) delta.students = students;
+  return delta;
+}
+
+function diffAiLogs(previous, current) {
+  for (let added = 0; added <= current.length; added += 1) {
+    const kept = current.slice(added);
+    if (!kept.every((line, index) => line === previous[index])) continue;
+    if (!added && kept.length === previous.length) return null;
+    return { add: current.slice(0, added), keep: kept.length };
+  }
+  return null;
+}
+
+function diffAiStudents(previous, current) {
+  // Keyed on id: two students can be generated with the same name.
+  const before = new Map(previous.map((student) => [student.id, student]));
+  const upsert = [];
+  for (const student of current) {
+    const old = before.get(student.id);
+    if (!old) {
+      upsert.push(student);
+      continue;
     }
-    for (const line of state.aiLines) {
-      addLog(state, "AI锐评", line, "neutral");
+    const patch = {};
+    for (const [key, value] of Object.entries(student)) {
+      if (JSON.stringify(value) !== JSON.stringify(old[key])) patch[key] = value;
     }
-    const event = normalizeClientAiEvent(payload.event);
-    if (event) {
-      if (event.kind === "passive") {
-        const result = applyAiEvent(state, event);
-        if (!result.ok) showToast(result.reason);
-      } else {
-        addAiEventPlan(state, event);
+    if (Object.keys(patch).length) upsert.push({ id: student.id, ...patch });
+  }
+  const ids = current.map((student) => student.id);
+  const previousIds = previous.map((student) => student.id);
+  const remove = previousIds.filter((id) => !ids.includes(id));
+  const reordered = ids.join("\n") !== previousIds.join("\n");
+  if (!upsert.length && !remove.length && !reordered) return null;
+  const diff = {};
+  if (upsert.length) diff.upsert = upsert;
+  if (remove.length) diff.remove = remove;
+  if (reordered) diff.order = ids;
+  return diff;
+}
+
+function prefetchAiReactions() {
+  if (!state.aiEnabled || state.aiPending || state.gameOver) return;
+  // Play the most likely plans forward on a throwaway copy so the server can
+  // start generating the next reaction while the player is still deciding.
+  const ordered = [...state.availablePlans].sort(
+    (a, b) => Number(b.id === state.selectedPlanId) - Number(a.id === state.selectedPlanId),
+  );
+  const candidates = ordered
+    .slice(0, PREFETCH_CANDIDATES)
+    .map((plan) => {
+      const predicted = JSON.parse(JSON.stringify(state));
+      const result = executePlan(predicted, plan.id);
+      if (!result.ok || predicted.gameOver) return null;
+      return { planId: plan.id, trigger: planTrigger(plan.name), state: serializeForAi(predicted) };
+    })
+    .filter(Boolean);
+  if (!candidates.length) return;
+  fetch("/api/react/prefetch", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ sessionId, state: serializeForAi(state), candidates, config: state.aiSettings }),
+  }).catch(() => {});
+}
+
+async function readEventStream(response, onEvent) {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  try {
+    while (true) {
+      const { value, done } = await reader.read();
+      buffer += decoder.decode(value, { stream: !done });
+      let boundary = buffer.indexOf("\n\n");
+      while (boundary >= 0) {
+        dispatchEventBlock(buffer.slice(0, boundary), onEvent);
+        buffer = buffer.slice(boundary + 2);
+        boundary = buffer.indexOf("\n\n");
       }
+      if (done) break;
     }
   } catch (error) {
-    state.aiEnabled = false;
-    els.aiToggle.checked = false;
-    state.aiLines = [];
-    showToast(error.message);
-    addLog(state, "AI", `AI 反应关闭：${error.message}`, "warn");
-  } finally {
-    state.aiBusy = false;
-    render();
+    reader.cancel().catch(() => {});
+    throw error;
   }
 }
 
+function dispatchEventBlock(block, onEvent) {
+  let name = "message";
+  const data = [];
+  for (const line of block.split("\n")) {
+    if (line.startsWith("event:")) name = line.slice(6).trim();
+    if (line.startsWith("data:")) data.push(line.slice(5).trim());
+  }
+  if (data.length) onEvent(name, JSON.parse(data.join("\n")));
+}
+
 function loadSettings() {
   try {
     const saved = JSON.parse(localStorage.getItem("astroChaosApiSettings") || "{}");
@@ -375,14 +679,27 @@ function loadSettings() {
       token: saved.token || "",
       baseUrl: saved.baseUrl || "",
       model: saved.model || "gpt-5.4",
+      providers: Array.isArray(saved.providers) ? saved.providers : [],
       wireApi: saved.wireApi || "responses",
       mode: saved.mode || "events",
     };
   } catch {
-    state.aiSettings = { token: "", baseUrl: "", model: "gpt-5.4", wireApi: "responses", mode: "events" };
+    state.aiSettings = { token: "", baseUrl: "", model: "gpt-5.4", providers: [], wireApi: "responses", mode: "events" };
   }
 }
 
+function parseProviders(text) {
+  return text
+    .split("\n")
+    .map((line) => line.trim().split(/\s+/))
+    .filter(([baseUrl]) => baseUrl)
+    .map(([baseUrl, model]) => (model ? { baseUrl, model } : { baseUrl }));
+}
+
+function formatProviders(providers) {
+  return (providers || []).map((provider) => [provider.baseUrl, provider.model].filter(Boolean).join(" ")).join("\n");
+}
+
 function saveSettings() {
   localStorage.setItem("astroChaosApiSettings", JSON.stringify(state.aiSettings));
 }
@@ -390,13 +707,14 @@ function saveSettings() {
 function syncSettingsInputs() {
   els.apiToken.value = state.aiSettings.token || "";
   els.apiBaseUrl.value = state.aiSettings.baseUrl || "";
+  els.apiProviders.value = formatProviders(state.aiSettings.providers);
   setModelOptions([{ id: state.aiSettings.model || "gpt-5.4", name: state.aiSettings.model || "gpt-5.4" }], state.aiSettings.model);
   els.wireApi.value = state.aiSettings.wireApi || "responses";
   els.aiMode.value = state.aiSettings.mode || "events";
   els.modelStatus.textContent = "填写 Token；Base URL 可为空，仅自定义网关时填写。";
 }
 
-async function refreshModels({ silent = false } = {}) {
+async function refreshModels({ silent = false, force = false } = {}) {
   if (!silent) {
     els.refreshModels.disabled = true;
     els.modelStatus.textContent = "正在从服务器获取模型列表...";
@@ -412,6 +730,7 @@ async function refreshModels({ silent = false } = {}) {
           baseUrl: els.apiBaseUrl.value.trim(),
           model: currentModel,
         },
+        refresh: force,
       }),
     });
     if (!response.ok) {
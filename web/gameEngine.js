@@ -111,7 +111,7 @@ function createInitialState(studentCount = 6) {
     gameOver: false,
     victory: false,
     aiEnabled: true,
-    aiBusy: false,
+    aiPending: false,
     aiLines: [],
     aiEvent: null,
     aiSettings: {
@@ -708,6 +708,7 @@ function serializeForAi(state) {
     avgAttrs: Object.fromEntries(Object.entries(stats.attrs).map(([attr, value]) => [attrLabel(attr), Math.round(value)])),
     recentLogs: state.logs.slice(0, 5).map((log) => `${log.type}: ${log.text}`),
     students: activeStudents(state).map((student) => ({
+      id: student.id,
       name: student.name,
       stress: Math.round(student.stress),
       honors: student.honors,